@@ -1,25 +1,27 @@
 from __future__ import annotations
 
-import pandas as _pd  # alias to avoid shadowing if user imports pandas as pd elsewhere
-
-
-def make_group_key(df: _pd.DataFrame, by: list[str]) -> _pd.Series:
-    """Vectorized group-key (tuple-valued Series)."""
-    if not by:
-        return _pd.Series([0] * len(df), index=df.index, dtype=object)
-    # Pandas groupby happily accepts a tuple-valued Series as the 'by' key;
-    # we materialize it once for re-use across multiple metrics.
-    mi = _pd.MultiIndex.from_frame(df[by], names=by)
-    return _pd.Series(mi.to_list(), index=df.index, dtype=object)
-
-
-from dataclasses import dataclass, field as dc_field
+from dataclasses import dataclass, field as dc_field, replace as dc_replace
 from enum import StrEnum
-from typing import Any, Iterable, Sequence, Mapping, override
+from functools import lru_cache, reduce
+from typing import Any, Callable, Iterable, Iterator, Sequence, Mapping, override
+from typing import Literal as _Literal  # 本模块的 Literal 是字面量表达式类
 import pandas as pd
 import numpy as np
 import re
+import itertools
+import operator
+import pickle
 import json
+import hashlib
+import time
+import tracemalloc
+import os
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from contextvars import ContextVar
 
 # ========= 0) 类型别名（PEP 695） =========
 
@@ -27,6 +29,71 @@ type RowAgg = "sum" | "mean" | "min" | "max" | "count" | "nunique"
 
 
 # ========= 1) 工具 =========
+@dataclass(slots=True)
+class GroupKey:
+    """整数编码分组键：每行一个稠密 int64 组号 + 组号 -> 维度取值的解码表。"""
+    names: list[str]
+    codes: np.ndarray  # shape=(n_rows,), 0..ngroups-1
+    uniques: pd.DataFrame  # index = 组号，列 = names
+
+    @property
+    def ngroups(self) -> int: return len(self.uniques)
+
+    def groupby(self, s: pd.Series):
+        # 按位置对齐（codes 与 s 同长），结果索引即组号
+        return s.groupby(self.codes, sort=True)
+
+    def size(self) -> pd.Series:
+        return pd.Series(np.bincount(self.codes, minlength=self.ngroups), dtype="int64")
+
+
+def make_group_key(df: pd.DataFrame, by: list[str]) -> GroupKey:
+    """逐列 factorize 成整数码，再按混合进制合成单个组号；全程不构造 Python tuple。"""
+    n = len(df)
+    if not by:
+        return GroupKey([], np.zeros(n, dtype=np.int64), pd.DataFrame(index=pd.RangeIndex(1 if n else 0)))
+
+    level_codes: list[np.ndarray] = []
+    level_uniques: list[pd.Index] = []
+    for name in by:
+        c, u = pd.factorize(df[name], sort=True, use_na_sentinel=False)
+        level_codes.append(c.astype(np.int64, copy=False))
+        level_uniques.append(pd.Index(u))
+
+    # 混合进制合成；基数乘积可能溢出 int64 时先压缩一次
+    combined = level_codes[0]
+    radix = max(len(level_uniques[0]), 1)
+    compacted = False
+    for c, u in zip(level_codes[1:], level_uniques[1:]):
+        k = max(len(u), 1)
+        if radix * k >= 2 ** 62:
+            combined, _ = pd.factorize(combined, sort=True)
+            radix, compacted = int(combined.max()) + 1 if n else 1, True
+        combined = combined * k + c
+        radix *= k
+    codes, packed = pd.factorize(combined, sort=True)
+    codes = codes.astype(np.int64, copy=False)
+    ngroups = len(packed)
+
+    if compacted:
+        # 罕见路径：按首次出现位置解码
+        _, first = np.unique(codes, return_index=True)
+        decoded = [c[first] for c in level_codes]
+    else:
+        decoded, rest = [], np.asarray(packed, dtype=np.int64)
+        for u in reversed(level_uniques[1:]):
+            k = max(len(u), 1)
+            decoded.append(rest % k)
+            rest = rest // k
+        decoded.append(rest)
+        decoded.reverse()
+
+    uniques = pd.DataFrame({i: u.take(d) for i, (u, d) in enumerate(zip(level_uniques, decoded))},
+                           index=pd.RangeIndex(ngroups))
+    uniques.columns = list(by)
+    return GroupKey(list(by), codes, uniques)
+
+
 def _flatten_multi_columns(cols: Iterable[tuple[str, ...]]) -> list[str]:
     out: list[str] = []
     for t in cols:
@@ -41,12 +108,20 @@ def Concat(a: "ScalarExpr | str", b: "ScalarExpr | str") -> "ScalarExpr":
     return BinaryOp(sa, sb, _op_fn("||"), "||")
 
 
+def _as_str(v: Any) -> Any:
+    return v.astype(str) if isinstance(v, pd.Series) else str(v)
+
+
+def _str_concat(a, b): return _as_str(a) + _as_str(b)
+
+
 def _op_fn(symbol: str):
-    if symbol == "+":  return lambda a, b: a + b
-    if symbol == "-":  return lambda a, b: a - b
-    if symbol == "*":  return lambda a, b: a * b
-    if symbol == "/":  return lambda a, b: a / b
-    if symbol == "||": return lambda a, b: a.astype(str) + b.astype(str)
+    # 模块级函数（而非 lambda），表达式树可 pickle 到子进程
+    if symbol == "+":  return operator.add
+    if symbol == "-":  return operator.sub
+    if symbol == "*":  return operator.mul
+    if symbol == "/":  return operator.truediv
+    if symbol == "||": return _str_concat
     raise ValueError(f"Unsupported binary op: {symbol}")
 
 
@@ -59,12 +134,78 @@ class Dialect(StrEnum):
 
 # ========= 3) 表达式体系 =========
 class Expr[T]:
+    # 结构字段（同时供 match 位置模式与结构哈希使用）
+    __match_args__: tuple[str, ...] = ()
+
     def dependencies(self) -> set[str]:
         return set()
 
+    def signature(self) -> tuple:
+        """结构哈希键：类型 + 结构字段（递归）。__eq__ 已重载为谓词构造，故不走 __hash__/__eq__。"""
+        sig = self.__dict__.get("_sig")
+        if sig is None:
+            sig = (type(self).__name__, *(_sig_of(getattr(self, f)) for f in self.__match_args__))
+            self.__dict__["_sig"] = sig
+        return sig
+
+
+def _sig_of(v: Any) -> Any:
+    if isinstance(v, Expr): return v.signature()
+    if isinstance(v, (list, tuple)): return tuple(_sig_of(x) for x in v)
+    if callable(v): return None  # BinaryOp.op 由 symbol 决定
+    try:
+        hash(v)
+    except TypeError:
+        return (type(v).__name__, repr(v))
+    return (type(v).__name__, v)
+
+
+class EvalContext:
+    """单次执行内的求值上下文：同一帧上结构相同的子表达式只计算一次。
+
+    eval() 的结果可能是标量（字面量及其纯标量运算），由 pandas 广播；
+    只有确实需要整列时才用 series() 物化。
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.memo: dict[tuple, pd.Series] = {}
+
+    def eval(self, e: "ScalarExpr") -> pd.Series:
+        sig = e.signature()
+        out = self.memo.get(sig)
+        if out is None:
+            if isinstance(e, PredicateExpr): out = _eval_on_dictionary(e, self)
+            if out is None: out = _eval_fused(e, self)
+            if out is None: out = e._eval(self)
+            self.memo[sig] = out
+        return out
+
+    def series(self, e: "ScalarExpr") -> pd.Series:
+        v = self.eval(e)
+        return v if isinstance(v, pd.Series) else pd.Series(v, index=self.df.index)
+
+
+def _eval_on_dictionary(p: "PredicateExpr", ctx: EvalContext) -> pd.Series | None:
+    """谓词只依赖单个分类列时：在字典（categories + NA）上求值一次，再按码映射回各行。"""
+    deps = p.dependencies()
+    if len(deps) != 1: return None
+    name = next(iter(deps))
+    s = ctx.df[name] if name in ctx.df.columns else None
+    if s is None or not isinstance(s.dtype, pd.CategoricalDtype): return None
+    cats = s.cat.categories
+    if len(cats) + 1 >= len(s): return None
+    # 位置 0 放 NA（对应码 -1），其后依次是各分类取值
+    values = pd.Series(pd.Categorical.from_codes(np.arange(-1, len(cats)), dtype=s.dtype)).astype(cats.dtype)
+    dict_mask = _to_mask(EvalContext(pd.DataFrame({name: values})).eval(p), len(values))
+    return pd.Series(dict_mask[s.cat.codes.to_numpy() + 1], index=s.index)
+
 
 class ScalarExpr[T](Expr[T]):
     def eval(self, df: pd.DataFrame) -> pd.Series:
+        return EvalContext(df).series(self)
+
+    def _eval(self, ctx: EvalContext) -> pd.Series | Any:
         raise NotImplementedError
 
     # 算术
@@ -145,12 +286,19 @@ class ScalarExpr[T](Expr[T]):
 
 
 class AggExpr[T](Expr[T]):
-    def aggregate(self, df: pd.DataFrame, by: list[str]) -> pd.Series:
+    def partials(self) -> list["Reduction"]:
+        """本聚合所需的分组归约；引擎会把所有度量的归约合并成一次 groupby。"""
         raise NotImplementedError
 
+    def finalize(self, parts: list[pd.Series]) -> pd.Series:
+        """由 partials() 对应的归约结果（组号索引）推出最终值。"""
+        raise NotImplementedError
 
-class WindowExpr[T](Expr[T]):
-    ...
+    def aggregate(self, df: pd.DataFrame, by: list[str], key: GroupKey | None = None) -> pd.Series:
+        """结果以组号（GroupKey.codes）为索引；key 由调用方传入时复用，不再重复编码。"""
+        key = key or make_group_key(df, by)
+        reduced = run_reductions(df, key, self.partials())
+        return self.finalize([reduced[i] for i in reduced.columns])
 
 
 class PredicateExpr(ScalarExpr[bool]):
@@ -163,10 +311,12 @@ class PredicateExpr(ScalarExpr[bool]):
 
 # ---- 具体 ScalarExpr ----
 class ColumnRef(ScalarExpr[Any]):
+    __match_args__ = ("name",)
+
     def __init__(self, name: str): self.name = name
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series: return df[self.name]
+    def _eval(self, ctx: EvalContext) -> pd.Series: return ctx.df[self.name]
 
     @override
     def dependencies(self) -> set[str]: return {self.name}
@@ -175,24 +325,33 @@ class ColumnRef(ScalarExpr[Any]):
 
 
 class Literal(ScalarExpr[Any]):
+    __match_args__ = ("value",)
+
     def __init__(self, value: Any): self.value = value
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        return pd.Series([self.value] * len(df), index=df.index)
+    def _eval(self, ctx: EvalContext) -> Any:
+        return self.value  # 标量，由调用方广播
 
     def __str__(self) -> str: return repr(self.value)
 
 
 class Coalesce(ScalarExpr[Any]):
+    __match_args__ = ("exprs",)
+
     def __init__(self, *exprs: ScalarExpr | str):
         self.exprs: list[ScalarExpr] = [_resolve_scalar(e) for e in exprs]
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        s = self.exprs[0].eval(df).copy()
+    def _eval(self, ctx: EvalContext) -> pd.Series | Any:
+        s = ctx.eval(self.exprs[0])
         for e in self.exprs[1:]:
-            s = s.fillna(e.eval(df))
+            if isinstance(s, pd.Series):
+                v = ctx.eval(e)
+                if isinstance(v, pd.Series) or not pd.isna(v):
+                    s = _decoded(s).fillna(v)  # 填充值可能不在字典里
+            elif pd.isna(s):
+                s = ctx.eval(e)
         return s
 
     @override
@@ -203,24 +362,36 @@ class Coalesce(ScalarExpr[Any]):
 
 
 class CaseWhen(ScalarExpr[Any]):
+    __match_args__ = ("whens", "otherwise")
+
     def __init__(self, whens: list[tuple[PredicateExpr, ScalarExpr | str]],
                  otherwise: ScalarExpr | str | None = None):
         self.whens = [(cond, _resolve_scalar(val)) for cond, val in whens]
         self.otherwise = _resolve_scalar(otherwise) if otherwise is not None else None
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        res = pd.Series(index=df.index, dtype="object")
-        covered = pd.Series(False, index=df.index)
-        for cond, val in self.whens:
-            m = cond.eval(df)
-            pick = m & ~covered
-            if pick.any():
-                res[pick] = val.eval(df)[pick]
-                covered |= m
-        if self.otherwise is not None:
-            res[~covered] = self.otherwise.eval(df)[~covered]
-        return res
+    def _eval(self, ctx: EvalContext) -> pd.Series:
+        # 一次 np.select 解出全部分支（先命中者优先，与 SQL CASE 一致），再按分支取值推断结果类型
+        idx = ctx.df.index
+        conds = [_to_mask(ctx.eval(c), len(idx)) for c, _ in self.whens]
+        choices = [ctx.eval(v) for _, v in self.whens]
+        default = ctx.eval(self.otherwise) if self.otherwise is not None else None
+        match _case_kind([*choices, *([default] if default is not None else [])]):
+            case "numeric":
+                arrs = [_to_numeric_array(v) for v in choices]
+                fill = _to_numeric_array(default) if default is not None else np.nan
+                dtype = np.result_type(*arrs, *([fill] if default is not None else []))
+                if default is None and dtype.kind in "biu": dtype = np.dtype("float64")
+                out = np.select(conds, [a.astype(dtype, copy=False) for a in arrs], default=fill) if conds \
+                    else np.broadcast_to(np.asarray(fill, dtype=dtype), len(idx)).copy()
+                return pd.Series(out.astype(dtype, copy=False), index=idx)
+            case _:
+                # 字符串/混合分支保持 object：不转分类，避免与字典外取值比较、fillna 新值时报错
+                arrs = [np.asarray(v, dtype=object) for v in choices]
+                fill = np.asarray(default, dtype=object) if default is not None else np.nan
+                out = np.select(conds, arrs, default=fill) if conds \
+                    else np.broadcast_to(np.asarray(fill, dtype=object), len(idx)).copy()
+                return pd.Series(out, index=idx, dtype=object)
 
     @override
     def dependencies(self) -> set[str]:
@@ -230,12 +401,54 @@ class CaseWhen(ScalarExpr[Any]):
         return out
 
 
+def _decoded(v: Any) -> Any:
+    # 分类列（字典编码）还原成取值列：算术、字典外取值比较、填充新值都按原字符串语义进行
+    return v.astype(v.cat.categories.dtype) if isinstance(v, pd.Series) and isinstance(v.dtype, pd.CategoricalDtype) \
+        else v
+
+
+def _to_mask(m: Any, n: int) -> np.ndarray:
+    # 谓词结果 -> bool ndarray（NA 视为 False）
+    if isinstance(m, pd.Series): return m.to_numpy(dtype=bool, na_value=False)
+    return np.broadcast_to(np.asarray(bool(m) if not pd.isna(m) else False), n)
+
+
+def _to_numeric_array(v: Any) -> np.ndarray:
+    if isinstance(v, pd.Series):
+        if isinstance(v.dtype, np.dtype): return v.to_numpy()
+        return v.to_numpy(dtype="float64", na_value=np.nan)
+    return np.asarray(v)
+
+
+def _case_kind(values: list[Any]) -> str:
+    """分支取值类型：numeric / string / object。"""
+    kinds = set()
+    for v in values:
+        if isinstance(v, pd.Series):
+            if pd.api.types.is_numeric_dtype(v.dtype):
+                kinds.add("numeric")
+            elif pd.api.types.infer_dtype(v, skipna=True) in ("string", "empty"):
+                kinds.add("string")
+            else:
+                kinds.add("object")
+        elif isinstance(v, (bool, int, float, np.number, np.bool_)):
+            kinds.add("numeric")
+        elif isinstance(v, str):
+            kinds.add("string")
+        else:
+            kinds.add("object")
+    return kinds.pop() if len(kinds) == 1 else "object"
+
+
 class BinaryOp(ScalarExpr[Any]):
+    __match_args__ = ("left", "right", "op", "symbol")
+
     def __init__(self, left: ScalarExpr, right: ScalarExpr, op, symbol: str):
         self.left, self.right, self.op, self.symbol = left, right, op, symbol
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series: return self.op(self.left.eval(df), self.right.eval(df))
+    def _eval(self, ctx: EvalContext) -> pd.Series | Any:
+        return self.op(_decoded(ctx.eval(self.left)), _decoded(ctx.eval(self.right)))
 
     @override
     def dependencies(self) -> set[str]: return self.left.dependencies() | self.right.dependencies()
@@ -244,13 +457,18 @@ class BinaryOp(ScalarExpr[Any]):
 
 
 class SafeDiv(ScalarExpr[float]):
+    __match_args__ = ("numer", "denom", "fill")
+
     def __init__(self, numerator: ScalarExpr, denominator: ScalarExpr, fill: float = 0.0):
         self.numer, self.denom, self.fill = numerator, denominator, fill
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        n = self.numer.eval(df)
-        d = self.denom.eval(df).replace({0: np.nan})
+    def _eval(self, ctx: EvalContext) -> pd.Series | Any:
+        n = ctx.eval(self.numer)
+        d = ctx.eval(self.denom)
+        if not isinstance(n, pd.Series) and not isinstance(d, pd.Series):
+            return self.fill if pd.isna(n) or pd.isna(d) or d == 0 else n / d
+        d = d.replace({0: np.nan}) if isinstance(d, pd.Series) else (np.nan if d == 0 else d)
         return (n / d).fillna(self.fill)
 
     @override
@@ -259,12 +477,14 @@ class SafeDiv(ScalarExpr[float]):
 
 # ---- 谓词 ----
 class Cmp(PredicateExpr):
+    __match_args__ = ("left", "right", "op")
+
     def __init__(self, left: ScalarExpr, right: ScalarExpr, op: str):
         self.left, self.right, self.op = left, right, op
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        l, r = self.left.eval(df), self.right.eval(df)
+    def _eval(self, ctx: EvalContext) -> pd.Series:
+        l, r = _decoded(ctx.eval(self.left)), _decoded(ctx.eval(self.right))
         match self.op:
             case "==" | "=":  # 新增 "=" 兼容
                 return l == r
@@ -287,49 +507,57 @@ class Cmp(PredicateExpr):
 
 
 class InSet(PredicateExpr):
+    __match_args__ = ("expr", "values")
+
     def __init__(self, expr: ScalarExpr, values: list[Any]):
         self.expr, self.values = expr, values
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series: return self.expr.eval(df).isin(self.values)
+    def _eval(self, ctx: EvalContext) -> pd.Series: return ctx.series(self.expr).isin(self.values)
 
     @override
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
 
 class Between(PredicateExpr):
+    __match_args__ = ("expr", "left", "right", "inclusive")
+
     def __init__(self, expr: ScalarExpr, left: Any, right: Any, inclusive: str = "both"):
         self.expr, self.left, self.right, self.inclusive = expr, left, right, inclusive
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        return self.expr.eval(df).between(self.left, self.right, inclusive=self.inclusive)
+    def _eval(self, ctx: EvalContext) -> pd.Series:
+        return ctx.series(self.expr).between(self.left, self.right, inclusive=self.inclusive)
 
     @override
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
 
 class IsNull(PredicateExpr):
+    __match_args__ = ("expr",)
+
     def __init__(self, expr: ScalarExpr): self.expr = expr
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series: return self.expr.eval(df).isna()
+    def _eval(self, ctx: EvalContext) -> pd.Series: return ctx.series(self.expr).isna()
 
     @override
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
 
 class BoolOp(PredicateExpr):
+    __match_args__ = ("left", "right", "op")
+
     def __init__(self, left: PredicateExpr, right: PredicateExpr, op: str):
         self.left, self.right, self.op = left, right, op
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
+    def _eval(self, ctx: EvalContext) -> pd.Series:
         match self.op:
             case "and":
-                return self.left.eval(df) & self.right.eval(df)
+                return ctx.eval(self.left) & ctx.eval(self.right)
             case "or":
-                return self.left.eval(df) | self.right.eval(df)
+                return ctx.eval(self.left) | ctx.eval(self.right)
             case _:
                 raise ValueError(self.op)
 
@@ -339,10 +567,12 @@ class BoolOp(PredicateExpr):
 
 
 class NotOp(PredicateExpr):
+    __match_args__ = ("inner",)
+
     def __init__(self, inner: PredicateExpr): self.inner = inner
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series: return ~self.inner.eval(df)
+    def _eval(self, ctx: EvalContext) -> pd.Series: return ~ctx.series(self.inner)
 
     @override
     def dependencies(self) -> set[str]: return self.inner.dependencies()
@@ -360,25 +590,73 @@ def _like_to_regex(pat: str) -> str:
     return "^" + "".join(buf) + "$"
 
 
+@lru_cache(maxsize=1024)
+def _compile_regex(pattern: str, flags: int = 0) -> re.Pattern:
+    """进程内共享的已编译正则缓存（LIKE 转换后的正则与 REGEXP 共用）。"""
+    return re.compile(pattern, flags)
+
+
+@lru_cache(maxsize=1024)
+def _like_shape(pat: str) -> tuple[str, str] | None:
+    """简单 LIKE 形态：abc / abc% / %abc / %abc% / % -> (kind, 文本)；其余返回 None 走正则。"""
+    if "_" in pat: return None
+    core = pat.strip("%")
+    if "%" in core: return None
+    if not core: return ("any", "") if pat else ("exact", "")
+    lead, trail = pat.startswith("%"), pat.endswith("%")
+    kind = "contains" if lead and trail else "endswith" if lead else "startswith" if trail else "exact"
+    return kind, core
+
+
+def _like_match(s: pd.Series, pat: str, ci: bool) -> pd.Series:
+    # s 为已转 str 的列；简单形态走 startswith/endswith/contains 字符串内核，不进正则引擎
+    shape = _like_shape(pat)
+    if shape is None:
+        return s.str.contains(_compile_regex(_like_to_regex(pat), re.IGNORECASE if ci else 0), na=False)
+    kind, text = shape
+    if ci: s, text = s.str.lower(), text.lower()
+    match kind:
+        case "any":
+            return s.notna()
+        case "exact":
+            return (s == text).fillna(False)
+        case "startswith":
+            return s.str.startswith(text, na=False)
+        case "endswith":
+            return s.str.endswith(text, na=False)
+        case _:
+            return s.str.contains(text, regex=False, na=False)
+
+
+def _match_per_pattern(s: pd.Series, patt: pd.Series, fn) -> pd.Series:
+    """模式逐行不同时：按不同模式值分组，每个模式只处理一次、向量化作用于其所属行。"""
+    codes, uniques = pd.factorize(patt, use_na_sentinel=False)
+    out = np.zeros(len(s), dtype=bool)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+    start = 0
+    for pat, stop in zip(uniques, bounds):
+        rows = order[start:stop]
+        out[rows] = fn(s.iloc[rows], str(pat)).to_numpy(dtype=bool, na_value=False)
+        start = stop
+    return pd.Series(out, index=s.index)
+
+
 class LikePredicate(PredicateExpr):
+    __match_args__ = ("expr", "pattern", "ci", "neg")
+
     def __init__(self, expr: ScalarExpr, pattern: ScalarExpr, case_insensitive: bool, neg: bool):
         self.expr, self.pattern = expr, pattern
         self.ci, self.neg = case_insensitive, neg
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        s = self.expr.eval(df).astype(str)
-        p = self.pattern
-        if isinstance(p, Literal) and isinstance(p.value, str):
-            regex = _like_to_regex(p.value)
-            m = s.str.contains(regex, regex=True, case=not self.ci, na=False)
+    def _eval(self, ctx: EvalContext) -> pd.Series:
+        s = ctx.series(self.expr).astype(str)
+        p = ctx.eval(self.pattern)
+        if not isinstance(p, pd.Series):
+            m = _like_match(s, str(p), self.ci)
         else:
-            patt = p.eval(df).astype(str)
-            mask = []
-            for val, pat in zip(s, patt):
-                regex = re.compile(_like_to_regex(pat), 0 if not self.ci else re.IGNORECASE)
-                mask.append(bool(regex.search(val)))
-            m = pd.Series(mask, index=df.index)
+            m = _match_per_pattern(s, p.astype(str), lambda sub, pat: _like_match(sub, pat, self.ci))
         return ~m if self.neg else m
 
     @override
@@ -387,23 +665,21 @@ class LikePredicate(PredicateExpr):
 
 
 class RegexPredicate(PredicateExpr):
+    __match_args__ = ("expr", "pattern", "flags", "neg")
+
     def __init__(self, expr: ScalarExpr, pattern: ScalarExpr, flags: str, neg: bool = False):
         self.expr, self.pattern, self.flags, self.neg = expr, pattern, flags, neg
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        s = self.expr.eval(df).astype(str)
-        if isinstance(self.pattern, Literal) and isinstance(self.pattern.value, str):
-            flags = 0
-            if "i" in self.flags.lower(): flags |= re.IGNORECASE
-            m = s.str.contains(self.pattern.value, regex=True, na=False, flags=flags)
+    def _eval(self, ctx: EvalContext) -> pd.Series:
+        s = ctx.series(self.expr).astype(str)
+        flags = re.IGNORECASE if "i" in self.flags.lower() else 0
+        p = ctx.eval(self.pattern)
+        if not isinstance(p, pd.Series):
+            m = s.str.contains(_compile_regex(str(p), flags), na=False)
         else:
-            patt = self.pattern.eval(df).astype(str)
-            mask = []
-            for val, pat in zip(s, patt):
-                rgx = re.compile(pat, re.IGNORECASE if "i" in self.flags.lower() else 0)
-                mask.append(bool(rgx.search(val)))
-            m = pd.Series(mask, index=df.index)
+            m = _match_per_pattern(s, p.astype(str),
+                                   lambda sub, pat: sub.str.contains(_compile_regex(pat, flags), na=False))
         return ~m if self.neg else m
 
     @override
@@ -411,6 +687,88 @@ class RegexPredicate(PredicateExpr):
         return self.expr.dependencies() | self.pattern.dependencies()
 
 
+# ---- 谓词执行：选择向量 + 短路 ----
+def _conjuncts(p: PredicateExpr, op: str) -> list[PredicateExpr]:
+    p = p.as_inner() if isinstance(p, SQLPredicate) else p
+    if isinstance(p, BoolOp) and p.op == op:
+        return _conjuncts(p.left, op) + _conjuncts(p.right, op)
+    return [p]
+
+
+def _pred_estimate(p: PredicateExpr) -> tuple[float, float]:
+    """(单行代价, 选择率) 的粗略静态估计，仅用于决定合取/析取项的求值顺序。"""
+    p = p.as_inner() if isinstance(p, SQLPredicate) else p
+    match p:
+        case BoolOp(left, right, op):
+            (cl, sl), (cr, sr) = _pred_estimate(left), _pred_estimate(right)
+            return cl + cr, (sl * sr if op == "and" else sl + sr - sl * sr)
+        case NotOp(inner):
+            c, sel = _pred_estimate(inner)
+            return c, 1.0 - sel
+        case Cmp(_, _, op):
+            return 1.0, (0.1 if op in ("==", "=") else 0.9 if op in ("!=", "<>") else 0.5)
+        case InSet(_, values):
+            return 1.5, min(0.05 * max(len(values), 1), 0.9)
+        case Between():
+            return 1.0, 0.3
+        case IsNull():
+            return 0.5, 0.1
+        case LikePredicate(_, pattern, _, _):
+            return (8.0 if isinstance(pattern, Literal) else 50.0), 0.3
+        case RegexPredicate(_, pattern, _, _):
+            return (15.0 if isinstance(pattern, Literal) else 60.0), 0.3
+        case _:
+            return 5.0, 0.5
+
+
+def _rank(p: PredicateExpr, op: str) -> float:
+    # AND：优先“便宜且淘汰多”的项；OR：优先“便宜且命中多”的项
+    cost, sel = _pred_estimate(p)
+    return cost / max(1.0 - sel, 1e-3) if op == "and" else cost / max(sel, 1e-3)
+
+
+def take_rows(df: pd.DataFrame, pos: np.ndarray, cols: list[str]) -> pd.DataFrame:
+    """一次性取出 pos 行 × cols 列（只拷贝这一块）。"""
+    idx = df.columns.get_indexer(cols)
+    if (idx < 0).any(): raise KeyError([c for c, i in zip(cols, idx) if i < 0])
+    return df.iloc[pos, idx]
+
+
+def filter_positions(pred: PredicateExpr, df: pd.DataFrame, sel: np.ndarray | None = None,
+                     index: "DataIndex | None" = None) -> np.ndarray:
+    """返回 sel（升序行位置，默认全部行）中满足 pred 的位置。
+
+    AND 按估计代价/选择率排序，后续项只在前面存活的行上求值；
+    OR 对尚未命中的补集继续求值；NOT 取 sel 内补集（与 ~mask 语义一致）。
+    index（df 的 DataIndex）命中单列叶子谓词时直接给出位置，或只在不确定的块上求值。
+    """
+    if sel is None: sel = np.arange(len(df))
+    if not len(sel): return sel
+    p = pred.as_inner() if isinstance(pred, SQLPredicate) else pred
+    match p:
+        case BoolOp(_, _, "and"):
+            for c in sorted(_conjuncts(p, "and"), key=lambda c: _rank(c, "and")):
+                sel = filter_positions(c, df, sel, index)
+                if not len(sel): break
+            return sel
+        case BoolOp(_, _, "or"):
+            hits, rest = [], sel
+            for c in sorted(_conjuncts(p, "or"), key=lambda c: _rank(c, "or")):
+                ok = filter_positions(c, df, rest, index)
+                hits.append(ok)
+                rest = np.setdiff1d(rest, ok, assume_unique=True)
+                if not len(rest): break
+            return np.sort(np.concatenate(hits))
+        case NotOp(inner):
+            return np.setdiff1d(sel, filter_positions(inner, df, sel, index), assume_unique=True)
+        case _:
+            if index is not None and (probe := index.probe(p, sel)) is not None:
+                sure, maybe = probe
+                return sure if not len(maybe) else np.union1d(sure, filter_positions(p, df, maybe))
+            sub = df if len(sel) == len(df) else take_rows(df, sel, sorted(p.dependencies()))
+            return sel[_to_mask(EvalContext(sub).eval(p), len(sub))]
+
+
 def col(name: str) -> ColumnRef: return ColumnRef(name)
 
 
@@ -423,6 +781,193 @@ def _resolve_scalar(x: ScalarExpr | str | int | float | None) -> ScalarExpr:
     return lit(x)
 
 
+# ---- 表达式编译：融合内核（numexpr 字符串 / 分块 NumPy + 复用暂存缓冲） ----
+# 只融合 int64/float64 列上的 + - * SafeDiv、比较、AND/OR/NOT、Between、IsNull；
+# 其余（字符串、分类、可空扩展类型、Case/Coalesce/LIKE…）仍逐节点求值。
+FUSED_MIN_ROWS = 65_536  # 行数少于此值时逐节点求值更省
+FUSED_BLOCK_ROWS = 65_536
+_FUSABLE_DTYPES = (np.dtype("int64"), np.dtype("float64"))
+_NE_CMP = {"==": "==", "=": "==", "!=": "!=", "<>": "!=", ">": ">", ">=": ">=", "<": "<", "<=": "<="}
+_NP_CMP = {"==": np.equal, "!=": np.not_equal, ">": np.greater, ">=": np.greater_equal,
+           "<": np.less, "<=": np.less_equal}
+_NP_ARITH = {"+": np.add, "-": np.subtract, "*": np.multiply}
+
+
+@lru_cache(maxsize=1)
+def _numexpr() -> Any | None:
+    try:
+        import numexpr  # type: ignore
+    except ImportError:
+        return None
+    return numexpr
+
+
+@dataclass(slots=True)
+class _Node:
+    """降级后的内核节点：kind ∈ col/const/arith/div/cmp/and/or/not/isnull；slot 为暂存缓冲下标。"""
+    kind: str
+    dtype: np.dtype
+    args: tuple = ()
+    value: Any = None  # col：输入列下标；const：标量；arith/cmp：运算符；div：fill
+    slot: int = -1
+
+
+@dataclass(slots=True)
+class Kernel:
+    """一个表达式树融合成的内核：一次遍历输入列，按块写出结果，不产生整列中间量。"""
+    columns: list[str]
+    root: _Node
+    slots: list[np.dtype]
+    source: str | None = None  # numexpr 表达式（不可用时为 None，走分块 NumPy）
+
+    def run(self, df: pd.DataFrame) -> np.ndarray:
+        cols = [df[c].to_numpy() for c in self.columns]
+        ne = _numexpr() if self.source is not None else None
+        if ne is not None:
+            local = {f"c{i}": c for i, c in enumerate(cols)}
+            local.update(_const_bindings(self.root))
+            return ne.evaluate(self.source, local_dict=local)
+        n = len(df)
+        out = np.empty(n, dtype=self.root.dtype)
+        scratch = [np.empty(min(n, FUSED_BLOCK_ROWS), dtype=d) for d in self.slots]
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            for start in range(0, n, FUSED_BLOCK_ROWS):
+                stop = min(start + FUSED_BLOCK_ROWS, n)
+                out[start:stop] = _run_block(self.root, [c[start:stop] for c in cols], scratch, stop - start)
+        return out
+
+
+def _const_bindings(node: _Node) -> dict[str, Any]:
+    out: dict[str, Any] = {}
+    if node.kind == "const": out[f"k{node.slot}"] = node.dtype.type(node.value)
+    if node.kind == "div": out[f"k{node.slot}"] = np.float64(node.value)
+    for a in node.args: out.update(_const_bindings(a))
+    return out
+
+
+def _lower(e: ScalarExpr, df: pd.DataFrame, columns: dict[str, int], slots: list[np.dtype]) -> _Node | None:
+    """表达式 -> _Node 树；遇到不可融合的节点/类型返回 None。"""
+    def new(kind: str, dtype: np.dtype, args: tuple = (), value: Any = None) -> _Node:
+        slots.append(np.dtype(dtype))
+        return _Node(kind, np.dtype(dtype), args, value, len(slots) - 1)
+
+    def numeric(*nodes: _Node | None) -> bool:
+        return all(n is not None and n.dtype != np.bool_ for n in nodes)
+
+    def logical(*nodes: _Node | None) -> bool:
+        return all(n is not None and n.dtype == np.bool_ for n in nodes)
+
+    e = e.as_inner() if isinstance(e, SQLPredicate) else e
+    if not e.dependencies():
+        v = EvalContext(pd.DataFrame()).eval(e)  # 纯字面量子树：折叠成常量
+        if isinstance(v, (bool, np.bool_)): return new("const", np.bool_, value=bool(v))
+        if isinstance(v, (int, np.integer)) and -2 ** 63 <= v < 2 ** 63: return new("const", np.int64, value=int(v))
+        if isinstance(v, (float, np.floating)): return new("const", np.float64, value=float(v))
+        return None
+    match e:
+        case ColumnRef(name):
+            if name not in df.columns or df[name].dtype not in _FUSABLE_DTYPES: return None
+            i = columns.setdefault(name, len(columns))
+            return _Node("col", df[name].dtype, value=i)
+        case BinaryOp(left, right, _, symbol) if symbol in _NP_ARITH:
+            a, b = _lower(left, df, columns, slots), _lower(right, df, columns, slots)
+            if not numeric(a, b): return None
+            return new("arith", np.result_type(a.dtype, b.dtype), (a, b), symbol)
+        case SafeDiv(numer, denom, fill):
+            a, b = _lower(numer, df, columns, slots), _lower(denom, df, columns, slots)
+            if not numeric(a, b) or not isinstance(fill, (int, float)): return None
+            slots.append(np.dtype(np.bool_))  # 紧邻的布尔暂存：d == 0 | 结果为 NaN
+            return new("div", np.float64, (a, b), float(fill))
+        case Cmp(left, right, op) if op in _NE_CMP:
+            a, b = _lower(left, df, columns, slots), _lower(right, df, columns, slots)
+            if not numeric(a, b): return None
+            return new("cmp", np.bool_, (a, b), _NE_CMP[op])
+        case BoolOp(left, right, op) if op in ("and", "or"):
+            a, b = _lower(left, df, columns, slots), _lower(right, df, columns, slots)
+            return new(op, np.bool_, (a, b)) if logical(a, b) else None
+        case NotOp(inner):
+            a = _lower(inner, df, columns, slots)
+            return new("not", np.bool_, (a,)) if logical(a) else None
+        case IsNull(expr):
+            a = _lower(expr, df, columns, slots)
+            return new("isnull", np.bool_, (a,)) if numeric(a) else None
+        case Between(expr, left, right, inclusive):
+            lower = Cmp(expr, Literal(left), ">=" if inclusive in ("both", "left") else ">")
+            upper = Cmp(expr, Literal(right), "<=" if inclusive in ("both", "right") else "<")
+            return _lower(BoolOp(lower, upper, "and"), df, columns, slots)
+        case _:
+            return None
+
+
+def _ne_source(node: _Node) -> str:
+    a = [_ne_source(x) for x in node.args]
+    match node.kind:
+        case "col": return f"c{node.value}"
+        case "const": return f"k{node.slot}"
+        case "arith" | "cmp": return f"({a[0]} {node.value} {a[1]})"
+        case "div":
+            q = f"({a[0]} / {a[1]})"
+            return f"where(({a[1]} == 0) | ({q} != {q}), k{node.slot}, {q})"
+        case "and": return f"({a[0]} & {a[1]})"
+        case "or": return f"({a[0]} | {a[1]})"
+        case "not": return f"(~{a[0]})"
+        case "isnull": return f"({a[0]} != {a[0]})"
+    raise ValueError(node.kind)
+
+
+def _run_block(node: _Node, cols: list[np.ndarray], scratch: list[np.ndarray], m: int) -> Any:
+    """在一个块上求值；每个节点写入自己的暂存缓冲（跨块复用），返回数组或标量。"""
+    if node.kind == "col": return cols[node.value]
+    if node.kind == "const": return node.value
+    a = [_run_block(x, cols, scratch, m) for x in node.args]
+    out = scratch[node.slot][:m]
+    match node.kind:
+        case "arith": _NP_ARITH[node.value](a[0], a[1], out=out)
+        case "cmp": _NP_CMP[node.value](a[0], a[1], out=out)
+        case "and": np.logical_and(a[0], a[1], out=out)
+        case "or": np.logical_or(a[0], a[1], out=out)
+        case "not": np.logical_not(a[0], out=out)
+        case "isnull": np.not_equal(a[0], a[0], out=out)
+        case "div":
+            # 与 SafeDiv 相同：分母为 0 或结果为 NaN 时取 fill
+            bad = scratch[node.slot - 1][:m]
+            np.divide(a[0], a[1], out=out)
+            np.equal(a[1], 0, out=bad)
+            bad |= out != out
+            np.copyto(out, node.value, where=bad)
+    return out
+
+
+_KERNEL_CACHE: OrderedDict[tuple, Kernel | None] = OrderedDict()
+_KERNEL_CACHE_SIZE = 256
+
+
+def compile_kernel(e: ScalarExpr, df: pd.DataFrame) -> Kernel | None:
+    """按 (表达式结构, 输入列 dtype) 缓存编译结果；不可融合（或只是单列/常量）时返回 None。"""
+    deps = sorted(e.dependencies())
+    if any(d not in df.columns for d in deps): return None
+    key = (e.signature(), tuple(str(df[d].dtype) for d in deps))
+    if key in _KERNEL_CACHE:
+        _KERNEL_CACHE.move_to_end(key)
+        return _KERNEL_CACHE[key]
+    columns: dict[str, int] = {}
+    slots: list[np.dtype] = []
+    root = _lower(e, df, columns, slots) if deps else None
+    kernel = None
+    if root is not None and root.kind not in ("col", "const"):
+        ordered = sorted(columns, key=columns.get)
+        kernel = Kernel(ordered, root, slots, _ne_source(root) if _numexpr() is not None else None)
+    _KERNEL_CACHE[key] = kernel
+    if len(_KERNEL_CACHE) > _KERNEL_CACHE_SIZE: _KERNEL_CACHE.popitem(last=False)
+    return kernel
+
+
+def _eval_fused(e: ScalarExpr, ctx: EvalContext) -> pd.Series | None:
+    if len(ctx.df) < FUSED_MIN_ROWS or isinstance(e, (ColumnRef, Literal)): return None
+    kernel = compile_kernel(e, ctx.df)
+    return None if kernel is None else pd.Series(kernel.run(ctx.df), index=ctx.df.index)
+
+
 # ========= 4) 字段/度量 =========
 class FieldRole(StrEnum):
     ROW = "row"
@@ -470,7 +1015,12 @@ class Dimension(Field[Any]):
         return f"__{self.name}@{g}__"
 
 
-class Measure[T](Field[T]): ...
+class Measure[T](Field[T]):
+    def partials(self) -> list[Reduction]:
+        raise NotImplementedError
+
+    def finalize(self, parts: list[pd.Series]) -> pd.Series:
+        raise NotImplementedError
 
 
 class RowMeasure(Measure[Any]):
@@ -480,6 +1030,22 @@ class RowMeasure(Measure[Any]):
 
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
+    @override
+    def partials(self) -> list[Reduction]:
+        match self.agg:
+            case "sum" | "min" | "max" | "count" | "nunique":
+                return [Reduction(self.agg, self.expr)]
+            case "mean":
+                return [Reduction("sum", self.expr), Reduction("count", self.expr)]
+            case other:
+                raise ValueError(f"Unsupported RowAgg: {other}")
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series:
+        if self.agg == "mean":
+            return parts[0] / parts[1].replace({0: np.nan})
+        return parts[0]
+
 
 class AggMeasure(Measure[Any]):
     def __init__(self, name: str, expr: AggExpr):
@@ -489,97 +1055,479 @@ class AggMeasure(Measure[Any]):
     def dependencies(self) -> set[str]:
         return self.expr.dependencies() if hasattr(self.expr, "dependencies") else set()
 
+    @override
+    def partials(self) -> list[Reduction]: return self.expr.partials()
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series: return self.expr.finalize(parts)
+
+
+class WindowMeasure(Measure[Any]):
+    """窗口度量：在聚合（及 HAVING）之后、透视之前计算，只作用于明细行。"""
+
+    def __init__(self, name: str, expr: WindowExpr):
+        super().__init__(name, FieldRole.COLUMN)
+        self.expr = expr
+
+    def dependencies(self) -> set[str]: return set()
+
+
+# ---- HyperLogLog 草图（近似去重，可按组构建、逐元素 max 合并） ----
+HLL_PRECISION = 12  # 2^12 个寄存器，相对标准误差约 1.04/sqrt(4096) ≈ 1.6%
+
+
+def hll_precision(error: float) -> int:
+    """相对标准误差 -> 寄存器位数 p（1.04/sqrt(2^p) <= error），限制在 [4, 18]。"""
+    if not 0 < error < 1: raise ValueError(f"HLL error must be in (0, 1), got {error}")
+    return int(min(18, max(4, np.ceil(2 * np.log2(1.04 / error)))))
+
+
+_NA_HASH = pd.util.hash_array(np.array([np.nan]))[0]
+
+
+def _hash64(values: pd.Series) -> np.ndarray:
+    """跨分块/进程稳定的 64 位哈希：整数与整值浮点按 int64（2**53 以上的 ID 不会因转 float64 相撞），
+    其余数值按 float64，其它按字符串；缺失值统一为一个哈希。object/分类列中的数值逐个按 Python 类型归类。"""
+    if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+        arr = values.to_numpy(dtype=object)
+        if pd.api.types.infer_dtype(arr, skipna=True) in ("integer", "boolean", "floating", "mixed-integer-float"):
+            ints = np.fromiter((isinstance(x, (int, np.integer)) for x in arr), dtype=bool, count=len(arr))
+            out = np.empty(len(arr), dtype=np.uint64)
+            out[ints] = _hash64(pd.Series(pd.array(arr[ints], dtype="Int64")))
+            out[~ints] = _hash64(pd.Series(arr[~ints].astype(np.float64)))  # None -> NaN
+            return out
+        values = pd.Series(arr)
+    na = values.isna().to_numpy()
+    if pd.api.types.is_bool_dtype(values.dtype) or pd.api.types.is_integer_dtype(values.dtype):
+        out = pd.util.hash_array(values.to_numpy(dtype=np.int64, na_value=0))
+    elif pd.api.types.is_numeric_dtype(values.dtype):
+        f = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        whole = (f == np.trunc(f)) & (np.abs(f) < 2.0 ** 63)  # 分块里出现 NaN 会把整数列变成 float
+        out = pd.util.hash_array(f)
+        out[whole] = pd.util.hash_array(f[whole].astype(np.int64))
+    else:
+        out = pd.util.hash_array(values.astype(str).to_numpy(dtype=object))
+    out[na] = _NA_HASH
+    return out
+
+
+def _bit_length(x: np.ndarray) -> np.ndarray:
+    n = np.zeros(x.shape, dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = x >= np.uint64(1 << shift)
+        x = np.where(big, x >> np.uint64(shift), x)
+        n += big.astype(np.uint8) * np.uint8(shift)
+    return n + (x > 0).astype(np.uint8)
+
+
+HLL_SPARSE_BYTES = 9  # 稀疏表示每个非零寄存器占用的字节（int64 槽位 + uint8 rank）
+
+
+@dataclass(slots=True)
+class HLLSketch:
+    """按组的 HyperLogLog 寄存器。
+
+    稀疏时只存非零寄存器：slots = 组号 * 2^p + 桶号（去重、无序）与对应 rank，内存随 (组, 桶) 对数增长，
+    组多而每组取值少时远小于 ngroups × 2^p 字节；非零寄存器多到稀疏更占内存时转为稠密 (ngroups, 2^p) 矩阵
+    （此时 slots=None，ranks 即矩阵）。两份草图合并即同槽位取 max。
+    """
+    p: int
+    ngroups: int
+    slots: np.ndarray | None
+    ranks: np.ndarray
+
+    def take(self, pos: np.ndarray) -> "HLLSketch":
+        """只保留 pos 指定的组（按 pos 顺序重新编号）。"""
+        pos = np.asarray(pos, dtype=np.int64)
+        if self.slots is None: return HLLSketch(self.p, len(pos), None, self.ranks[pos])
+        remap = np.full(self.ngroups, -1, dtype=np.int64)
+        remap[pos] = np.arange(len(pos))
+        g = remap[self.slots >> self.p]
+        keep = g >= 0
+        slots = (g[keep] << self.p) | (self.slots[keep] & ((1 << self.p) - 1))
+        return HLLSketch(self.p, len(pos), slots, self.ranks[keep])
+
+
+def _hll_reduce(p: int, ngroups: int, slots: np.ndarray, ranks: np.ndarray) -> HLLSketch:
+    """(槽位, rank) 可重复 -> 同槽位取 max；稠密矩阵只在不大于输入或比稀疏更省时分配。"""
+    m = 1 << p
+    if ngroups * m <= len(slots):
+        regs = np.zeros(ngroups * m, dtype=np.uint8)
+        np.maximum.at(regs, slots, ranks)
+        return HLLSketch(p, ngroups, None, regs.reshape(ngroups, m))
+    top = pd.Series(ranks, copy=False).groupby(slots, sort=False).max()
+    slots, ranks = top.index.to_numpy(dtype=np.int64), top.to_numpy(dtype=np.uint8)
+    if len(slots) * HLL_SPARSE_BYTES < ngroups * m:
+        return HLLSketch(p, ngroups, slots, ranks)
+    regs = np.zeros(ngroups * m, dtype=np.uint8)
+    regs[slots] = ranks  # 槽位已去重
+    return HLLSketch(p, ngroups, None, regs.reshape(ngroups, m))
+
+
+def hll_sketch(codes: np.ndarray, ngroups: int, hashes: np.ndarray, p: int = HLL_PRECISION) -> HLLSketch:
+    """按组构建 HyperLogLog 草图（见 HLLSketch）。"""
+    idx = (hashes >> np.uint64(64 - p)).astype(np.int64)
+    rest = (hashes << np.uint64(p)) | np.uint64(1 << (p - 1))  # 哨兵位保证 rank <= 64-p+1
+    rank = (np.uint8(65) - _bit_length(rest)).astype(np.uint8)
+    return _hll_reduce(p, ngroups, (np.asarray(codes, dtype=np.int64) << p) | idx, rank)
+
+
+def _hll_merge_dense(regs: np.ndarray, codes: np.ndarray, ngroups: int) -> np.ndarray:
+    """按组合并寄存器矩阵的行（逐元素 max）：排序后按组切片归约，比二维 np.maximum.at 快一个数量级。"""
+    out = np.zeros((ngroups, regs.shape[1]), dtype=np.uint8)
+    if not len(codes): return out
+    order = np.argsort(codes, kind="stable")
+    sc, rows = np.asarray(codes)[order], regs[order]
+    starts = np.flatnonzero(np.r_[True, sc[1:] != sc[:-1]])
+    if len(starts) > 4096:  # 组很多、每组行很少时逐组循环的开销占主导
+        out[sc[starts]] = np.maximum.reduceat(rows, starts, axis=0)
+        return out
+    for a, b in zip(starts, np.r_[starts[1:], len(sc)]):
+        out[sc[a]] = rows[a:b].max(axis=0)
+    return out
+
+
+def hll_merge(sketches: list[HLLSketch], codes: np.ndarray, ngroups: int) -> HLLSketch:
+    """合并多份草图：各草图的组依次拼接后，第 k 组并入新组 codes[k]。"""
+    p = sketches[0].p
+    if all(sk.slots is None for sk in sketches):
+        return HLLSketch(p, ngroups, None, _hll_merge_dense(np.vstack([sk.ranks for sk in sketches]), codes, ngroups))
+    codes = np.asarray(codes, dtype=np.int64)
+    mask = (1 << p) - 1
+    slots: list[np.ndarray] = []
+    ranks: list[np.ndarray] = []
+    offset = 0
+    for sk in sketches:
+        if sk.slots is None:
+            g, idx = np.nonzero(sk.ranks)
+            r = sk.ranks[g, idx]
+        else:
+            g, idx, r = sk.slots >> p, sk.slots & mask, sk.ranks
+        slots.append((codes[offset + g] << p) | idx)
+        ranks.append(r)
+        offset += sk.ngroups
+    return _hll_reduce(p, ngroups, np.concatenate(slots), np.concatenate(ranks))
+
+
+def hll_estimate(sketch: HLLSketch) -> np.ndarray:
+    """每组基数估计（小基数用线性计数修正）。"""
+    m = 1 << sketch.p
+    if sketch.slots is None:
+        regs = sketch.ranks
+        inv = np.exp2(-regs.astype(np.float64)).sum(axis=1)
+        zeros = (regs == 0).sum(axis=1)
+    else:
+        g = sketch.slots >> sketch.p
+        zeros = m - np.bincount(g, minlength=sketch.ngroups)  # 未出现的寄存器为 0，各贡献 2^0
+        inv = zeros + np.bincount(g, weights=np.exp2(-sketch.ranks.astype(np.float64)), minlength=sketch.ngroups)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / inv
+    est = np.where((raw <= 2.5 * m) & (zeros > 0), m * np.log(m / np.maximum(zeros, 1)), raw)
+    return np.rint(est).astype(np.int64)
+
+
+# ---- 分组归约（各度量的可合并中间量） ----
+type ReduceOp = _Literal["sum", "count", "min", "max", "nunique", "hll", "size"]
+
+
+@dataclass(slots=True, eq=False)
+class Reduction:
+    """一次分组归约：对 expr 的值做 op；expr=None 仅用于 size（组内行数）；arg 为 op 参数（hll 的 p）。"""
+    op: ReduceOp
+    expr: ScalarExpr | None = None
+    arg: Any = None
+
+    @property
+    def ident(self) -> tuple:
+        return (self.op, None if self.expr is None else self.expr.signature(), self.arg)
+
+
+def run_reductions(df: pd.DataFrame, key: GroupKey, reductions: list[Reduction],
+                   ctx: EvalContext | None = None) -> pd.DataFrame:
+    """在同一个 groupby 上一次性完成全部归约；第 i 列对应 reductions[i]，索引为组号。"""
+    ctx = ctx or EvalContext(df)
+    inputs: dict[tuple, str] = {}
+    cols: dict[str, pd.Series] = {}
+    for r in reductions:
+        if r.expr is not None and (sig := r.expr.signature()) not in inputs:
+            inputs[sig] = f"__in{len(inputs)}__"
+            cols[inputs[sig]] = ctx.eval(r.expr)
+
+    out: dict[int, pd.Series] = {}
+    if cols:
+        g = pd.DataFrame(cols, index=df.index).groupby(key.codes, sort=True)
+        named = {f"__r{i}__": (inputs[r.expr.signature()], r.op)
+                 for i, r in enumerate(reductions) if r.op in ("sum", "count", "min", "max")}
+        reduced = g.agg(**named) if named else None
+        for i, r in enumerate(reductions):
+            if r.op == "nunique":
+                out[i] = g[inputs[r.expr.signature()]].nunique(dropna=False)
+            elif r.op == "hll":
+                sketch = hll_sketch(key.codes, key.ngroups, _hash64(cols[inputs[r.expr.signature()]]), r.arg)
+                out[i] = pd.Series(hll_estimate(sketch))
+            elif r.op != "size":
+                out[i] = reduced[f"__r{i}__"]
+    if any(r.op == "size" for r in reductions):
+        size = key.size()
+        out.update({i: size for i, r in enumerate(reductions) if r.op == "size"})
+    return pd.DataFrame({i: out[i] for i in range(len(reductions))}, index=pd.RangeIndex(key.ngroups))
+
 
 # ---- 常用聚合表达式 ----
 class Sum(AggExpr[float]):
+    __match_args__ = ("expr",)
+
     def __init__(self, expr: ScalarExpr | str): self.expr = _resolve_scalar(expr)
 
     @override
-    def aggregate(self, df: pd.DataFrame, by: list[str]) -> pd.Series:
-        s = self.expr.eval(df)
-        key = make_group_key(df, by)
-        return s.groupby(key).sum()
+    def partials(self) -> list[Reduction]: return [Reduction("sum", self.expr)]
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series: return parts[0]
 
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
 
 class Count(AggExpr[int]):
+    __match_args__ = ("expr",)
+
     def __init__(self, expr: ScalarExpr | str | None = None):
         self.expr = _resolve_scalar(expr) if expr is not None else None
 
     @override
-    def aggregate(self, df: pd.DataFrame, by: list[str]) -> pd.Series:
-        key = make_group_key(df, by)
-        if self.expr is None:
-            return key.groupby(key).size()
-        s = self.expr.eval(df)
-        return s.groupby(key).count()
+    def partials(self) -> list[Reduction]:
+        return [Reduction("size")] if self.expr is None else [Reduction("count", self.expr)]
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series: return parts[0]
 
     def dependencies(self) -> set[str]: return set() if self.expr is None else self.expr.dependencies()
 
 
 class Avg(AggExpr[float]):
+    __match_args__ = ("expr",)
+
     def __init__(self, expr: ScalarExpr | str): self.expr = _resolve_scalar(expr)
 
     @override
-    def aggregate(self, df: pd.DataFrame, by: list[str]) -> pd.Series:
-        s = self.expr.eval(df)
-        key = make_group_key(df, by)
-        return s.groupby(key).mean()
+    def partials(self) -> list[Reduction]: return [Reduction("sum", self.expr), Reduction("count", self.expr)]
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series:
+        return parts[0] / parts[1].replace({0: np.nan})
 
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
 
 class Min(AggExpr[Any]):
+    __match_args__ = ("expr",)
+
     def __init__(self, expr: ScalarExpr | str): self.expr = _resolve_scalar(expr)
 
     @override
-    def aggregate(self, df: pd.DataFrame, by: list[str]) -> pd.Series:
-        s = self.expr.eval(df)
-        key = make_group_key(df, by)
-        return s.groupby(key).min()
+    def partials(self) -> list[Reduction]: return [Reduction("min", self.expr)]
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series: return parts[0]
 
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
 
 class Max(AggExpr[Any]):
+    __match_args__ = ("expr",)
+
     def __init__(self, expr: ScalarExpr | str): self.expr = _resolve_scalar(expr)
 
     @override
-    def aggregate(self, df: pd.DataFrame, by: list[str]) -> pd.Series:
-        s = self.expr.eval(df)
-        key = make_group_key(df, by)
-        return s.groupby(key).max()
+    def partials(self) -> list[Reduction]: return [Reduction("max", self.expr)]
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series: return parts[0]
 
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
 
 class NUnique(AggExpr[int]):
+    __match_args__ = ("expr",)
+
     def __init__(self, expr: ScalarExpr | str): self.expr = _resolve_scalar(expr)
 
     @override
-    def aggregate(self, df: pd.DataFrame, by: list[str]) -> pd.Series:
-        s = self.expr.eval(df)
-        key = make_group_key(df, by)
-        return s.groupby(key).nunique(dropna=False)
+    def partials(self) -> list[Reduction]: return [Reduction("nunique", self.expr)]
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series: return parts[0]
+
+    def dependencies(self) -> set[str]: return self.expr.dependencies()
+
+
+class ApproxNUnique(AggExpr[int]):
+    """HyperLogLog 近似去重计数；error 为目标相对标准误差（决定每组寄存器数 2^p，稀疏存储见 HLLSketch）。
+    SQL 引擎自带近似达不到 error 时生成精确 COUNT(DISTINCT)（见 SQLEmitter.agg_of_measure）。"""
+    __match_args__ = ("expr", "error")
+
+    def __init__(self, expr: ScalarExpr | str, error: float = 0.0163):
+        self.expr, self.error = _resolve_scalar(expr), error
+        self.precision = hll_precision(error)
+
+    @override
+    def partials(self) -> list[Reduction]: return [Reduction("hll", self.expr, self.precision)]
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series: return parts[0]
 
     def dependencies(self) -> set[str]: return self.expr.dependencies()
 
 
 class RatioOfSums(AggExpr[float]):
+    __match_args__ = ("num", "den", "fill")
+
     def __init__(self, numerator: ScalarExpr | str, denominator: ScalarExpr | str, fill: float = 0.0):
         self.num, self.den, self.fill = _resolve_scalar(numerator), _resolve_scalar(denominator), fill
 
     @override
-    def aggregate(self, df: pd.DataFrame, by: list[str]) -> pd.Series:
-        key = make_group_key(df, by)
-        n = self.num.eval(df).groupby(key).sum()
-        d = self.den.eval(df).groupby(key).sum().replace({0: np.nan})
-        return (n / d).fillna(self.fill)
+    def partials(self) -> list[Reduction]: return [Reduction("sum", self.num), Reduction("sum", self.den)]
+
+    @override
+    def finalize(self, parts: list[pd.Series]) -> pd.Series:
+        n, d = parts
+        return (n / d.replace({0: np.nan})).fillna(self.fill)
 
     def dependencies(self) -> set[str]: return self.num.dependencies() | self.den.dependencies()
 
 
+# ---- 窗口度量（聚合后，按分区内整数时间码排序） ----
+def _time_codes(values: pd.Series, grain: str | None) -> tuple[np.ndarray, np.ndarray]:
+    """时间维度取值 -> (连续整数周期码（相邻周期差 1，与 SQLEmitter.time_code 一致）, 非空掩码)。
+
+    空值（NaT/NA）行的码无意义（填 0），调用方须按掩码剔除，不能让它参与窗口。
+    """
+    if grain is None and pd.api.types.is_integer_dtype(values.dtype):
+        return values.to_numpy(dtype=np.int64, na_value=0), values.notna().to_numpy()
+    ts = pd.to_datetime(pd.Series(values).reset_index(drop=True), errors="coerce")
+    if getattr(ts.dt, "tz", None) is not None: ts = ts.dt.tz_localize(None)
+    valid = ts.notna().to_numpy()
+    ts = ts.where(valid, pd.Timestamp(0))
+    days = ts.to_numpy(dtype="datetime64[D]").astype(np.int64)
+    match grain:
+        case None | "day":
+            codes = days
+        case "week":
+            codes = (days + 3) // 7  # 1970-01-01 为周四；按周一起算
+        case "month":
+            codes = (ts.dt.year * 12 + ts.dt.month - 1).to_numpy(dtype=np.int64)
+        case "quarter":
+            codes = (ts.dt.year * 4 + ts.dt.quarter - 1).to_numpy(dtype=np.int64)
+        case "year":
+            codes = ts.dt.year.to_numpy(dtype=np.int64)
+        case other:
+            raise ValueError(f"Unsupported time_grain: {other}")
+    return codes, valid
+
+
+def _range_window(values: np.ndarray, part: np.ndarray, t: np.ndarray,
+                  lo: int | None, hi: int | None) -> tuple[np.ndarray, np.ndarray]:
+    """同分区内时间码落在 [t+lo, t+hi] 的行的 (非空值之和, 非空个数)；lo/hi 为 None 表示无界。
+
+    按 (分区, 时间码) 排序后拼成单调的复合键，窗口边界用 searchsorted 定位，再做前缀和差分。
+    """
+    n = len(values)
+    if not n: return np.zeros(0), np.zeros(0, dtype=np.int64)
+    order = np.lexsort((t, part))
+    p, tt, v = part[order], t[order], values[order]
+    pad = max(abs(lo or 0), abs(hi or 0)) + 1
+    base = tt - tt.min() + pad
+    span = int(base.max()) + pad + 1
+    key = p * span + base
+    key_lo = p * span if lo is None else key + lo
+    key_hi = p * span + span - 1 if hi is None else key + hi
+    left, right = np.searchsorted(key, key_lo, "left"), np.searchsorted(key, key_hi, "right")
+    ok = ~np.isnan(v)
+    cs = np.concatenate([[0.0], np.cumsum(np.where(ok, v, 0.0))])
+    cn = np.concatenate([[0], np.cumsum(ok)])
+    s, c = np.empty(n), np.empty(n, dtype=np.int64)
+    s[order], c[order] = cs[right] - cs[left], cn[right] - cn[left]
+    return s, c
+
+
+class WindowExpr[T](Expr[T]):
+    """聚合后的窗口度量：source 为同一报表里的聚合度量名；order_by 为时间维度名（缺省取报表中唯一的时间粒度维度）。
+
+    分区为除排序维度外的全部分组维度；窗口按整数时间码的 RANGE 计算，缺失的周期不补零。
+    """
+    __match_args__ = ("source", "order_by")
+
+    def __init__(self, source: str, order_by: str | None = None):
+        self.source, self.order_by = source, order_by
+
+    def compute(self, values: np.ndarray, part: np.ndarray, t: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+
+class RollingSum(WindowExpr[float]):
+    __match_args__ = ("source", "periods", "order_by")
+
+    def __init__(self, source: str, periods: int, order_by: str | None = None):
+        super().__init__(source, order_by)
+        self.periods = periods
+
+    @override
+    def compute(self, values: np.ndarray, part: np.ndarray, t: np.ndarray) -> np.ndarray:
+        s, c = _range_window(values, part, t, 1 - self.periods, 0)
+        return np.where(c > 0, s, np.nan)
+
+
+class RollingMean(RollingSum):
+    @override
+    def compute(self, values: np.ndarray, part: np.ndarray, t: np.ndarray) -> np.ndarray:
+        s, c = _range_window(values, part, t, 1 - self.periods, 0)
+        return np.where(c > 0, s / np.maximum(c, 1), np.nan)
+
+
+class CumSum(WindowExpr[float]):
+    @override
+    def compute(self, values: np.ndarray, part: np.ndarray, t: np.ndarray) -> np.ndarray:
+        s, c = _range_window(values, part, t, None, 0)
+        return np.where(c > 0, s, np.nan)
+
+
+class Lag(WindowExpr[float]):
+    """offset 个周期之前的值（该周期无数据时为空）。"""
+    __match_args__ = ("source", "offset", "order_by")
+
+    def __init__(self, source: str, offset: int = 1, order_by: str | None = None):
+        super().__init__(source, order_by)
+        self.offset = offset
+
+    @override
+    def compute(self, values: np.ndarray, part: np.ndarray, t: np.ndarray) -> np.ndarray:
+        s, c = _range_window(values, part, t, -self.offset, -self.offset)
+        return np.where(c > 0, s, np.nan)
+
+
+class Lead(Lag):
+    @override
+    def compute(self, values: np.ndarray, part: np.ndarray, t: np.ndarray) -> np.ndarray:
+        s, c = _range_window(values, part, t, self.offset, self.offset)
+        return np.where(c > 0, s, np.nan)
+
+
+class PeriodDelta(Lag):
+    """环比：当前值 - offset 个周期前的值；pct=True 时为 当前/之前 - 1（之前为 0 或空时为空）。"""
+    __match_args__ = ("source", "offset", "pct", "order_by")
+
+    def __init__(self, source: str, offset: int = 1, pct: bool = False, order_by: str | None = None):
+        super().__init__(source, offset, order_by)
+        self.pct = pct
+
+    @override
+    def compute(self, values: np.ndarray, part: np.ndarray, t: np.ndarray) -> np.ndarray:
+        prev = super().compute(values, part, t)
+        if not self.pct: return values - prev
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(prev == 0, np.nan, values / prev - 1)
+
+
 # ========= 5) 报表规范 =========
 @dataclass(slots=True)
 class SortBy:
@@ -599,6 +1547,7 @@ class ReportSpec:
     topn: int | None = None
     limit: int | None = None
     totals: bool = False
+    grouping: str | None = None  # "rollup" | "cube"：按行维度输出各级小计（分组集）
 
     # ---- 序列化 ----
     def to_dict(self) -> dict[str, Any]:
@@ -613,6 +1562,7 @@ class ReportSpec:
             "topn": self.topn,
             "limit": self.limit,
             "totals": self.totals,
+            "grouping": self.grouping,
         }
 
     @staticmethod
@@ -628,8 +1578,14 @@ class ReportSpec:
             topn=d.get("topn"),
             limit=d.get("limit"),
             totals=bool(d.get("totals", False)),
+            grouping=d.get("grouping"),
         )
 
+    def fingerprint(self) -> str:
+        """规范化 to_dict() 的结构哈希（键排序），用作结果缓存键。"""
+        canon = json.dumps(self.to_dict(), sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
 
 @dataclass(slots=True)
 class PivotResult:
@@ -641,6 +1597,12 @@ class PivotResult:
             raise ValueError("Multiple slices present; use frames[(...)] to select.")
         return next(iter(self.frames.values()))
 
+    def nbytes(self) -> int:
+        return int(sum(f.memory_usage(index=True, deep=True).sum() for f in self.frames.values()))
+
+    def copy(self) -> "PivotResult":
+        return PivotResult({k: f.copy() for k, f in self.frames.items()}, list(self.slicer_names))
+
 
 # ========= 6) SQL ⇄ 谓词：SQLTokenizer / SQLMiniParser / SQLEmitter / SQLPredicate / SQLBridge =========
 # ---- 6.1 SQLTokenizer ----
@@ -970,6 +1932,9 @@ class SQLMiniParser:
 
 
 # ---- 6.3 SQLEmitter：表达式/谓词/度量 -> 目标方言 SQL 片段 ----
+BIGQUERY_HLL_PRECISION = 15  # BigQuery APPROX_COUNT_DISTINCT 的 HLL++ 精度（相对标准误差约 0.57%）
+
+
 class SQLEmitter:
     def __init__(self, dialect: Dialect):
         self.dialect = dialect
@@ -1011,8 +1976,11 @@ class SQLEmitter:
                 n = self.scalar(numer, alias_map)
                 d = self.scalar(denom, alias_map)
                 if self.dialect is Dialect.BIGQUERY:
-                    return f"SAFE_DIVIDE(CAST({n} AS FLOAT64), CAST({d} AS FLOAT64))"
-                return f"(CAST({n} AS DOUBLE) / NULLIF(CAST({d} AS DOUBLE), 0))"
+                    ratio = f"SAFE_DIVIDE(CAST({n} AS FLOAT64), CAST({d} AS FLOAT64))"
+                else:
+                    ratio = f"(CAST({n} AS DOUBLE) / NULLIF(CAST({d} AS DOUBLE), 0))"
+                # 与 SafeDiv._eval 一致：分母为 0、任一侧缺失时取 fill
+                return ratio if fill is None or _is_missing(fill) else f"COALESCE({ratio}, {self.lit(fill)})"
             case Coalesce(exprs):
                 inner = ", ".join(self.scalar(x, alias_map) for x in exprs)
                 return f"COALESCE({inner})"
@@ -1079,6 +2047,56 @@ class SQLEmitter:
             case _:
                 raise NotImplementedError(f"Predicate to SQL not implemented for {type(p)}")
 
+    def time_code(self, expr: str, grain: str | None) -> str:
+        """时间表达式 -> 连续整数周期码（窗口 RANGE 的排序键），与 _time_codes 一致。"""
+        if self.dialect is Dialect.BIGQUERY:
+            days = f"UNIX_DATE(DATE({expr}))"
+            year, month, quarter = (f"EXTRACT({p} FROM {expr})" for p in ("YEAR", "MONTH", "QUARTER"))
+        elif self.dialect is Dialect.DUCKDB:
+            days = f"date_diff('day', DATE '1970-01-01', CAST({expr} AS DATE))"
+            year, month, quarter = f"year({expr})", f"month({expr})", f"quarter({expr})"
+        else:
+            raise NotImplementedError("Window time codes need DuckDB or BigQuery dialect")
+        match grain:
+            case None | "day":
+                return days
+            case "week":
+                return f"CAST(FLOOR(({days} + 3) / 7) AS {'INT64' if self.dialect is Dialect.BIGQUERY else 'BIGINT'})"
+            case "month":
+                return f"({year} * 12 + {month} - 1)"
+            case "quarter":
+                return f"({year} * 4 + {quarter} - 1)"
+            case "year":
+                return year
+            case other:
+                raise ValueError(f"Unsupported time_grain: {other}")
+
+    def window(self, w: WindowExpr, source: str, code: str, partition: list[str]) -> str:
+        """窗口度量 -> SQL 窗口函数（RANGE 帧按整数周期码；缺失周期不补零）。"""
+        head = f"PARTITION BY {', '.join(partition)} " if partition else ""
+
+        def over(frame: str) -> str: return f"OVER ({head}ORDER BY {code} RANGE BETWEEN {frame})"
+
+        match w:
+            case PeriodDelta(_, k, pct, _):
+                prev = f"MAX({source}) {over(f'{k} PRECEDING AND {k} PRECEDING')}"
+                if not pct: return f"({source} - {prev})"
+                if self.dialect is Dialect.BIGQUERY:
+                    return f"(SAFE_DIVIDE({source}, NULLIF({prev}, 0)) - 1)"
+                return f"({source} / NULLIF({prev}, 0) - 1)"
+            case Lead(_, k, _):
+                return f"MAX({source}) {over(f'{k} FOLLOWING AND {k} FOLLOWING')}"
+            case Lag(_, k, _):
+                return f"MAX({source}) {over(f'{k} PRECEDING AND {k} PRECEDING')}"
+            case RollingMean(_, n, _):
+                return f"AVG({source}) {over(f'{n - 1} PRECEDING AND CURRENT ROW')}"
+            case RollingSum(_, n, _):
+                return f"SUM({source}) {over(f'{n - 1} PRECEDING AND CURRENT ROW')}"
+            case CumSum():
+                return f"SUM({source}) {over('UNBOUNDED PRECEDING AND CURRENT ROW')}"
+            case _:
+                raise NotImplementedError(f"WindowExpr SQL not implemented: {type(w)}")
+
     def agg_of_measure(self, m: Measure) -> tuple[str, str]:
         if isinstance(m, AggMeasure):
             match m.expr:
@@ -1091,14 +2109,24 @@ class SQLEmitter:
                 case Max(expr):
                     return (f"MAX({self.scalar(expr)})", self.q(m.name))
                 case Count(expr):
-                    if expr.expr is None: return ("COUNT(*)", self.q(m.name))
-                    return (f"COUNT({self.scalar(expr.expr)})", self.q(m.name))
+                    if expr is None: return ("COUNT(*)", self.q(m.name))
+                    return (f"COUNT({self.scalar(expr)})", self.q(m.name))
                 case NUnique(expr):
                     return (f"COUNT(DISTINCT {self.scalar(expr)})", self.q(m.name))
-                case RatioOfSums(num, den, _fill):
+                case ApproxNUnique(expr, _error):
+                    # 只在引擎自带近似能满足 error 时用它：BigQuery 的 APPROX_COUNT_DISTINCT 是 p=15 的 HLL++；
+                    # DuckDB 的 approx_count_distinct 没有误差保证（实测可偏差近一半），与 ANSI 一样退化为精确计数
+                    if self.dialect is Dialect.BIGQUERY and m.expr.precision <= BIGQUERY_HLL_PRECISION:
+                        return (f"APPROX_COUNT_DISTINCT({self.scalar(expr)})", self.q(m.name))
+                    return (f"COUNT(DISTINCT {self.scalar(expr)})", self.q(m.name))
+                case RatioOfSums(num, den, fill):
                     if self.dialect is Dialect.BIGQUERY:
-                        return (f"SAFE_DIVIDE(SUM({self.scalar(num)}), SUM({self.scalar(den)}))", self.q(m.name))
-                    return (f"(SUM({self.scalar(num)}) / NULLIF(SUM({self.scalar(den)}), 0))", self.q(m.name))
+                        ratio = f"SAFE_DIVIDE(SUM({self.scalar(num)}), SUM({self.scalar(den)}))"
+                    else:
+                        ratio = f"(SUM({self.scalar(num)}) / NULLIF(SUM({self.scalar(den)}), 0))"
+                    # 与 RatioOfSums.finalize 一致：分母为 0 / 缺失时取 fill
+                    if fill is not None and not _is_missing(fill): ratio = f"COALESCE({ratio}, {self.lit(fill)})"
+                    return (ratio, self.q(m.name))
                 case _:
                     raise NotImplementedError(f"AggExpr SQL not implemented: {type(m.expr)}")
         elif isinstance(m, RowMeasure):
@@ -1144,8 +2172,12 @@ class SQLPredicate(PredicateExpr):
         return self._inner
 
     @override
-    def eval(self, df: pd.DataFrame) -> pd.Series:
-        return self.as_inner().eval(df)
+    def _eval(self, ctx: EvalContext) -> pd.Series:
+        return ctx.eval(self.as_inner())
+
+    @override
+    def signature(self) -> tuple:
+        return self.as_inner().signature()
 
     @override
     def dependencies(self) -> set[str]:
@@ -1183,68 +2215,653 @@ class SQLBridge:
 
 
 # ========= 7) Planner & Engine（Pandas/DuckDB/BigQuery） =========
-class Dataset:
-    """本地数据集（Pandas DataFrame）。外部引擎（DuckDB/BigQuery）可忽略其中 df。"""
+def dictionary_encode(df: pd.DataFrame, columns: Sequence[str] | None = None, *,
+                      max_ratio: float = 0.05) -> pd.DataFrame:
+    """把低基数字符串列转为有序分类（字典编码）。
 
-    def __init__(self, df: pd.DataFrame): self.df = df
+    columns=None 时自动挑选：字符串列且 distinct/行数 <= max_ratio。分类按取值排序，
+    因此比较/排序语义与原字符串一致；算术（BinaryOp）、字典外取值比较与 Coalesce 填充前先解码回原取值。
+    返回浅拷贝，不改动传入的帧。
+    """
+    n = len(df)
+    if columns is None:
+        columns = [c for c in df.columns
+                   if not isinstance(df[c].dtype, pd.CategoricalDtype)
+                   and pd.api.types.infer_dtype(df[c], skipna=True) == "string"
+                   and df[c].nunique(dropna=True) <= max(max_ratio * n, 1)]
+    if not columns: return df
+    out = df.copy(deep=False)
+    for c in columns:
+        out[c] = out[c].astype("category").cat.as_ordered()
+    return out
 
-    def report(self, spec: ReportSpec, engine: "Engine" | None = None) -> PivotResult:
+
+class ResultCache:
+    """PivotResult 的 LRU 缓存；容量按结果帧占用字节数计。存入与取出都复制帧，调用方修改结果不会污染缓存。"""
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[PivotResult, int]] = OrderedDict()
+
+    def get(self, key: tuple) -> PivotResult | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0].copy()
+
+    def put(self, key: tuple, result: PivotResult) -> None:
+        size = result.nbytes()
+        if size > self.max_bytes: return
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        self._entries[key] = (result.copy(), size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __len__(self) -> int: return len(self._entries)
+
+
+def _frame_token(df: pd.DataFrame) -> tuple:
+    """df 的廉价身份：形状、列名与各列缓冲地址（ndarray 底的列取数据指针，其余扩展数组取对象身份）。"""
+    bufs = []
+    for _, s in df.items():
+        arr = s.array  # numpy/日期/时长/分类列每次取出的是新包装，须看底层 ndarray
+        nd = getattr(arr, "_ndarray", None)
+        bufs.append(id(arr) if nd is None else nd.__array_interface__["data"][0])
+    return df.shape, tuple(df.columns), tuple(bufs)
+
+
+def _concat_rows(base: pd.DataFrame, rows: pd.DataFrame) -> pd.DataFrame:
+    # 已字典编码的列：按并集字典重新编码后再拼接，保持分类类型
+    base, rows = base.copy(deep=False), rows.copy(deep=False)
+    for c in base.columns:
+        if c in rows.columns and isinstance(base[c].dtype, pd.CategoricalDtype):
+            cats = base[c].cat.categories.union(pd.Index(rows[c].dropna().unique()))
+            base[c] = base[c].cat.set_categories(cats)
+            rows[c] = rows[c].astype(base[c].dtype)
+    return pd.concat([base, rows], axis=0, ignore_index=isinstance(base.index, pd.RangeIndex))
+
+
+def _as_arrow(data: Any) -> Any:
+    """pyarrow Table / RecordBatch / RecordBatchReader / record batch 序列 -> pyarrow.Table（不复制列缓冲）。"""
+    try:
+        import pyarrow as pa  # type: ignore
+    except Exception as e:
+        raise RuntimeError("请先 `pip install pyarrow` 再使用 Arrow 数据集") from e
+    if isinstance(data, pa.Table): return data
+    if isinstance(data, pa.RecordBatch): return pa.Table.from_batches([data])
+    if isinstance(data, pa.RecordBatchReader): return data.read_all()
+    return pa.Table.from_batches(list(data))
+
+
+# ---- EXPLAIN：计划树 + ANALYZE 分阶段计量（耗时 / 行数 / 峰值分配字节） ----
+@dataclass(slots=True, eq=False)
+class PlanNode:
+    """EXPLAIN 计划树节点。detail 为静态信息（列、SQL、融合归约…）；analyze 后填入实测指标。
+
+    同一父节点下同名阶段多次执行（逐块、逐切片）时合并计量：calls 计次，时间与行数累加，峰值取最大。
+    """
+    op: str
+    detail: dict[str, Any] = dc_field(default_factory=dict)
+    children: list["PlanNode"] = dc_field(default_factory=list)
+    calls: int = 0
+    seconds: float | None = None
+    rows_in: int | None = None
+    rows_out: int | None = None
+    peak_bytes: int | None = None
+
+    def child(self, op: str) -> "PlanNode":
+        for c in self.children:
+            if c.op == op: return c
+        node = PlanNode(op)
+        self.children.append(node)
+        return node
+
+    def find(self, op: str) -> "PlanNode | None":
+        if self.op == op: return self
+        return next((hit for c in self.children if (hit := c.find(op)) is not None), None)
+
+    def to_dict(self) -> dict[str, Any]:
+        out: dict[str, Any] = {"op": self.op, "detail": self.detail}
+        if self.calls:
+            out.update(calls=self.calls, seconds=self.seconds, rows_in=self.rows_in, rows_out=self.rows_out,
+                       peak_bytes=self.peak_bytes)
+        out["children"] = [c.to_dict() for c in self.children]
+        return out
+
+    def render(self, depth: int = 0) -> str:
+        text = "  " * depth + ("-> " if depth else "") + self.op
+        if self.detail: text += " " + " ".join(f"{k}={v}" for k, v in self.detail.items())
+        if self.calls:
+            stats = [f"time={self.seconds * 1e3:.2f}ms"]
+            if self.calls > 1: stats.append(f"calls={self.calls}")
+            if self.rows_in is not None or self.rows_out is not None:
+                stats.append(f"rows={'?' if self.rows_in is None else self.rows_in}->"
+                             f"{'?' if self.rows_out is None else self.rows_out}")
+            if self.peak_bytes is not None: stats.append(f"peak={self.peak_bytes / 2 ** 20:.2f}MiB")
+            text += "  (" + " ".join(stats) + ")"
+        return "\n".join([text, *(c.render(depth + 1) for c in self.children)])
+
+    def __str__(self) -> str: return self.render()
+
+
+class _Profiler:
+    """ANALYZE 期间的阶段栈；峰值用 tracemalloc 逐阶段重置，子阶段的峰值向上合并给祖先。"""
+
+    def __init__(self, root: PlanNode, memory: bool):
+        self.memory = memory
+        self.frames: list[list[Any]] = []  # [node, t0, 起始已分配, 区间内峰值]
+        self.enter(root)
+
+    def _traced(self) -> tuple[int, int]:
+        return tracemalloc.get_traced_memory() if self.memory else (0, 0)
+
+    def enter(self, node: PlanNode) -> None:
+        cur, peak = self._traced()
+        for f in self.frames: f[3] = max(f[3], peak)
+        if self.memory: tracemalloc.reset_peak()
+        self.frames.append([node, time.perf_counter(), cur, cur])
+
+    def exit(self, rows_in: int | None, rows_out: int | None) -> None:
+        node, t0, cur0, peak = self.frames.pop()
+        elapsed = time.perf_counter() - t0
+        peak = max(peak, self._traced()[1])
+        for f in self.frames: f[3] = max(f[3], peak)
+        node.calls += 1
+        node.seconds = (node.seconds or 0.0) + elapsed
+        if rows_in is not None: node.rows_in = (node.rows_in or 0) + rows_in
+        if rows_out is not None: node.rows_out = (node.rows_out or 0) + rows_out
+        if self.memory: node.peak_bytes = max(node.peak_bytes or 0, peak - cur0)
+
+    @property
+    def current(self) -> PlanNode: return self.frames[-1][0]
+
+
+_PROFILER: ContextVar[_Profiler | None] = ContextVar("report_profiler", default=None)
+
+
+class _Stage:
+    """执行阶段的计量点：`with _Stage("filter", len(src)) as st: ...; st.rows_out = ...`；未在 ANALYZE 中时只是空操作。"""
+    __slots__ = ("op", "rows_in", "rows_out", "_prof")
+
+    def __init__(self, op: str, rows_in: int | None = None):
+        self.op, self.rows_in, self.rows_out = op, rows_in, None
+
+    def __enter__(self) -> "_Stage":
+        self._prof = _PROFILER.get()
+        if self._prof is not None: self._prof.enter(self._prof.current.child(self.op))
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if self._prof is not None: self._prof.exit(self.rows_in, self.rows_out)
+
+
+def _source_rows(src: Any) -> int | None:
+    """DataFrame / Arrow 表的行数；流式来源（scanner）未知时为 None。"""
+    if isinstance(src, pd.DataFrame): return len(src)
+    return getattr(src, "num_rows", None)
+
+
+def _dataset_rows(dataset: Any) -> int | None:
+    """本地数据集的行数（不触发 Arrow -> pandas 转换）；分块数据集未知。"""
+    df = getattr(dataset, "_df", None)
+    return _source_rows(df if df is not None else getattr(dataset, "_arrow", None))
+
+
+def _expr_text(e: Any) -> str:
+    """计划树里的表达式文本：能转成 ANSI SQL 的用 SQL，否则用 repr。"""
+    em = SQLEmitter(Dialect.ANSI)
+    try:
+        if isinstance(e, PredicateExpr): return em.predicate(e)
+        if isinstance(e, ScalarExpr): return em.scalar(e)
+    except Exception:
+        pass
+    return repr(e)
+
+
+def _pandas_plan(dataset: Any, spec: ReportSpec, plan: Plan, engine: "Engine") -> PlanNode:
+    """Pandas 系引擎的静态计划：列裁剪 -> WHERE -> 时间粒度 -> 组号 -> 融合归约（或立方体上卷）-> 收尾。"""
+    root = PlanNode("report", {"engine": type(engine).__name__})
+    agg_plan = plan.agg_plan or fuse_measures(_report_metrics(spec))
+    if plan.cube is not None:
+        root.children.append(PlanNode("cube", {"dims": plan.cube.group_keys, "groups": plan.cube.state.ngroups}))
+        return _finish_plan(root, spec)
+    scan: dict[str, Any] = {"columns": plan.columns or required_columns(spec)}
+    if (rows := _dataset_rows(dataset)) is not None: scan["rows"] = rows
+    root.children.append(PlanNode("scan", scan))
+    if (where := ensure_predicate(spec.where)) is not None:
+        detail: dict[str, Any] = {"where": _expr_text(where)}
+        if (index := getattr(dataset, "indexes", None)) is not None:
+            detail["indexes"] = {c: type(i).__name__ for c, i in index.by_column.items()}
+        root.children.append(PlanNode("filter", detail))
+    if grains := [d.materialized_name() for d in [*spec.rows, *spec.columns, *spec.slicers] if d.time_grain]:
+        root.children.append(PlanNode("materialize", {"time_grains": grains}))
+    root.children.append(PlanNode("group_key", {"keys": plan.group_keys}))
+    root.children.append(PlanNode("aggregate", {
+        "reductions": [r.op if r.expr is None else f"{r.op}({_expr_text(r.expr)})" for r in agg_plan.reductions],
+        "measures": dict(agg_plan.slots)}))
+    return _finish_plan(root, spec)
+
+
+def _finish_plan(root: PlanNode, spec: ReportSpec) -> PlanNode:
+    """聚合之后的公共收尾：HAVING -> 分组集上卷（只上卷存活明细）-> 窗口 -> 透视/排序/截断（与 _finish_state 一致）。"""
+    if (having := ensure_predicate(spec.having)) is not None:
+        root.children.append(PlanNode("having", {"having": _expr_text(having)}))
+    if sets := _grouping_sets(spec):
+        root.children.append(PlanNode("rollup", {"sets": sets}))
+    if windows := [m.name for m in spec.metrics if isinstance(m, WindowMeasure)]:
+        root.children.append(PlanNode("window", {"measures": windows}))
+    root.children.append(_pivot_node(spec))
+    return root
+
+
+def _pivot_node(spec: ReportSpec) -> PlanNode:
+    row_names, col_names, slicer_names = _group_names(spec)
+    pivot = {"rows": row_names, "columns": col_names, "slicers": slicer_names,
+             "sort_by": [s.name for s in spec.sort_by], "topn": spec.topn, "limit": spec.limit}
+    return PlanNode("pivot", {k: v for k, v in pivot.items() if v not in (None, [])})
+
+
+def explain_report(dataset: Any, spec: ReportSpec, engine: "Engine", analyze: bool = False, *,
+                   memory: bool = True) -> PlanNode:
+    """EXPLAIN：引擎给出的计划树；analyze=True 时实际执行（不走结果缓存），逐阶段填入耗时、行数与峰值分配。
+
+    memory=False 时不开 tracemalloc（分配追踪本身有开销，耗时更接近真实执行）。
+    """
+    plan = Planner(engine).compile(dataset, spec)
+    root = engine.explain(dataset, spec, plan)
+    if not analyze: return root
+    started = memory and not tracemalloc.is_tracing()
+    if started: tracemalloc.start()
+    prof = _Profiler(root, memory)
+    token = _PROFILER.set(prof)
+    try:
+        result = plan.cube.answer(spec) if plan.cube is not None else engine.execute(dataset, spec, plan)
+    finally:
+        _PROFILER.reset(token)
+        prof.exit(None, None)
+        if started: tracemalloc.stop()
+    root.rows_in = _dataset_rows(dataset)
+    root.rows_out = sum(len(f) for f in result.frames.values())
+    return root
+
+
+class Dataset:
+    """本地数据集（Pandas DataFrame 或 Arrow 表）。外部引擎（BigQuery）可忽略其中 df。
+
+    传入 pyarrow Table / record batches 时以 Arrow 为底：DuckDBEngine 直接零拷贝扫描 Arrow 列、
+    以 Arrow 取回聚合结果，原始数据不经过 pandas；本地 Pandas 引擎首次访问 df 时才整体转换一次。
+
+    encode=True 时在构建时把低基数字符串列（Campaign/Device/Country 等）字典编码为分类列；
+    也可直接传列名列表。谓词在字典上求值后按码映射，分组/透视/DuckDB 注册直接使用码。
+
+    report(spec, AutoEngine()) 按代价估计自动选择引擎（选择记录见 AutoEngine.decisions）。
+
+    report() 结果按 (ReportSpec 指纹, 引擎标识, 数据版本) 缓存；替换 df、append() 会递增版本并清空缓存。
+    report()/report_many()/explain()/append() 前会比对 df 的形状、列名与列缓冲（_frame_token），
+    增删行列、整列赋值自动视同 invalidate()；pandas Copy-on-Write 下（pandas 3 默认）loc/iloc 原地改值
+    也会换新缓冲而被发现。未开启 Copy-on-Write 时原地改值请手动调用 invalidate()。
+    缓存存取都复制结果帧，修改返回的 PivotResult 不影响之后的命中。
+
+    materialize(spec) 返回增量维护的报表：append() 只聚合新行并合并进各物化报表的分组状态；
+    替换 df 或 invalidate() 时物化报表与立方体从整帧重建。
+    create_index(column, kind) 登记列索引；数据变化后在下一次过滤时重建。
+    """
+
+    def __init__(self, df: pd.DataFrame | Any, *, encode: bool | Sequence[str] = False, max_ratio: float = 0.05,
+                 cache_bytes: int | None = 256 * 2 ** 20):
+        self._arrow = None if isinstance(df, pd.DataFrame) else _as_arrow(df)
+        self._encode = (encode, max_ratio)
+        if self._arrow is not None:
+            df = None  # 按需转换
+        elif encode:
+            df = dictionary_encode(df, None if encode is True else list(encode), max_ratio=max_ratio)
+        self._df = df
+        self.version = 0
+        self.cache = ResultCache(cache_bytes) if cache_bytes else None
+        self.materialized: list[MaterializedReport] = []
+        self.cubes: list[Cube] = []
+        self._index_specs: dict[str, tuple[str, int]] = {}
+        self._index: DataIndex | None = None
+        self._seen: tuple[pd.DataFrame, tuple] | None = None
+        self._snapshot()
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if self._df is None:
+            encode, max_ratio = self._encode
+            df = self._arrow.to_pandas()
+            if encode: df = dictionary_encode(df, None if encode is True else list(encode), max_ratio=max_ratio)
+            self._df = df
+            self._snapshot()
+        return self._df
+
+    @df.setter
+    def df(self, value: pd.DataFrame) -> None:
+        self._df, self._arrow = value, None
+        self.invalidate()
+
+    @property
+    def arrow(self) -> Any | None:
+        """Arrow 底表（pyarrow.Table）；以 DataFrame 构建或被替换/追加后为 None。"""
+        return self._arrow
+
+    def invalidate(self) -> None:
+        self._bump()
+        for mr in [*self.materialized, *self.cubes]:
+            mr.refresh(self.df)  # 旧状态不再对应当前数据，不能在其上合并
+
+    def _bump(self) -> None:
+        self.version += 1
+        self._index = None  # 索引按新数据惰性重建
+        if self.cache is not None: self.cache.clear()
+        self._snapshot()
+
+    def _snapshot(self) -> None:
+        # 浅拷贝持有当前列缓冲：Copy-on-Write 下对 df 的原地写因此会换新缓冲，_frame_token 随之变化
+        self._seen = None if self._df is None else (self._df.copy(deep=False), _frame_token(self._df))
+
+    def _check_mutation(self) -> None:
+        """df 自上次版本后被原地修改时视同 invalidate()。"""
+        if self._seen is not None and _frame_token(self._df) != self._seen[1]:
+            self.invalidate()
+
+    def create_index(self, column: str, kind: str = "auto", *, block_rows: int = 65_536) -> None:
+        """登记列索引供 PandasEngine 的 WHERE 跳读：zonemap / bitmap / sorted / auto（见 DataIndex）。"""
+        if kind not in ("auto", "zonemap", "bitmap", "sorted"):
+            raise ValueError(f"Unknown index kind: {kind}")
+        self._index_specs[column] = (kind, block_rows)
+        self._index = None
+
+    @property
+    def indexes(self) -> DataIndex | None:
+        if not self._index_specs: return None
+        if self._index is None: self._index = DataIndex(self.df, self._index_specs)
+        return self._index
+
+    def append(self, rows: pd.DataFrame) -> None:
+        self._check_mutation()  # 物化状态须先对应当前数据，才能只合并新行
+        self._df, self._arrow = _concat_rows(self.df, rows), None
+        self._bump()
+        if self.materialized or self.cubes:
+            tail = self._df.iloc[len(self._df) - len(rows):]  # 与存量同一编码的新行
+            for mr in [*self.materialized, *self.cubes]:
+                mr.update(tail)
+
+    def materialize(self, spec: ReportSpec) -> "MaterializedReport":
+        self._check_mutation()
+        mr = MaterializedReport(self, spec)
+        self.materialized.append(mr)
+        return mr
+
+    def add_cube(self, dims: list[Dimension], measures: list[Measure],
+                 where: PredicateExpr | str | None = None) -> "Cube":
+        """登记预聚合立方体；本地引擎的 report()/report_many() 命中时直接上卷立方体作答。"""
+        self._check_mutation()
+        cube = Cube(self, dims, measures, where)
+        self.cubes.append(cube)
+        return cube
+
+    def _cache_key(self, spec: ReportSpec, engine: "Engine") -> tuple | None:
+        if self.cache is None or not engine.cacheable: return None
+        try:
+            return (spec.fingerprint(), engine.identity(), self.version)
+        except TypeError:
+            return None  # 含不可序列化的自定义表达式：不缓存
+
+    def report(self, spec: ReportSpec, engine: "Engine" | None = None) -> PivotResult:
+        engine = engine or PandasEngine()
+        self._check_mutation()
+        key = self._cache_key(spec, engine)
+        if key is not None and (hit := self.cache.get(key)) is not None:
+            return hit
+        result = Planner(engine).run(self, spec)
+        if key is not None: self.cache.put(key, result)
+        return result
+
+    def explain(self, spec: ReportSpec, engine: "Engine" | None = None, analyze: bool = False, *,
+                memory: bool = True) -> PlanNode:
+        """报表的执行计划（EXPLAIN）；analyze=True 时执行并附上各阶段耗时/行数/峰值分配字节（EXPLAIN ANALYZE）。"""
+        self._check_mutation()
+        return explain_report(self, spec, engine or PandasEngine(), analyze, memory=memory)
+
+    def report_many(self, specs: Sequence[ReportSpec], engine: "Engine" | None = None) -> list[PivotResult]:
+        """批量出报表（仪表盘刷新）：WHERE 相同的报表共用一次过滤、时间粒度与行级度量，
+        并从最细公共分组上卷出各自的粒度。结果与逐个 report() 相同，也走同一个结果缓存。
+        非 PandasEngine 时退化为逐个 report()。
+        """
         engine = engine or PandasEngine()
-        planner = Planner(engine)
-        return planner.run(self, spec)
+        if type(engine) is not PandasEngine:
+            return [self.report(s, engine) for s in specs]
+        self._check_mutation()
+        results: list[PivotResult | None] = [None] * len(specs)
+        keys = [self._cache_key(s, engine) for s in specs]
+        batches: dict[tuple | None, list[int]] = {}
+        for i, (spec, key) in enumerate(zip(specs, keys)):
+            if key is not None and (hit := self.cache.get(key)) is not None:
+                results[i] = hit
+                continue
+            if (cube := _pick_cube(self, spec)) is not None:
+                results[i] = cube.answer(spec)
+                if key is not None: self.cache.put(key, results[i])
+                continue
+            where_pred = ensure_predicate(spec.where)
+            batches.setdefault(None if where_pred is None else where_pred.signature(), []).append(i)
+        for idx in batches.values():
+            for i, result in zip(idx, report_shared(self.df, [specs[i] for i in idx], index=self.indexes)):
+                results[i] = result
+                if keys[i] is not None: self.cache.put(keys[i], result)
+        return results
+
+
+@dataclass(slots=True)
+class AggPlan:
+    """融合后的聚合计划：去重后的归约列表 + 每个度量取用哪些归约（下标）。"""
+    reductions: list[Reduction]
+    slots: dict[str, list[int]]
+
+    def finalize(self, metrics: list[Measure], reduced: pd.DataFrame) -> list[pd.Series]:
+        out: list[pd.Series] = []
+        for m in metrics:
+            s = m.finalize([reduced[i] for i in self.slots[m.name]])
+            s.name = m.name
+            out.append(s)
+        return out
+
+
+def fuse_measures(metrics: list[Measure]) -> AggPlan:
+    """收集全部度量的归约并去重（如 Sum(clicks) 与 RatioOfSums(clicks, impr) 共用 sum(clicks)）。"""
+    reductions: list[Reduction] = []
+    index: dict[tuple, int] = {}
+    slots: dict[str, list[int]] = {}
+    for m in metrics:
+        if not isinstance(m, (AggMeasure, RowMeasure)):
+            raise TypeError(f"Unknown measure type: {type(m)}")
+        pos: list[int] = []
+        for r in m.partials():
+            if r.ident not in index:
+                index[r.ident] = len(reductions)
+                reductions.append(r)
+            pos.append(index[r.ident])
+        slots[m.name] = pos
+    return AggPlan(reductions, slots)
 
 
 @dataclass(slots=True)
 class Plan:
     group_keys: list[str]
     metric_names: list[str]
+    agg_plan: AggPlan | None = None
+    columns: list[str] = dc_field(default_factory=list)  # 报表实际用到的原始列（列裁剪）
+    cube: "Cube | None" = None  # 可由预聚合立方体上卷作答时，不再交给引擎扫描原始行
+
+
+def required_columns(spec: ReportSpec) -> list[str]:
+    """维度 + WHERE + 度量依赖的原始列；HAVING 作用于聚合结果，不占原始列。"""
+    need: dict[str, None] = {}
+    for dim in [*spec.rows, *spec.columns, *spec.slicers]:
+        need[dim.name] = None
+    where_pred = ensure_predicate(spec.where)
+    if where_pred is not None:
+        need.update(dict.fromkeys(sorted(where_pred.dependencies())))
+    for m in spec.metrics:
+        need.update(dict.fromkeys(sorted(m.dependencies())))
+    return list(need)
+
+
+def _materialize_dims(df: pd.DataFrame, dims: list[Dimension]) -> pd.DataFrame:
+    """在（已裁剪的）帧上补出时间粒度列；浅拷贝避免回写调用方的帧。"""
+    pending = [d for d in dims if d.materialized_name() not in df.columns]
+    if not pending: return df
+    df = df.copy(deep=False)
+    for dim in pending:
+        name, series = dim.materialize(df)
+        if name not in df.columns: df[name] = series
+    return df
 
 
 class Engine:
+    # 结果只取决于 (spec, dataset.df) 时才可缓存；远端表（BigQuery）不走本地版本号
+    cacheable: bool = True
+    # 本地 Pandas 系引擎：Planner 可改由 dataset 上的 Cube 作答
+    cube_routing: bool = False
+
     def execute(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PivotResult:
         raise NotImplementedError
 
+    def explain(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PlanNode:
+        """静态计划树（不执行）；默认按本地 Pandas 管线描述。"""
+        return _pandas_plan(dataset, spec, plan, self)
+
+    def identity(self) -> tuple:
+        """引擎标识（参与结果缓存键）。"""
+        return (type(self).__qualname__,)
+
 
 class Planner:
     def __init__(self, engine: Engine):
         self.engine = engine
 
     def compile(self, dataset: Dataset, spec: ReportSpec) -> Plan:
-        df = dataset.df
-        keys: list[str] = []
-
-        # 本地引擎（Pandas/DuckDB）时物化列；BigQuery 仅取“物化名”
-        local = isinstance(self.engine, (PandasEngine, DuckDBEngine))
-        for dim in [*spec.rows, *spec.columns, *spec.slicers]:
-            if local:
-                name, series = dim.materialize(df)
-                if name not in df.columns: df[name] = series
-                keys.append(name)
-            else:
-                keys.append(dim.materialized_name())
+        # 只记录物化名；时间粒度列由本地引擎在裁剪/过滤后的帧上物化，不再写回 dataset.df
+        keys = [dim.materialized_name() for dim in [*spec.rows, *spec.columns, *spec.slicers]]
         metric_names = [m.name for m in spec.metrics]
-        return Plan(group_keys=keys, metric_names=metric_names)
+        cube = _pick_cube(dataset, spec) if self.engine.cube_routing else None
+        return Plan(group_keys=keys, metric_names=metric_names, agg_plan=fuse_measures(_report_metrics(spec)),
+                    columns=required_columns(spec), cube=cube)
 
     def run(self, dataset: Dataset, spec: ReportSpec) -> PivotResult:
         plan = self.compile(dataset, spec)
+        if plan.cube is not None:
+            return plan.cube.answer(spec)
         return self.engine.execute(dataset, spec, plan)
 
 
 # ---- 7.1 公共排序/总计/透视 ----
-def _with_totals(df_slice: pd.DataFrame, totals: bool) -> pd.DataFrame:
-    if not totals: return df_slice
-    total = pd.DataFrame(df_slice.sum(numeric_only=True)).T
-    total.index = ["__TOTAL__"]
-    return pd.concat([df_slice, total], axis=0)
+TOTAL_LABEL = "__TOTAL__"
+GROUPING_COL = "__grouping__"
 
 
-def _sort_limit(df_slice: pd.DataFrame, spec: ReportSpec) -> pd.DataFrame:
-    has_totals_row = "__TOTAL__" in df_slice.index
-    if has_totals_row:
-        totals = df_slice.loc[["__TOTAL__"]]
-        data = df_slice.drop(index="__TOTAL__")
+def _grouping_sets(spec: ReportSpec) -> list[list[str]]:
+    """除明细外还要输出的行维度分组（被上卷的行维度取 TOTAL_LABEL）；列/切片维度始终参与分组。
+
+    rollup：逐级去掉末尾行维度直到总计；cube：行维度的全部真子集；totals=True 至少包含总计 ()。
+    无行维度时为空（totals 的总计行由 _pivot_frames 逐列求和追加）。
+    """
+    row_names = [d.materialized_name() for d in spec.rows]
+    if not row_names: return []
+    match spec.grouping:
+        case None:
+            sets = []
+        case "rollup":
+            sets = [row_names[:k] for k in range(len(row_names) - 1, -1, -1)]
+        case "cube":
+            sets = [[row_names[i] for i in idx] for k in range(len(row_names) - 1, -1, -1)
+                    for idx in itertools.combinations(range(len(row_names)), k)]
+        case other:
+            raise ValueError(f"Unsupported grouping: {other}")
+    if spec.totals and [] not in sets: sets.append([])
+    return sets
+
+
+def _grouping_id(row_names: list[str], kept: list[str]) -> int:
+    # 与 SQL GROUPING(r1, r2, ...) 相同：被上卷的维度对应位为 1，首个维度为最高位
+    return sum(1 << (len(row_names) - 1 - i) for i, r in enumerate(row_names) if r not in kept)
+
+
+def _split_grouping(grouped: pd.DataFrame, row_names: list[str]) -> tuple[pd.DataFrame, pd.DataFrame | None]:
+    """SQL 分组集结果 -> (明细, 小计)；小计里被上卷的维度（NULL）改写为 TOTAL_LABEL。"""
+    if GROUPING_COL not in grouped.columns: return grouped, None
+    gid = grouped[GROUPING_COL].to_numpy(dtype=np.int64)
+    detail = grouped[gid == 0].drop(columns=GROUPING_COL)
+    subs = grouped[gid != 0].copy()
+    for i, r in enumerate(row_names):
+        rolled = (subs[GROUPING_COL].to_numpy(dtype=np.int64) >> (len(row_names) - 1 - i)) & 1 == 1
+        subs[r] = subs[r].astype(object).where(~rolled, TOTAL_LABEL)
+    return detail, subs
+
+
+def _grouping_sql(em: SQLEmitter, key_sql: Mapping[str, str], row_names: list[str], other_names: list[str],
+                  spec: ReportSpec) -> tuple[str, str]:
+    """分组集下推 -> (GROUP BY 子句, GROUPING 位掩码表达式)；DuckDB / BigQuery 通用。"""
+    sets = _grouping_sets(spec)
+    rows_sql = ", ".join(key_sql[r] for r in row_names)
+    if not other_names and spec.grouping in ("rollup", "cube") and ([] in sets or spec.grouping == "cube"):
+        clause = f" GROUP BY {spec.grouping.upper()} ({rows_sql})"
     else:
-        data = df_slice
+        full = [row_names + other_names] + [kept + other_names for kept in sets]
+        clause = " GROUP BY GROUPING SETS (" + ", ".join(
+            "(" + ", ".join(key_sql[k] for k in g) + ")" for g in full) + ")"
+    gid = " + ".join(f"GROUPING({key_sql[r]}) * {1 << (len(row_names) - 1 - i)}" for i, r in enumerate(row_names))
+    return clause, f"({gid})"
+
+
+def _having_source_sql(em: SQLEmitter, source: str, where_sql: str | None, key_sql: Mapping[str, str],
+                       group_keys: list[str], having_sql: str) -> tuple[str, str]:
+    """分组集 + HAVING -> (WITH 前缀, FROM 子句)：CTE 先按 HAVING 筛出存活的明细组，外层只聚合这些组的行，
+    小计/总计因此只由存活明细上卷（与本地引擎一致）。外层分组键直接引用 CTE 中的物化列名。"""
+    derived = "".join(f", {expr} AS {em.q(k)}" for k, expr in key_sql.items() if expr != em.q(k))
+    base = f"SELECT *{derived} FROM {source}" + (f" WHERE {where_sql}" if where_sql else "")
+    kept = ", ".join(f"{em.q(k)} AS {em.q(f'__kept{i}__')}" for i, k in enumerate(group_keys))
+    positions = ", ".join(str(i + 1) for i in range(len(group_keys)))
+    on = " AND ".join(f"b.{em.q(k)} IS NOT DISTINCT FROM k.{em.q(f'__kept{i}__')}" for i, k in enumerate(group_keys))
+    prefix = (f"WITH b AS ({base}), "
+              f"k AS (SELECT {kept} FROM b GROUP BY {positions} HAVING {having_sql}) ")
+    return prefix, f"b JOIN k ON {on}"
+
+
+def _window_query(em: SQLEmitter, spec: ReportSpec, inner: str, grouping: bool) -> str:
+    """聚合查询外包一层窗口函数；有分组集时按 GROUPING 位掩码分区，且只对明细行取值。
+
+    时间键为空的组与本地引擎一致取空值（NULL 在 RANGE 窗口里自成一组，不计算）。
+    """
+    windows = [m for m in spec.metrics if isinstance(m, WindowMeasure)]
+    if not windows: return inner
+    keys = sum(_group_names(spec), [])
+    cols: list[str] = []
+    for m in windows:
+        order_name, grain = _window_order(spec, m.expr)
+        partition = [em.q(k) for k in keys if k != order_name] + ([em.q(GROUPING_COL)] if grouping else [])
+        w = em.window(m.expr, em.q(m.expr.source), em.time_code(em.q(order_name), grain), partition)
+        cond = [f"{em.q(order_name)} IS NOT NULL"] + ([f"{em.q(GROUPING_COL)} = 0"] if grouping else [])
+        w = f"CASE WHEN {' AND '.join(cond)} THEN {w} END"
+        cols.append(f"{w} AS {em.q(m.name)}")
+    return f"SELECT *, {', '.join(cols)} FROM ({inner}) AS g"
+
+
+def _sort_limit(df_slice: pd.DataFrame, spec: ReportSpec) -> pd.DataFrame:
+    data = df_slice
     by: list[str] = []
     asc: list[bool] = []
     for s in spec.sort_by:
@@ -1255,8 +2872,6 @@ def _sort_limit(df_slice: pd.DataFrame, spec: ReportSpec) -> pd.DataFrame:
         data = data.sort_values(by=by, ascending=asc, kind="mergesort")
     if spec.topn is not None:  data = data.head(spec.topn)
     if spec.limit is not None: data = data.head(spec.limit)
-    if has_totals_row:
-        data = pd.concat([data, totals], axis=0)
     return data
 
 
@@ -1267,21 +2882,15 @@ def ensure_predicate(clause: PredicateExpr | str | None, dialect: Dialect = Dial
     raise TypeError(f"Unsupported where/having type: {type(clause)}")
 
 
-def _pivot_frames(grouped_df: pd.DataFrame,
-                  row_names: list[str],
-                  col_names: list[str],
-                  slicer_names: list[str],
-                  metrics: list[str] | None,
-                  spec: ReportSpec) -> dict[tuple, pd.DataFrame]:
-    """统一透视/切片/排序，供各引擎复用。"""
-    metrics = metrics or ["rows"]
+def _pivot_slices(grouped_df: pd.DataFrame, row_names: list[str], col_names: list[str],
+                  slicer_names: list[str], metrics: list[str]) -> dict[tuple, pd.DataFrame]:
     if col_names:
         pivoted = grouped_df.pivot_table(
             index=row_names + slicer_names,
             columns=col_names,
             values=metrics,
             aggfunc="first",
-            observed=False
+            observed=True
         )
         pivoted.columns = _flatten_multi_columns(pivoted.columns.to_flat_index())
         pivoted = pivoted.sort_index(axis=1)
@@ -1291,91 +2900,215 @@ def _pivot_frames(grouped_df: pd.DataFrame,
     frames: dict[tuple, pd.DataFrame] = {}
     if slicer_names:
         reset = pivoted.reset_index()
-        for keys, sub in reset.groupby(slicer_names, dropna=False, sort=False):
+        for keys, sub in reset.groupby(slicer_names, dropna=False, sort=False, observed=True):
             if not isinstance(keys, tuple): keys = (keys,)
-            slice_df = sub.drop(columns=slicer_names).set_index(row_names)
-            frames[keys] = _sort_limit(_with_totals(slice_df, spec.totals), spec)
+            frames[keys] = sub.drop(columns=slicer_names).set_index(row_names)
     else:
-        df2 = pivoted if isinstance(pivoted, pd.DataFrame) else pivoted.to_frame()
-        frames[()] = _sort_limit(_with_totals(df2, spec.totals), spec)
+        frames[()] = pivoted if isinstance(pivoted, pd.DataFrame) else pivoted.to_frame()
     return frames
 
 
-# ---- 7.2 PandasEngine ----
-class PandasEngine(Engine):
-    @override
-    def execute(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PivotResult:
-        df = dataset.df.copy()
+def _pivot_frames(grouped_df: pd.DataFrame,
+                  row_names: list[str],
+                  col_names: list[str],
+                  slicer_names: list[str],
+                  metrics: list[str] | None,
+                  spec: ReportSpec,
+                  subtotals: pd.DataFrame | None = None) -> dict[tuple, pd.DataFrame]:
+    """统一透视/切片/排序，供各引擎复用。
 
-        # WHERE
-        where_pred = ensure_predicate(spec.where)
-        if where_pred is not None:
-            df = df[where_pred.eval(df)]
+    subtotals 为分组集的小计/总计行（含 GROUPING_COL）：按层级透视后追加在排序/截断后的明细之后，
+    列限定为明细帧的列。无行维度时 totals 沿用逐列求和的总计行。
+    """
+    metrics = metrics or ["rows"]
+    frames = _pivot_slices(grouped_df, row_names, col_names, slicer_names, metrics)
+    extra: dict[tuple, list[pd.DataFrame]] = {}
+    if subtotals is not None and len(subtotals):
+        for _, level in subtotals.groupby(GROUPING_COL, sort=True):
+            level = level.drop(columns=GROUPING_COL).sort_values(row_names, kind="mergesort")  # SQL 结果无序
+            for keys, f in _pivot_slices(level, row_names, col_names, slicer_names, metrics).items():
+                extra.setdefault(keys, []).append(f)
+    out: dict[tuple, pd.DataFrame] = {}
+    for keys in dict.fromkeys([*frames, *extra]):
+        detail = frames.get(keys)
+        data = None
+        if detail is not None:
+            with _Stage("sort_limit", len(detail)) as st:
+                data = _sort_limit(detail, spec)
+                st.rows_out = len(data)
+        subs = extra.get(keys, [])
+        if detail is not None:
+            subs = [f.reindex(columns=detail.columns) for f in subs]
+            if spec.totals and not row_names:
+                total = pd.DataFrame(detail.sum(numeric_only=True)).T
+                total.index = [TOTAL_LABEL]
+                subs.append(total)
+        parts = [f for f in [data, *subs] if f is not None]
+        out[keys] = pd.concat(parts, axis=0) if len(parts) > 1 else parts[0]
+    return out
 
-        # materialized keys（Planner 已加过）
-        row_names = [d.materialized_name() for d in spec.rows]
-        col_names = [d.materialized_name() for d in spec.columns]
-        slicer_names = [d.materialized_name() for d in spec.slicers]
-        group_keys = row_names + col_names + slicer_names
 
-        # 行级度量
-        for m in spec.metrics:
-            if isinstance(m, RowMeasure):
-                df[f"__row_{m.name}__"] = m.expr.eval(df)
-
-        key = make_group_key(df, group_keys) if group_keys else pd.Series([0] * len(df), index=df.index)
-
-        # 聚合
-        series_list: list[pd.Series] = []
-        for m in spec.metrics:
-            if isinstance(m, AggMeasure):
-                s = m.expr.aggregate(df, group_keys)
-                s.name = m.name
-                series_list.append(s)
-            elif isinstance(m, RowMeasure):
-                tmp = df[f"__row_{m.name}__"]
-                match m.agg:
-                    case "sum":
-                        s = tmp.groupby(key).sum()
-                    case "mean":
-                        s = tmp.groupby(key).mean()
-                    case "min":
-                        s = tmp.groupby(key).min()
-                    case "max":
-                        s = tmp.groupby(key).max()
-                    case "count":
-                        s = tmp.groupby(key).count()
-                    case "nunique":
-                        s = tmp.groupby(key).nunique(dropna=False)
-                    case other:
-                        raise ValueError(f"Unsupported RowAgg: {other}")
-                s.name = m.name
-                series_list.append(s)
-            else:
-                raise TypeError(f"Unknown measure type: {type(m)}")
+# ---- 7.2 PandasEngine ----
+def _report_metrics(spec: ReportSpec) -> list[Measure]:
+    # 参与分组聚合的度量（窗口度量在聚合后计算）；无度量时按组计行数（列名 rows）
+    return [m for m in spec.metrics if not isinstance(m, WindowMeasure)] or [AggMeasure("rows", Count())]
+
+
+def _output_names(spec: ReportSpec) -> list[str]:
+    return [m.name for m in spec.metrics] or ["rows"]
 
-        if not series_list:
-            s = key.groupby(key).size()
-            s.name = "rows"
-            series_list.append(s)
 
-        grouped_df = pd.concat(series_list, axis=1)
+def _window_order(spec: ReportSpec, w: WindowExpr) -> tuple[str, str | None]:
+    """窗口排序维度 -> (物化列名, 规范化粒度)。"""
+    dims = [*spec.rows, *spec.columns, *spec.slicers]
+    if w.order_by is not None:
+        cands = [d for d in dims if w.order_by in (d.name, d.materialized_name())]
+    else:
+        cands = [d for d in dims if d.time_grain]
+    if len(cands) != 1:
+        raise ValueError(f"Window order_by must name exactly one report dimension (got {w.order_by!r})")
+    return cands[0].materialized_name(), _grain(cands[0])
+
+
+def _apply_windows(grouped_df: pd.DataFrame, spec: ReportSpec) -> pd.DataFrame:
+    """在聚合结果上计算窗口度量；分区为除排序维度外的全部分组维度。"""
+    windows = [m for m in spec.metrics if isinstance(m, WindowMeasure)]
+    if not windows: return grouped_df
+    grouped_df = grouped_df.copy(deep=False)
+    keys = sum(_group_names(spec), [])
+    for m in windows:
+        order_name, grain = _window_order(spec, m.expr)
+        others = [k for k in keys if k != order_name]
+        part = make_group_key(grouped_df, others).codes if others else np.zeros(len(grouped_df), dtype=np.int64)
+        t, valid = _time_codes(grouped_df[order_name], grain)
+        values = grouped_df[m.expr.source].to_numpy(dtype=np.float64, na_value=np.nan)
+        out = np.full(len(grouped_df), np.nan)
+        out[valid] = m.expr.compute(values[valid], part[valid], t[valid])  # 时间键为空的组不参与窗口，取值为空
+        grouped_df[m.name] = out
+    return grouped_df
+
+
+def _group_names(spec: ReportSpec) -> tuple[list[str], list[str], list[str]]:
+    return ([d.materialized_name() for d in spec.rows],
+            [d.materialized_name() for d in spec.columns],
+            [d.materialized_name() for d in spec.slicers])
+
+
+def _prepare_frame(src: pd.DataFrame, spec: ReportSpec, columns: list[str],
+                   index: DataIndex | None = None) -> pd.DataFrame:
+    """WHERE 先行：按选择向量逐项收窄，之后只搬运存活行 × 所需列，再物化时间粒度。"""
+    where_pred = ensure_predicate(spec.where)
+    if where_pred is not None:
+        with _Stage("filter", len(src)) as st:
+            df = take_rows(src, filter_positions(where_pred, src, index=index), columns)
+            st.rows_out = len(df)
+    else:
+        df = src[columns]
+    dims = [*spec.rows, *spec.columns, *spec.slicers]
+    if not any(d.time_grain for d in dims): return df
+    with _Stage("materialize", len(df)) as st:
+        df = _materialize_dims(df, dims)
+        st.rows_out = len(df)
+    return df
+
+
+def _pivot_grouped(grouped: pd.DataFrame, spec: ReportSpec) -> PivotResult:
+    """SQL 引擎取回的聚合结果（可含 GROUPING_COL）-> 透视/切片/排序。"""
+    row_names, col_names, slicer_names = _group_names(spec)
+    with _Stage("pivot", len(grouped)) as st:
+        detail, subtotals = _split_grouping(grouped, row_names)
+        frames = _pivot_frames(detail, row_names, col_names, slicer_names, _output_names(spec), spec, subtotals)
+        st.rows_out = sum(len(f) for f in frames.values())
+    return PivotResult(frames=frames, slicer_names=slicer_names)
+
+
+def _having_mask(grouped_df: pd.DataFrame, spec: ReportSpec) -> np.ndarray | None:
+    """HAVING 在明细聚合结果上的保留掩码；无 HAVING 时为 None。"""
+    having_pred = ensure_predicate(spec.having)
+    if having_pred is None: return None
+    with _Stage("having", len(grouped_df)) as st:
+        keep = having_pred.eval(grouped_df).to_numpy(dtype=bool, na_value=False)
+        st.rows_out = int(keep.sum())
+    return keep
+
+
+def _finish_report(grouped_df: pd.DataFrame, spec: ReportSpec, subtotals: pd.DataFrame | None = None, *,
+                   having: bool = True) -> PivotResult:
+    """HAVING（聚合后，只作用于明细；having=False 表示调用方已过滤）+ 透视/切片/排序。"""
+    keep = _having_mask(grouped_df, spec) if having else None
+    if keep is not None: grouped_df = grouped_df[keep]
+    if any(isinstance(m, WindowMeasure) for m in spec.metrics):
+        with _Stage("window", len(grouped_df)) as st:
+            grouped_df = _apply_windows(grouped_df, spec)  # 与 SQL 一致：窗口在 HAVING 之后
+            st.rows_out = len(grouped_df)
+    row_names, col_names, slicer_names = _group_names(spec)
+    metrics = _output_names(spec)
+    if subtotals is not None:
+        subtotals = subtotals.reindex(columns=list(dict.fromkeys([*subtotals.columns, *metrics])))  # 小计行无窗口值
+    with _Stage("pivot", len(grouped_df) + (0 if subtotals is None else len(subtotals))) as st:
+        frames = _pivot_frames(grouped_df, row_names, col_names, slicer_names, metrics, spec, subtotals)
+        st.rows_out = sum(len(f) for f in frames.values())
+    return PivotResult(frames=frames, slicer_names=slicer_names)
+
+
+def _finish_state(state: AggState, spec: ReportSpec, metrics: list[Measure], agg_plan: AggPlan) -> PivotResult:
+    """由明细粒度的可合并状态出报表：各级小计/总计都从状态上卷（比值、均值、去重按分子分母/集合合并）。
+
+    小计/总计只上卷通过 HAVING 的明细组，与报表中显示的明细一致。
+    """
+    grouped_df = state.finalize(metrics, agg_plan)
+    sets = _grouping_sets(spec)
+    if not sets: return _finish_report(grouped_df, spec)
+    keep = _having_mask(grouped_df, spec)
+    if keep is not None:
+        pos = np.flatnonzero(keep)
+        grouped_df, state = grouped_df.iloc[pos], state.take(pos)
+    row_names, col_names, slicer_names = _group_names(spec)
+    levels: list[pd.DataFrame] = []
+    with _Stage("rollup", state.ngroups) as st:
+        for kept in sets:
+            sub = state.rollup(kept + col_names + slicer_names, agg_plan.reductions).finalize(metrics, agg_plan)
+            for r in row_names:
+                if r not in kept: sub[r] = TOTAL_LABEL
+            sub[GROUPING_COL] = _grouping_id(row_names, kept)
+            levels.append(sub)
+        st.rows_out = sum(len(x) for x in levels)
+    return _finish_report(grouped_df, spec, pd.concat(levels, ignore_index=True), having=False)
+
+
+def _aggregate_frame(df: pd.DataFrame, group_keys: list[str], metrics: list[Measure], agg_plan: AggPlan,
+                     ctx: EvalContext | None = None) -> pd.DataFrame:
+    # 整数组号：所有度量共享同一个 key
+    with _Stage("group_key", len(df)) as st:
+        key = make_group_key(df, group_keys)
+        st.rows_out = key.ngroups
+
+    # 聚合：全部度量的归约融合成一次 groupby，再逐个度量收尾（比值等）
+    with _Stage("aggregate", len(df)) as st:
+        reduced = run_reductions(df, key, agg_plan.reductions, ctx or EvalContext(df))
+        grouped_df = pd.concat(agg_plan.finalize(metrics, reduced), axis=1)
 
         if group_keys:
-            gk_df = df[group_keys].copy()
-            gk_df["__k__"] = key.values
-            gk_df = gk_df.drop_duplicates("__k__").set_index("__k__")
-            grouped_df = gk_df.join(grouped_df, how="right")
+            # 组号 -> 维度取值（解码表只有 ngroups 行）
+            grouped_df = key.uniques.join(grouped_df, how="right")
+        st.rows_out = len(grouped_df)
+    return grouped_df
 
-        # HAVING（聚合后）
-        having_pred = ensure_predicate(spec.having)
-        if having_pred is not None:
-            grouped_df = grouped_df[having_pred.eval(grouped_df)]
 
-        # 透视/切片/排序（统一）
-        metrics = [m.name for m in spec.metrics] or ["rows"]
-        frames = _pivot_frames(grouped_df, row_names, col_names, slicer_names, metrics, spec)
-        return PivotResult(frames=frames, slicer_names=slicer_names)
+class PandasEngine(Engine):
+    cube_routing = True
+
+    @override
+    def execute(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PivotResult:
+        df = _prepare_frame(dataset.df, spec, plan.columns or required_columns(spec), dataset.indexes)
+        row_names, col_names, slicer_names = _group_names(spec)
+        group_keys = row_names + col_names + slicer_names
+        metrics = _report_metrics(spec)
+        agg_plan = plan.agg_plan or fuse_measures(metrics)
+        if _grouping_sets(spec):
+            # 小计/总计需要可合并状态：一次聚合，各级从状态上卷
+            return _finish_state(AggState.build(df, group_keys, agg_plan.reductions), spec, metrics, agg_plan)
+        return _finish_report(_aggregate_frame(df, group_keys, metrics, agg_plan), spec)
 
 
 # ---- 7.3 DuckDBEngine（把聚合下推给 DuckDB；透视/切片/排序仍在本地） ----
@@ -1384,14 +3117,38 @@ class DuckDBEngine(Engine):
         self.db_path = db_path
 
     @override
-    def execute(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PivotResult:
-        try:
-            import duckdb  # type: ignore
-        except Exception as e:
-            raise RuntimeError("请先 `pip install duckdb` 再使用 DuckDBEngine") from e
+    def identity(self) -> tuple: return (type(self).__qualname__, self.db_path)
+
+    @staticmethod
+    def _dim_sql(em: SQLEmitter, dim: Dimension) -> str:
+        # Arrow 底表：时间粒度在 SQL 中截断（与 Dimension.materialize 同为周一起始的周）
+        if not dim.time_grain: return em.q(dim.name)
+        g = _GRAIN_ALIASES.get(dim.time_grain.lower(), dim.time_grain.lower())
+        if g not in ("day", "week", "month", "quarter", "year"):
+            raise ValueError(f"Unsupported time_grain: {dim.time_grain}")
+        return f"CAST(date_trunc('{g}', TRY_CAST({em.q(dim.name)} AS TIMESTAMP)) AS TIMESTAMP)"
 
-        df = dataset.df.copy()
+    @staticmethod
+    def _arrow_backed(dataset: Dataset | ParquetDataset) -> bool:
+        return isinstance(dataset, ParquetDataset) or dataset.arrow is not None
+
+    def _source(self, dataset: Dataset | ParquetDataset, spec: ReportSpec, columns: list[str]) -> Any:
+        """注册给 DuckDB 的数据：只含报表用到的列（WHERE 仍下推给 DuckDB）。"""
+        if isinstance(dataset, ParquetDataset):
+            return dataset.scanner(columns, spec.where)  # 分区/行组裁剪后由 DuckDB 流式扫描
+        if dataset.arrow is not None:
+            return dataset.arrow.select(columns)  # 列投影零拷贝
+        return _materialize_dims(dataset.df[columns], [*spec.rows, *spec.columns, *spec.slicers])
+
+    def build_sql(self, dataset: Dataset | ParquetDataset, spec: ReportSpec) -> str:
+        """报表对应的 DuckDB 查询（数据源注册名为 df）。"""
+        dims = [*spec.rows, *spec.columns, *spec.slicers]
         em = SQLEmitter(Dialect.DUCKDB)
+        if self._arrow_backed(dataset):
+            # 时间粒度在 SQL 中物化，原始数据不转 pandas
+            key_sql = {d.materialized_name(): self._dim_sql(em, d) for d in dims}
+        else:
+            key_sql = {d.materialized_name(): em.q(d.materialized_name()) for d in dims}
 
         # WHERE
         where_pred = ensure_predicate(spec.where, dialect=Dialect.DUCKDB)
@@ -1403,33 +3160,80 @@ class DuckDBEngine(Engine):
         slicer_names = [d.materialized_name() for d in spec.slicers]
         group_keys = row_names + col_names + slicer_names
 
-        select_keys_exprs = ", ".join(em.q(k) for k in group_keys) if group_keys else ""
-        agg_cols = [em.agg_of_measure(m) for m in spec.metrics] or [("COUNT(*)", em.q("rows"))]
-        alias_map = {m.name: sql for m, (sql, _alias) in zip(spec.metrics, agg_cols)}
+        agg_measures = [m for m in spec.metrics if not isinstance(m, WindowMeasure)]
+        agg_cols = [em.agg_of_measure(m) for m in agg_measures] or [("COUNT(*)", em.q("rows"))]
+        alias_map = {m.name: sql for m, (sql, _alias) in zip(agg_measures, agg_cols)}
+
+        # HAVING（支持别名）；有分组集时先在 CTE 中筛出存活明细组，小计/总计只由它们上卷
+        having_pred = ensure_predicate(spec.having, dialect=Dialect.DUCKDB)
+        having_sql = em.predicate(having_pred, alias_map=alias_map) if having_pred is not None else None
+        grouping = bool(_grouping_sets(spec))
+        prefix, source = "", "df"
+        if grouping and having_sql:
+            prefix, source = _having_source_sql(em, source, where_sql, key_sql, group_keys, having_sql)
+            key_sql = {k: em.q(k) for k in group_keys}
+            where_sql = having_sql = None
+
+        select_keys_exprs = ", ".join(key_sql[k] if key_sql[k] == em.q(k) else f"{key_sql[k]} AS {em.q(k)}"
+                                      for k in group_keys)
         select_aggs = ", ".join(f"{expr} AS {alias}" for expr, alias in agg_cols)
         select_list = f"{select_keys_exprs}, {select_aggs}" if select_keys_exprs else select_aggs
         group_by = f" GROUP BY {', '.join(str(i + 1) for i, _ in enumerate(group_keys))}" if group_keys else ""
+        if grouping:
+            # 小计/总计下推为 ROLLUP / CUBE / GROUPING SETS，一条查询出全部层级
+            group_by, gid_sql = _grouping_sql(em, key_sql, row_names,
+                                              col_names + slicer_names, spec)
+            select_list += f", {gid_sql} AS {em.q(GROUPING_COL)}"
 
-        sql = f"SELECT {select_list} FROM df"
+        sql = f"{prefix}SELECT {select_list} FROM {source}"
         if where_sql: sql += f" WHERE {where_sql}"
         sql += group_by
+        if having_sql: sql += f" HAVING {having_sql}"
+        return _window_query(em, spec, sql, grouping)
 
-        # HAVING（支持别名）
-        having_pred = ensure_predicate(spec.having, dialect=Dialect.DUCKDB)
-        if having_pred is not None:
-            sql += f" HAVING {em.predicate(having_pred, alias_map=alias_map)}"
+    @override
+    def execute(self, dataset: Dataset | ParquetDataset, spec: ReportSpec, plan: Plan) -> PivotResult:
+        try:
+            import duckdb  # type: ignore
+        except Exception as e:
+            raise RuntimeError("请先 `pip install duckdb` 再使用 DuckDBEngine") from e
 
+        sql = self.build_sql(dataset, spec)
+        arrow = self._arrow_backed(dataset)
+        with _Stage("scan") as st:
+            df = self._source(dataset, spec, plan.columns or required_columns(spec))
+            st.rows_out = _source_rows(df)
         con = duckdb.connect(self.db_path) if self.db_path else duckdb.connect()
         try:
-            con.register("df", df)
-            grouped = con.sql(sql).df()
+            with _Stage("sql", st.rows_out) as st:
+                con.register("df", df)
+                rel = con.sql(sql)
+                # 整数 SUM 在 DuckDB 中是 HUGEINT（取回成 float / Decimal）：转回 BIGINT，与 pandas 的 int64 一致
+                if "HUGEINT" in map(str, rel.types):
+                    em = SQLEmitter(Dialect.DUCKDB)
+                    rel = rel.project(", ".join(f"CAST({em.q(c)} AS BIGINT) AS {em.q(c)}" if str(t) == "HUGEINT"
+                                                else em.q(c) for c, t in zip(rel.columns, rel.types)))
+                # Arrow 底表以 Arrow 取回，只把（小的）聚合结果转成 pandas
+                grouped = rel.fetch_arrow_table().to_pandas() if arrow else rel.df()
+                st.rows_out = len(grouped)
         finally:
             con.close()
 
         # 透视/切片/排序（统一）
-        metrics = [m.name for m in spec.metrics] or ["rows"]
-        frames = _pivot_frames(grouped, row_names, col_names, slicer_names, metrics, spec)
-        return PivotResult(frames=frames, slicer_names=slicer_names)
+        return _pivot_grouped(grouped, spec)
+
+    @override
+    def explain(self, dataset: Dataset | ParquetDataset, spec: ReportSpec, plan: Plan) -> PlanNode:
+        columns = plan.columns or required_columns(spec)
+        if isinstance(dataset, ParquetDataset):
+            scan: dict[str, Any] = {"source": "parquet", "path": dataset.path, "columns": columns}
+            if (expr := dataset.pruning_filter(spec.where)) is not None: scan["pruning"] = str(expr)
+        else:
+            scan = {"source": "arrow" if dataset.arrow is not None else "pandas", "columns": columns}
+        root = PlanNode("report", {"engine": type(self).__name__})
+        root.children += [PlanNode("scan", scan), PlanNode("sql", {"sql": self.build_sql(dataset, spec)})]
+        root.children.append(_pivot_node(spec))
+        return root
 
 
 # ---- 7.4 BigQueryEngine（聚合下推到 BigQuery；透视等在本地） ----
@@ -1450,6 +3254,11 @@ class BigQueryEngine(Engine):
         self.credentials = credentials
         self.location = location
 
+    cacheable = False
+
+    @override
+    def identity(self) -> tuple: return (type(self).__qualname__, self._full_table_id(), self.location)
+
     def _full_table_id(self) -> str:
         return f"{self.project}.{self.dataset}.{self.table}"
 
@@ -1471,40 +3280,57 @@ class BigQueryEngine(Engine):
         expr = f"DATE_TRUNC(DATE({col}), {grain_map[g]})"
         return (expr, em.q(dim.materialized_name()))
 
-    @override
-    def execute(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PivotResult:
-        try:
-            from google.cloud import bigquery  # type: ignore
-        except Exception as e:
-            raise RuntimeError("请先 `pip install google-cloud-bigquery` 并配置凭据后使用 BigQueryEngine") from e
-
+    def build_sql(self, spec: ReportSpec) -> str:
+        """报表对应的 BigQuery 查询。"""
         em = SQLEmitter(Dialect.BIGQUERY)
 
         # WHERE
         where_pred = ensure_predicate(spec.where, dialect=Dialect.BIGQUERY)
         where_sql = em.predicate(where_pred) if where_pred is not None else None
 
-        # 分组键：为每个维度生成 SQL 表达式 + 别名
-        row_dims = [self._dim_sql(em, d) for d in spec.rows]
-        col_dims = [self._dim_sql(em, d) for d in spec.columns]
-        slicer_dims = [self._dim_sql(em, d) for d in spec.slicers]
-        group_dims = row_dims + col_dims + slicer_dims
+        # 分组键：为每个维度生成 SQL 表达式（物化名为别名）
+        dims = [*spec.rows, *spec.columns, *spec.slicers]
+        group_keys = [d.materialized_name() for d in dims]
+        key_sql = {d.materialized_name(): self._dim_sql(em, d)[0] for d in dims}
+
+        agg_measures = [m for m in spec.metrics if not isinstance(m, WindowMeasure)]
+        agg_cols = [em.agg_of_measure(m) for m in agg_measures] or [("COUNT(*)", em.q("rows"))]
+        alias_map = {m.name: sql for m, (sql, _alias) in zip(agg_measures, agg_cols)}
 
-        select_keys_exprs = ", ".join(f"{expr} AS {alias}" for (expr, alias) in group_dims) if group_dims else ""
-        agg_cols = [em.agg_of_measure(m) for m in spec.metrics] or [("COUNT(*)", em.q("rows"))]
-        alias_map = {m.name: sql for m, (sql, _alias) in zip(spec.metrics, agg_cols)}
+        # HAVING（支持别名映射为真实聚合式）；有分组集时先在 CTE 中筛出存活明细组，小计/总计只由它们上卷
+        having_pred = ensure_predicate(spec.having, dialect=Dialect.BIGQUERY)
+        having_sql = em.predicate(having_pred, alias_map=alias_map) if having_pred is not None else None
+        grouping = bool(_grouping_sets(spec))
+        prefix, source = "", f"`{self._full_table_id()}`"
+        if grouping and having_sql:
+            prefix, source = _having_source_sql(em, source, where_sql, key_sql, group_keys, having_sql)
+            key_sql = {k: em.q(k) for k in group_keys}
+            where_sql = having_sql = None
+
+        select_keys_exprs = ", ".join(f"{key_sql[k]} AS {em.q(k)}" for k in group_keys)
         select_aggs = ", ".join(f"{expr} AS {alias}" for expr, alias in agg_cols)
         select_list = f"{select_keys_exprs}, {select_aggs}" if select_keys_exprs else select_aggs
-        group_by = f" GROUP BY {', '.join(str(i + 1) for i, _ in enumerate(group_dims))}" if group_dims else ""
+        group_by = f" GROUP BY {', '.join(str(i + 1) for i, _ in enumerate(group_keys))}" if group_keys else ""
+        if grouping:
+            # 小计/总计：ROLLUP / CUBE / GROUPING SETS，GROUPING() 用与分组相同的表达式
+            group_by, gid_sql = _grouping_sql(em, key_sql, [d.materialized_name() for d in spec.rows],
+                                              [d.materialized_name() for d in [*spec.columns, *spec.slicers]], spec)
+            select_list += f", {gid_sql} AS {em.q(GROUPING_COL)}"
 
-        sql = f"SELECT {select_list} FROM `{self._full_table_id()}`"
+        sql = f"{prefix}SELECT {select_list} FROM {source}"
         if where_sql: sql += f" WHERE {where_sql}"
         sql += group_by
+        if having_sql: sql += f" HAVING {having_sql}"
+        return _window_query(em, spec, sql, grouping)
 
-        # HAVING（支持别名映射为真实聚合式）
-        having_pred = ensure_predicate(spec.having, dialect=Dialect.BIGQUERY)
-        if having_pred is not None:
-            sql += f" HAVING {em.predicate(having_pred, alias_map=alias_map)}"
+    @override
+    def execute(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PivotResult:
+        try:
+            from google.cloud import bigquery  # type: ignore
+        except Exception as e:
+            raise RuntimeError("请先 `pip install google-cloud-bigquery` 并配置凭据后使用 BigQueryEngine") from e
+
+        sql = self.build_sql(spec)
 
         # 执行
         client_kwargs = {"project": self.project}
@@ -1512,17 +3338,1369 @@ class BigQueryEngine(Engine):
         if self.credentials is not None:
             client_kwargs["credentials"] = self.credentials
         client = bigquery.Client(**client_kwargs)
-        job = client.query(sql)
-        grouped = job.result().to_dataframe(create_bqstorage_client=True)
+        with _Stage("sql") as st:
+            job = client.query(sql)
+            grouped = job.result().to_dataframe(create_bqstorage_client=True)
+            st.rows_out = len(grouped)
 
         # 透视/切片/排序（统一）
-        row_names = [d.materialized_name() for d in spec.rows]
-        col_names = [d.materialized_name() for d in spec.columns]
-        slicer_names = [d.materialized_name() for d in spec.slicers]
-        metrics = [m.name for m in spec.metrics] or ["rows"]
+        return _pivot_grouped(grouped, spec)
+
+    @override
+    def explain(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PlanNode:
+        root = PlanNode("report", {"engine": type(self).__name__, "table": self._full_table_id()})
+        root.children += [PlanNode("sql", {"sql": self.build_sql(spec)}), _pivot_node(spec)]
+        return root
+
+
+# ---- 7.5 可合并分组状态（增量追加 / 物化报表） ----
+NUNIQUE_EXACT_LIMIT = 2_000_000  # 精确去重状态允许的 (组, 值) 对总数，超出改用 HLL 草图
+
+
+def _null_to_none(values: Any) -> np.ndarray:
+    arr = np.asarray(values, dtype=object)
+    arr[pd.isna(arr)] = None  # NaN 互不相等，统一成 None 才能放进 set 里去重
+    return arr
+
+
+def _distinct_state(values: pd.Series, codes: np.ndarray, ngroups: int) -> pd.Series | HLLSketch:
+    """nunique 的可合并状态：(组, 值) 对不多时为每组 frozenset，否则为 HLL 草图。"""
+    vcodes, vuniq = pd.factorize(values, use_na_sentinel=False)
+    width = len(vuniq) + 1
+    pairs = pd.unique(np.asarray(codes, dtype=np.int64) * width + vcodes)
+    if len(pairs) > NUNIQUE_EXACT_LIMIT:
+        return hll_sketch(codes, ngroups, _hash64(values))
+    g, v = pairs // width, pairs % width
+    order = np.argsort(g, kind="stable")
+    bounds = np.cumsum(np.bincount(g, minlength=ngroups))
+    objs = _null_to_none(vuniq)[v[order]]
+    sets = [frozenset(objs[a:b]) for a, b in zip(np.r_[0, bounds[:-1]], bounds)]
+    return pd.Series(sets, dtype=object)
+
+
+def _sets_to_hll(sets: pd.Series, p: int = HLL_PRECISION) -> HLLSketch:
+    lens = sets.map(len).to_numpy()
+    flat = pd.Series([x for cell in sets for x in cell], dtype=object)  # 由 _hash64 推断类型，大整数不经 float64
+    return hll_sketch(np.repeat(np.arange(len(sets)), lens), len(sets), _hash64(flat), p)
+
+
+def _merge_distinct(parts: list[pd.Series | HLLSketch], codes: np.ndarray, ngroups: int) -> pd.Series | HLLSketch:
+    if all(isinstance(x, pd.Series) for x in parts):
+        acc: list[set] = [set() for _ in range(ngroups)]
+        for g, cell in zip(codes, (c for x in parts for c in x)):
+            acc[g] |= cell
+        if sum(map(len, acc)) <= NUNIQUE_EXACT_LIMIT:
+            return pd.Series([frozenset(x) for x in acc], dtype=object)
+    return hll_merge([x if isinstance(x, HLLSketch) else _sets_to_hll(x) for x in parts], codes, ngroups)
+
+
+@dataclass(slots=True)
+class AggState:
+    """按组的可合并中间状态（增量追加、分块与并行执行共用）。
+
+    keys 每组一行（分组列取值）；parts[i] 对应 reductions[i]：sum/count/size/min/max 为数值 Series，
+    nunique 为 frozenset 的 object Series（精确）或 HLLSketch（草图），hll 总是 HLLSketch。
+    """
+    group_keys: list[str]
+    reductions: list[Reduction]
+    keys: pd.DataFrame
+    parts: list[pd.Series | HLLSketch]
+
+    @property
+    def ngroups(self) -> int: return len(self.keys)
+
+    @staticmethod
+    def build(df: pd.DataFrame, group_keys: list[str], reductions: list[Reduction],
+              ctx: EvalContext | None = None, key: GroupKey | None = None) -> "AggState":
+        ctx = ctx or EvalContext(df)
+        if key is None:
+            with _Stage("group_key", len(df)) as st:
+                key = make_group_key(df, group_keys)
+                st.rows_out = key.ngroups
+        with _Stage("aggregate", len(df)) as st:
+            plain = [i for i, r in enumerate(reductions) if r.op not in ("nunique", "hll")]
+            reduced = run_reductions(df, key, [reductions[i] for i in plain], ctx)
+            parts: list[Any] = [None] * len(reductions)
+            for j, i in enumerate(plain):
+                parts[i] = reduced[j].reset_index(drop=True)
+            for i, r in enumerate(reductions):
+                if r.op == "nunique":
+                    parts[i] = _distinct_state(ctx.series(r.expr), key.codes, key.ngroups)
+                elif r.op == "hll":
+                    parts[i] = hll_sketch(key.codes, key.ngroups, _hash64(ctx.series(r.expr)), r.arg)
+            st.rows_out = key.ngroups
+        return AggState(list(group_keys), list(reductions), key.uniques.reset_index(drop=True), parts)
+
+    @staticmethod
+    def merge_all(states: list["AggState"]) -> "AggState":
+        """按分组取值合并多份状态：sum/count/size 相加，min/max 取极值，去重状态取并。"""
+        first = states[0]
+        if len(states) == 1: return first
+        keys = reduce(_concat_rows, [s.keys for s in states])  # 分类键按并集字典对齐
+        columns = [[s.parts[i] for s in states] for i in range(len(first.reductions))]
+        return AggState._combine(keys, first.group_keys, first.reductions, columns)
+
+    def rollup(self, group_keys: list[str], reductions: list[Reduction] | None = None) -> "AggState":
+        """上卷到更粗的分组（group_keys 为当前分组列的子集）；reductions 给出时只保留这些归约（按 ident 取）。"""
+        missing = [k for k in group_keys if k not in self.group_keys]
+        if missing: raise ValueError(f"Cannot roll up to keys not in state: {missing}")
+        pos = {r.ident: i for i, r in enumerate(self.reductions)}
+        picked = [pos[r.ident] for r in reductions] if reductions is not None else list(range(len(self.reductions)))
+        return AggState._combine(self.keys[group_keys], list(group_keys), [self.reductions[i] for i in picked],
+                                 [[self.parts[i]] for i in picked])
+
+    @staticmethod
+    def _combine(keys: pd.DataFrame, group_keys: list[str], reductions: list[Reduction],
+                 columns: list[list[pd.Series | HLLSketch]]) -> "AggState":
+        # keys 与 columns[i] 拼接后的各行一一对应；按 group_keys 重新编码后逐归约合并
+        if group_keys:
+            key = make_group_key(keys, group_keys)
+            codes, ngroups, uniques = key.codes, key.ngroups, key.uniques
+        else:
+            codes, ngroups, uniques = np.zeros(len(keys), dtype=np.int64), 1, pd.DataFrame(index=pd.RangeIndex(1))
+        parts: list[Any] = []
+        for r, col in zip(reductions, columns):
+            match r.op:
+                case "sum" | "count" | "size":
+                    parts.append(pd.concat(col, ignore_index=True).groupby(codes).sum().reset_index(drop=True))
+                case "min":
+                    parts.append(pd.concat(col, ignore_index=True).groupby(codes).min().reset_index(drop=True))
+                case "max":
+                    parts.append(pd.concat(col, ignore_index=True).groupby(codes).max().reset_index(drop=True))
+                case "nunique":
+                    parts.append(_merge_distinct(col, codes, ngroups))
+                case "hll":
+                    parts.append(hll_merge(col, codes, ngroups))
+                case other:
+                    raise ValueError(f"Unsupported reduction: {other}")
+        return AggState(list(group_keys), list(reductions), uniques.reset_index(drop=True), parts)
+
+    def merge(self, other: "AggState") -> "AggState":
+        return AggState.merge_all([self, other])
+
+    def take(self, pos: np.ndarray) -> "AggState":
+        """只保留 pos 指定的组（按 pos 顺序重新编号）。"""
+        parts = [p.take(pos) if isinstance(p, HLLSketch) else p.iloc[pos].reset_index(drop=True) for p in self.parts]
+        return AggState(self.group_keys, self.reductions, self.keys.iloc[pos].reset_index(drop=True), parts)
+
+    def reduced(self) -> pd.DataFrame:
+        """状态 -> 各归约的最终值（第 i 列对应 reductions[i]），供 AggPlan.finalize 使用。"""
+        out: dict[int, pd.Series] = {}
+        for i, part in enumerate(self.parts):
+            if isinstance(part, HLLSketch):
+                out[i] = pd.Series(hll_estimate(part))
+            elif self.reductions[i].op == "nunique":
+                out[i] = part.map(len).astype("int64")
+            else:
+                out[i] = part
+        return pd.DataFrame(out, index=pd.RangeIndex(self.ngroups))
+
+    def finalize(self, metrics: list[Measure], agg_plan: AggPlan) -> pd.DataFrame:
+        grouped = pd.concat(agg_plan.finalize(metrics, self.reduced()), axis=1)
+        return self.keys.join(grouped, how="right") if self.group_keys else grouped
+
+
+class MaterializedReport:
+    """增量维护的报表：保存按组可合并状态，Dataset.append 时只聚合新行再合并。"""
+
+    def __init__(self, dataset: Dataset, spec: ReportSpec):
+        self.spec = spec
+        self.metrics = _report_metrics(spec)
+        self.agg_plan = fuse_measures(self.metrics)
+        self.columns = required_columns(spec)
+        row_names, col_names, slicer_names = _group_names(spec)
+        self.group_keys = row_names + col_names + slicer_names
+        self.state = self._state_of(dataset.df)
+
+    def _state_of(self, df: pd.DataFrame) -> AggState:
+        frame = _prepare_frame(df, self.spec, self.columns)
+        return AggState.build(frame, self.group_keys, self.agg_plan.reductions)
+
+    def update(self, rows: pd.DataFrame) -> None:
+        self.state = self.state.merge(self._state_of(rows))
+
+    def refresh(self, df: pd.DataFrame) -> None:
+        self.state = self._state_of(df)
+
+    def result(self) -> PivotResult:
+        return _finish_state(self.state, self.spec, self.metrics, self.agg_plan)
+
 
-        frames = _pivot_frames(grouped, row_names, col_names, slicer_names, metrics, spec)
-        return PivotResult(frames=frames, slicer_names=slicer_names)
+# ---- 7.6 分块数据源 + ChunkedPandasEngine（out-of-core：逐块过滤/归约，按组合并状态） ----
+type ChunkSource = Callable[[list[str] | None], Iterable[pd.DataFrame]]
+
+
+class ChunkedDataset:
+    """不整体装入内存的数据源：每次执行按需逐块读取（只读报表用到的列）。
+
+    source 为 `columns -> 可迭代的 DataFrame 分块` 的工厂，每次 report 都会重新调用；
+    直接传入迭代器时只能执行一次。峰值内存约为 单块大小 + merge_every × 组数。
+    """
+
+    def __init__(self, source: ChunkSource | Iterable[pd.DataFrame], *, merge_every: int = 8):
+        if callable(source):
+            self._source: ChunkSource = source
+        elif isinstance(source, Iterator):
+            self._source = self._once(source)
+        else:
+            self._source = lambda columns: source
+        self.merge_every = merge_every
+
+    @staticmethod
+    def _once(it: Iterator[pd.DataFrame]) -> ChunkSource:
+        used = False
+
+        def source(columns: list[str] | None) -> Iterable[pd.DataFrame]:
+            nonlocal used
+            if used: raise RuntimeError("分块迭代器已被消费；需要多次执行请传入工厂函数")
+            used = True
+            return it
+        return source
+
+    @classmethod
+    def from_csv(cls, path: str, *, chunksize: int = 1_000_000, **read_kw: Any) -> "ChunkedDataset":
+        """read_csv 分块读取；时间维度列请通过 parse_dates=[...] 解析。"""
+        def source(columns: list[str] | None) -> Iterable[pd.DataFrame]:
+            kw = dict(read_kw)
+            if columns is not None and isinstance(kw.get("parse_dates"), list):
+                kw["parse_dates"] = [c for c in kw["parse_dates"] if c in columns]  # 未读取的列不能解析
+            return pd.read_csv(path, usecols=columns, chunksize=chunksize, **kw)
+        return cls(source)
+
+    @classmethod
+    def from_parquet(cls, path: str, *, batch_size: int = 1_000_000) -> "ChunkedDataset":
+        """按 record batch 读取 Parquet（需要 pyarrow）。"""
+        try:
+            import pyarrow.parquet as pq  # type: ignore
+        except Exception as e:
+            raise RuntimeError("请先 `pip install pyarrow` 再读取 Parquet 分块") from e
+
+        def source(columns: list[str] | None) -> Iterable[pd.DataFrame]:
+            with pq.ParquetFile(path) as f:
+                for batch in f.iter_batches(batch_size=batch_size, columns=columns):
+                    yield batch.to_pandas()
+        return cls(source)
+
+    def chunks(self, columns: list[str] | None = None, where: PredicateExpr | None = None) -> Iterable[pd.DataFrame]:
+        # where 仅供可裁剪的数据源跳过数据；引擎仍会在每块上完整求值
+        return self._source(columns)
+
+    def report(self, spec: ReportSpec, engine: "Engine" | None = None) -> PivotResult:
+        return Planner(engine or ChunkedPandasEngine()).run(self, spec)
+
+    def explain(self, spec: ReportSpec, engine: "Engine" | None = None, analyze: bool = False, *,
+                memory: bool = True) -> PlanNode:
+        return explain_report(self, spec, engine or ChunkedPandasEngine(), analyze, memory=memory)
+
+
+# Parquet 数据集：WHERE -> pyarrow.dataset 过滤表达式（分区 + 行组 min/max 统计裁剪）
+_FLIPPED_OPS = {">": "<", ">=": "<=", "<": ">", "<=": ">=", "==": "==", "=": "==", "!=": "!=", "<>": "!="}
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or value is pd.NaT or (isinstance(value, float) and np.isnan(value))
+
+
+def _arrow_scalar(value: Any, typ: Any) -> Any | None:
+    """字面量转为列类型的 Arrow 标量；缺失值、不可转换或有损转换时返回 None（不参与裁剪）。"""
+    import pyarrow as pa  # type: ignore
+    if _is_missing(value): return None
+    try:
+        src = pa.scalar(value)
+        out = src.cast(typ)
+        if not pa.types.is_string(src.type) and out.cast(src.type) != src: return None
+        return out
+    except (pa.ArrowException, TypeError, ValueError, OverflowError):
+        return None
+
+
+def arrow_filter(pred: PredicateExpr, schema: Any, *, exact: bool = False) -> Any | None:
+    """把谓词翻译为 pyarrow.compute 表达式；无法翻译返回 None。
+
+    支持 列 与字面量 的 Cmp / Between / InSet / IsNull 及其 AND/OR/NOT（SQLPredicate 先解析）。
+    exact=False 时 AND 中无法翻译的一侧直接丢弃，结果为原谓词的超集，只可用于裁剪。
+    """
+    import pyarrow as pa  # type: ignore
+    import pyarrow.compute as pc  # type: ignore
+
+    def column(e: ScalarExpr) -> str | None:
+        return e.name if isinstance(e, ColumnRef) and e.name in schema.names else None
+
+    match pred:
+        case SQLPredicate():
+            return arrow_filter(pred.as_inner(), schema, exact=exact)
+        case BoolOp(left, right, "and"):
+            a, b = arrow_filter(left, schema, exact=exact), arrow_filter(right, schema, exact=exact)
+            if a is None or b is None: return None if exact else (a if b is None else b)
+            return a & b
+        case BoolOp(left, right, "or"):
+            a, b = arrow_filter(left, schema, exact=exact), arrow_filter(right, schema, exact=exact)
+            return None if a is None or b is None else a | b
+        case NotOp(inner):
+            # pandas 中 NaN 比较为 False、取反为 True；Arrow 的 null 需先补成 False
+            e = arrow_filter(inner, schema, exact=True)
+            return None if e is None else ~pc.coalesce(e, pa.scalar(False))
+        case IsNull(expr):
+            name = column(expr)
+            return None if name is None else pc.field(name).is_null(nan_is_null=True)
+        case Cmp(left, right, op):
+            if isinstance(left, Literal) and isinstance(right, ColumnRef):
+                left, right, op = right, left, _FLIPPED_OPS.get(op, op)
+            name = column(left)
+            if name is None or not isinstance(right, Literal): return None
+            v = _arrow_scalar(right.value, schema.field(name).type)
+            if v is None: return None
+            f = pc.field(name)
+            match op:
+                case "==" | "=": return f == v
+                case "!=" | "<>": return (f != v) | f.is_null(nan_is_null=True)
+                case ">": return f > v
+                case ">=": return f >= v
+                case "<": return f < v
+                case "<=": return f <= v
+            return None
+        case Between(expr, lo, hi, inclusive):
+            name = column(expr)
+            if name is None: return None
+            typ = schema.field(name).type
+            lo_v, hi_v = _arrow_scalar(lo, typ), _arrow_scalar(hi, typ)
+            if lo_v is None or hi_v is None: return None
+            f = pc.field(name)
+            lower = f >= lo_v if inclusive in ("both", "left") else f > lo_v
+            upper = f <= hi_v if inclusive in ("both", "right") else f < hi_v
+            return lower & upper
+        case InSet(expr, values):
+            name = column(expr)
+            if name is None: return None
+            typ = schema.field(name).type
+            scalars = [_arrow_scalar(v, typ) for v in values]
+            if any(v is None for v in scalars): return None
+            return pc.field(name).isin(pa.array([v.as_py() for v in scalars], type=typ))
+        case _:
+            return None
+
+
+class ParquetDataset(ChunkedDataset):
+    """Parquet 文件或目录（按日期分目录 / hive 布局 `Date=2025-01-01/part-0.parquet`）。
+
+    WHERE 中可翻译的部分（见 arrow_filter，含解析后的 SQLPredicate）交给 pyarrow.dataset：
+    先按分区键跳过文件，再按行组 min/max 统计跳过行组，之后才解码剩余数据。
+    裁剪只需是超集，完整 WHERE 仍由引擎在每块上求值。partitioning 原样传给 pyarrow.dataset.dataset。
+    """
+
+    def __init__(self, path: str | list[str], *, partitioning: Any = "hive", batch_size: int = 1_000_000,
+                 merge_every: int = 8):
+        try:
+            import pyarrow.dataset as pads  # type: ignore
+        except Exception as e:
+            raise RuntimeError("请先 `pip install pyarrow` 再读取 Parquet 数据集") from e
+        self.path = path
+        self.dataset = pads.dataset(path, format="parquet", partitioning=partitioning)
+        self.batch_size = batch_size
+        super().__init__(lambda columns: self.chunks(columns), merge_every=merge_every)
+
+    @property
+    def schema(self) -> Any: return self.dataset.schema
+
+    def pruning_filter(self, where: PredicateExpr | str | None) -> Any | None:
+        pred = ensure_predicate(where)
+        return None if pred is None else arrow_filter(pred, self.schema)
+
+    def scanner(self, columns: list[str] | None = None, where: PredicateExpr | str | None = None) -> Any:
+        return self.dataset.scanner(columns=columns, filter=self.pruning_filter(where), batch_size=self.batch_size)
+
+    @override
+    def chunks(self, columns: list[str] | None = None, where: PredicateExpr | None = None) -> Iterable[pd.DataFrame]:
+        empty = True
+        for batch in self.scanner(columns, where).to_batches():
+            if not batch.num_rows: continue
+            empty = False
+            yield batch.to_pandas(date_as_object=False)
+        if empty:  # 全部被裁剪：给引擎一个空块以产出空报表
+            table = self.schema.empty_table()
+            yield (table if columns is None else table.select(columns)).to_pandas(date_as_object=False)
+
+
+class ChunkedPandasEngine(Engine):
+    """逐块执行 WHERE/行级度量/部分聚合，按组合并 AggState 后再透视。
+
+    也可用于内存中的 Dataset：按 chunk_rows 切片执行，限制中间列的峰值内存；此时结果照常进入 Dataset 的结果缓存。
+    """
+    cube_routing = True
+
+    def __init__(self, chunk_rows: int = 1_000_000, merge_every: int | None = None):
+        self.chunk_rows = chunk_rows
+        self.merge_every = merge_every
+
+    def _chunks(self, dataset: Dataset | ChunkedDataset, columns: list[str],
+                where: PredicateExpr | None = None) -> Iterable[pd.DataFrame]:
+        if isinstance(dataset, ChunkedDataset):
+            yield from dataset.chunks(columns, where)
+            return
+        df = dataset.df
+        for start in range(0, max(len(df), 1), self.chunk_rows):
+            yield df.iloc[start:start + self.chunk_rows]
+
+    @override
+    def execute(self, dataset: Dataset | ChunkedDataset, spec: ReportSpec, plan: Plan) -> PivotResult:
+        columns = plan.columns or required_columns(spec)
+        row_names, col_names, slicer_names = _group_names(spec)
+        group_keys = row_names + col_names + slicer_names
+        metrics = _report_metrics(spec)
+        agg_plan = plan.agg_plan or fuse_measures(metrics)
+        merge_every = self.merge_every or getattr(dataset, "merge_every", 8)
+
+        # 部分状态攒够 merge_every 份就折叠一次：内存只随组数增长，与总行数无关
+        pending: list[AggState] = []
+        for chunk in _staged("scan", self._chunks(dataset, columns, ensure_predicate(spec.where))):
+            pending.append(AggState.build(_prepare_frame(chunk, spec, columns), group_keys, agg_plan.reductions))
+            if len(pending) >= merge_every:
+                pending = [_merge_states(pending)]
+        if not pending:  # 空数据源：与空 DataFrame 上的 PandasEngine 结果一致
+            pending.append(AggState.build(_prepare_frame(pd.DataFrame(columns=columns), spec, columns),
+                                          group_keys, agg_plan.reductions))
+        return _finish_state(_merge_states(pending), spec, metrics, agg_plan)
+
+    @override
+    def explain(self, dataset: Dataset | ChunkedDataset, spec: ReportSpec, plan: Plan) -> PlanNode:
+        root = super().explain(dataset, spec, plan)
+        scan = root.find("scan")
+        if scan is not None:
+            if isinstance(dataset, ParquetDataset):
+                scan.detail.update(source="parquet", path=dataset.path, batch_size=dataset.batch_size)
+                if (expr := dataset.pruning_filter(spec.where)) is not None: scan.detail["pruning"] = str(expr)
+            elif not isinstance(dataset, ChunkedDataset):
+                scan.detail["chunk_rows"] = self.chunk_rows
+            pos = next(i for i, c in enumerate(root.children) if c.op == "aggregate") + 1
+            root.children.insert(pos, PlanNode("merge", {"merge_every": self.merge_every
+                                                         or getattr(dataset, "merge_every", 8)}))
+        return root
+
+
+def _staged(op: str, chunks: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+    """逐块拉取也计入一个阶段（含读取/解码耗时）；耗尽前的最后一次拉取同样计时。"""
+    it = iter(chunks)
+    while True:
+        with _Stage(op) as st:
+            chunk = next(it, None)
+            if chunk is not None: st.rows_out = len(chunk)
+        if chunk is None: return
+        yield chunk
+
+
+def _merge_states(states: list[AggState]) -> AggState:
+    with _Stage("merge", sum(s.ngroups for s in states)) as st:
+        merged = AggState.merge_all(states)
+        st.rows_out = merged.ngroups
+    return merged
+
+
+# ---- 7.7 ParallelPandasEngine（多进程分区聚合；列缓冲走共享内存） ----
+@dataclass(slots=True)
+class SharedColumn:
+    """一列在共享内存中的描述：values 为 numpy 缓冲；分类/字符串/扩展类型列只共享码，字典随描述传递。"""
+    name: str
+    shm_name: str | None
+    dtype: str
+    length: int
+    categories: Any = None  # 码列的字典（pd.Index；扩展类型列为 ExtensionArray）
+    ordered: bool = False
+    decode: Any = None  # 字符串/对象列：在子进程按字典解码回原 dtype（语义与原列一致）
+    tz: Any = None
+    mask_shm: str | None = None  # 可空数值/布尔列（Int64/Float64/boolean）：缺失掩码缓冲，decode 为其 dtype
+    raw: pd.Series | None = None  # 无法编码的列（不可哈希对象）：只随所在分区传递对应切片
+    offset: int = 0  # raw 切片在全列中的起始行
+
+    def rows(self, start: int, stop: int) -> "SharedColumn":
+        """下发给某个分区的描述：缓冲列原样，raw 列只带该分区的切片。"""
+        if self.raw is None: return self
+        return SharedColumn(self.name, None, self.dtype, self.length, raw=self.raw.iloc[start:stop], offset=start)
+
+    def view(self, start: int, stop: int, shms: dict[str, Any]) -> pd.Series | np.ndarray:
+        if self.raw is not None:
+            return self.raw.iloc[start - self.offset:stop - self.offset].reset_index(drop=True)
+        arr = np.ndarray((self.length,), dtype=np.dtype(self.dtype), buffer=shms[self.shm_name].buf)[start:stop]
+        if self.mask_shm is not None:
+            mask = np.ndarray((self.length,), dtype=np.bool_, buffer=shms[self.mask_shm].buf)[start:stop]
+            return pd.Series(self.decode.construct_array_type()(arr.copy(), mask.copy()))
+        if isinstance(self.categories, pd.api.extensions.ExtensionArray):
+            return pd.Series(self.categories.take(arr, allow_fill=True))  # 码 -1 -> NA
+        if self.decode is not None:
+            lut = np.append(self.categories.to_numpy(dtype=object), np.nan)  # 码 -1 -> 末位 NaN
+            return pd.Series(lut[arr], dtype=self.decode)
+        if self.categories is not None:
+            return pd.Categorical.from_codes(arr, categories=self.categories, ordered=self.ordered)
+        if self.tz is not None:
+            return pd.DatetimeIndex(arr.view("M8[ns]")).tz_localize("UTC").tz_convert(self.tz)
+        return arr
+
+
+def _attach_shm(name: str) -> Any:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13：附着也会登记，但子进程与父进程共用同一个 resource tracker，由父进程 unlink 注销
+        return shared_memory.SharedMemory(name=name)
+
+
+def share_columns(df: pd.DataFrame, columns: Sequence[str] | None = None) -> tuple[list[SharedColumn], list[Any]]:
+    """把 df 的列（默认全部）直接从原缓冲拷进共享内存（每列一次），返回列描述与需要由调用方 close/unlink 的段。"""
+    cols: list[SharedColumn] = []
+    segments: list[Any] = []
+
+    def put(values: np.ndarray) -> str:
+        values = np.ascontiguousarray(values)
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        segments.append(shm)
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+        return shm.name
+
+    for c in (df.columns if columns is None else columns):
+        s = df[c]
+        kw: dict[str, Any] = {}
+        try:
+            if isinstance(s.dtype, pd.CategoricalDtype):
+                values = s.cat.codes.to_numpy()
+                kw = dict(categories=s.cat.categories, ordered=s.cat.ordered)
+            elif isinstance(s.dtype, pd.DatetimeTZDtype):
+                values = s.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy("M8[ns]").view("i8")
+                kw = dict(tz=s.dt.tz)
+            elif isinstance(s.dtype, np.dtype) and s.dtype.kind in "biufcmM":
+                values = s.to_numpy()
+            elif isinstance(s.array, (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)):
+                # 可空数值/布尔：数据与缺失掩码各一段缓冲，子进程原样拼回
+                values = s.to_numpy(dtype=s.dtype.numpy_dtype, na_value=0)
+                kw = dict(decode=s.dtype, mask_shm=put(s.isna().to_numpy()))
+            elif pd.api.types.is_string_dtype(s.dtype) or s.dtype == object:
+                # 字符串/对象列：共享 int 码，字典（去重值）随描述 pickle，子进程解码
+                values, uniques = pd.factorize(s)
+                kw = dict(categories=pd.Index(uniques, dtype=object), decode=s.dtype)
+            else:
+                # 其余扩展类型（Period/Interval/Arrow 等）：共享码，字典为同类型 ExtensionArray
+                values, uniques = s.array.factorize()
+                kw = dict(categories=uniques)
+        except TypeError:  # 不可哈希的对象值
+            cols.append(SharedColumn(c, None, str(s.dtype), len(s), raw=s.reset_index(drop=True)))
+            continue
+        cols.append(SharedColumn(c, put(values), values.dtype.str, len(values), **kw))
+    return cols, segments
+
+
+def _partition_state(spec: ReportSpec, cols: list[SharedColumn], start: int, stop: int,
+                     group_keys: list[str], reductions: list[Reduction]) -> AggState:
+    """子进程：按行区间附着共享列 -> WHERE/行级度量/部分聚合，只回传按组状态。"""
+    names = [n for c in cols for n in (c.shm_name, c.mask_shm) if n is not None]
+    shms = {n: _attach_shm(n) for n in names}
+    try:
+        df = pd.DataFrame({c.name: c.view(start, stop, shms) for c in cols})
+        state = AggState.build(_prepare_frame(df, spec, list(df.columns)), group_keys, reductions)
+        del df
+        return state
+    finally:
+        for shm in shms.values(): shm.close()
+
+
+class ParallelPandasEngine(Engine):
+    """按行区间切分到进程池并行聚合，再按组合并 AggState（NUnique 合并集合/草图，比值合并分子分母）。
+
+    行数低于 min_rows 时直接在本进程按 PandasEngine 的路径执行。mp_context 可传入
+    multiprocessing 上下文（默认使用平台默认启动方式；spawn/forkserver 要求本模块可按名导入）。
+    进程池在首次并行执行时创建并留在引擎上复用；不再使用时调用 close()（或用 with 语句）。
+    """
+
+    cube_routing = True
+
+    def __init__(self, workers: int | None = None, *, min_rows: int = 200_000, mp_context: Any = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_rows = min_rows
+        self.mp_context = mp_context
+        self._pool: ProcessPoolExecutor | None = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context)
+        return self._pool
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self) -> "ParallelPandasEngine":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    @override
+    def execute(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PivotResult:
+        src = dataset.df
+        n = len(src)
+        parts = min(self.workers, max(n // max(self.min_rows // 4, 1), 1))
+        if n < self.min_rows or parts < 2:
+            return PandasEngine().execute(dataset, spec, plan)
+
+        row_names, col_names, slicer_names = _group_names(spec)
+        group_keys = row_names + col_names + slicer_names
+        metrics = _report_metrics(spec)
+        agg_plan = plan.agg_plan or fuse_measures(metrics)
+        try:
+            pickle.dumps((spec, agg_plan.reductions))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return PandasEngine().execute(dataset, spec, plan)  # 含 lambda 等自定义表达式：无法下发子进程
+        bounds = np.linspace(0, n, parts + 1).astype(int)
+
+        cols, segments = share_columns(src, plan.columns or required_columns(spec))  # 不先切出子帧，省一份拷贝
+        try:
+            with _Stage("partitions", n) as st:
+                pool = self._executor()
+                futures = [pool.submit(_partition_state, spec, [c.rows(a, b) for c in cols], a, b, group_keys,
+                                       agg_plan.reductions)
+                           for a, b in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+                states = [f.result() for f in futures]
+                st.rows_out = sum(x.ngroups for x in states)
+            state = _merge_states(states)
+        except BrokenProcessPool:
+            self._pool = None  # 子进程异常退出后池不可再用，下次重建
+            raise
+        finally:
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+        return _finish_state(state, spec, metrics, agg_plan)
+
+    @override
+    def explain(self, dataset: Dataset, spec: ReportSpec, plan: Plan) -> PlanNode:
+        root = super().explain(dataset, spec, plan)
+        n = _dataset_rows(dataset) or 0
+        parts = min(self.workers, max(n // max(self.min_rows // 4, 1), 1))
+        if plan.cube is not None or n < self.min_rows or parts < 2: return root
+        # 分区内的过滤/物化/聚合在子进程执行：合成一个 partitions 阶段，其后按组合并
+        inner = [c for c in root.children if c.op in ("filter", "materialize", "group_key", "aggregate")]
+        for c in inner: c.detail.pop("indexes", None)  # 子进程按行区间附着共享列，不带索引
+        node = PlanNode("partitions", {"workers": parts}, inner)
+        pos = root.children.index(inner[0])
+        root.children[pos:pos + len(inner)] = [node, PlanNode("merge")]
+        return root
+
+
+# ---- 7.8 批量报表（共享扫描 + 最细公共分组上卷） ----
+def report_shared(src: pd.DataFrame, specs: Sequence[ReportSpec], *, max_group_ratio: float = 0.5,
+                  index: DataIndex | None = None) -> list[PivotResult]:
+    """一批 WHERE 相同的报表：过滤、时间粒度物化与行级度量（共享 EvalContext）各做一次。
+
+    按全部维度的并集（最细公共分组）聚合一次成 AggState，各报表再上卷到自己的维度；
+    并集组数超过 max_group_ratio × 存活行数时上卷不划算，改为在共享帧上逐个聚合。
+    """
+    columns = list(dict.fromkeys(c for s in specs for c in required_columns(s)))
+    dims = list({d.materialized_name(): d for s in specs for d in [*s.rows, *s.columns, *s.slicers]}.values())
+    where_pred = ensure_predicate(specs[0].where)
+    if where_pred is not None:
+        df = take_rows(src, filter_positions(where_pred, src, index=index), columns)
+    else:
+        df = src[columns]
+    df = _materialize_dims(df, dims)
+    ctx = EvalContext(df)
+
+    plans: list[tuple[ReportSpec, list[Measure], AggPlan, list[str]]] = []
+    for s in specs:
+        metrics = _report_metrics(s)
+        row_names, col_names, slicer_names = _group_names(s)
+        plans.append((s, metrics, fuse_measures(metrics), row_names + col_names + slicer_names))
+
+    if len(plans) > 1:
+        finest = list(dict.fromkeys(k for *_, keys in plans for k in keys))
+        key = make_group_key(df, finest)
+        if key.ngroups <= max(max_group_ratio * len(df), 1):
+            reductions = list({r.ident: r for _, _, ap, _ in plans for r in ap.reductions}.values())
+            base = AggState.build(df, finest, reductions, ctx, key)
+            return [_finish_state(base.rollup(keys, ap.reductions), s, metrics, ap) for s, metrics, ap, keys in plans]
+    return [_finish_state(AggState.build(df, keys, ap.reductions, ctx), s, metrics, ap) if _grouping_sets(s)
+            else _finish_report(_aggregate_frame(df, keys, metrics, ap, ctx), s) for s, metrics, ap, keys in plans]
+
+
+# ---- 7.9 Cube：按声明粒度预聚合的可合并状态，Planner 命中时上卷作答 ----
+_GRAIN_ALIASES = {"d": "day", "w": "week", "m": "month", "q": "quarter", "y": "year"}
+# 细粒度 -> 可由其上卷得到的粗粒度（周跨月，不能由周得到月/季/年）
+_GRAIN_ROLLUPS = {
+    None: {None, "day", "week", "month", "quarter", "year"},
+    "day": {"day", "week", "month", "quarter", "year"},
+    "week": {"week"},
+    "month": {"month", "quarter", "year"},
+    "quarter": {"quarter", "year"},
+    "year": {"year"},
+}
+
+
+def _grain(dim: Dimension) -> str | None:
+    g = dim.time_grain.lower() if dim.time_grain else None
+    return _GRAIN_ALIASES.get(g, g)
+
+
+class Cube:
+    """在 dims 粒度上预聚合 measures 的可合并状态（AggState），可选带固定 WHERE。
+
+    报表的维度都能由立方体维度得到（同名同粒度，或更粗的时间粒度，如 day -> month），
+    其度量的全部归约都在立方体里，且 WHERE 等于立方体 WHERE 再加上只涉及立方体普通维度的合取项时，
+    即可直接在 ngroups 行的状态上过滤、上卷作答，不再扫描原始行。Dataset.append 时增量更新。
+    """
+
+    def __init__(self, dataset: Dataset, dims: list[Dimension], measures: list[Measure],
+                 where: PredicateExpr | str | None = None):
+        self.dims = list(dims)
+        self.measures = list(measures)
+        self.where = where
+        self.agg_plan = fuse_measures(self.measures)
+        self.group_keys = [d.materialized_name() for d in self.dims]
+        self._spec = ReportSpec(rows=self.dims, columns=[], metrics=self.measures, where=where)
+        self.columns = required_columns(self._spec)
+        self.state = self._state_of(dataset.df)
+
+    def _state_of(self, df: pd.DataFrame) -> AggState:
+        frame = _prepare_frame(df, self._spec, self.columns)
+        return AggState.build(frame, self.group_keys, self.agg_plan.reductions)
+
+    def update(self, rows: pd.DataFrame) -> None:
+        self.state = self.state.merge(self._state_of(rows))
+
+    def refresh(self, df: pd.DataFrame) -> None:
+        self.state = self._state_of(df)
+
+    def _source_dim(self, dim: Dimension) -> Dimension | None:
+        """立方体中能推出 dim 的维度（优先同粒度）。"""
+        cands = [d for d in self.dims if d.name == dim.name and _grain(dim) in _GRAIN_ROLLUPS.get(_grain(d), set())]
+        return min(cands, key=lambda d: _grain(d) != _grain(dim), default=None)
+
+    def _residual(self, spec: ReportSpec) -> list[PredicateExpr] | None:
+        """spec.where 去掉立方体 WHERE 后剩余的合取项；无法在立方体上求值时返回 None。"""
+        have = [p.signature() for p in _conjuncts(ensure_predicate(self.where), "and")] if self.where is not None else []
+        spec_pred = ensure_predicate(spec.where)
+        rest = _conjuncts(spec_pred, "and") if spec_pred is not None else []
+        sigs = [p.signature() for p in rest]
+        if any(s not in sigs for s in have): return None
+        residual = [p for p, s in zip(rest, sigs) if s not in have]
+        plain = {d.name for d in self.dims if not d.time_grain}
+        return residual if all(p.dependencies() <= plain for p in residual) else None
+
+    def can_answer(self, spec: ReportSpec) -> bool:
+        if any(self._source_dim(d) is None for d in [*spec.rows, *spec.columns, *spec.slicers]): return False
+        have = {r.ident for r in self.agg_plan.reductions}
+        try:
+            need = fuse_measures(_report_metrics(spec)).reductions
+        except TypeError:
+            return False
+        return all(r.ident in have for r in need) and self._residual(spec) is not None
+
+    def answer(self, spec: ReportSpec) -> PivotResult:
+        pos = np.arange(self.state.ngroups)
+        for p in self._residual(spec) or []:
+            pos = filter_positions(p, self.state.keys, pos)
+        state = self.state.take(pos)
+        keys = state.keys
+
+        # 由细粒度时间列推出报表需要的粗粒度列（日期已截断，按原规则再截断一次即可）
+        extra: list[str] = []
+        for dim in [*spec.rows, *spec.columns, *spec.slicers]:
+            name = dim.materialized_name()
+            if name in keys.columns: continue
+            src = self._source_dim(dim)
+            keys[name] = dim.materialize(pd.DataFrame({dim.name: keys[src.materialized_name()]}))[1]
+            extra.append(name)
+
+        row_names, col_names, slicer_names = _group_names(spec)
+        metrics = _report_metrics(spec)
+        agg_plan = fuse_measures(metrics)
+        with _Stage("cube", self.state.ngroups) as st:
+            rolled = AggState(state.group_keys + extra, state.reductions, keys, state.parts) \
+                .rollup(row_names + col_names + slicer_names, agg_plan.reductions)
+            st.rows_out = rolled.ngroups
+        return _finish_state(rolled, spec, metrics, agg_plan)
+
+
+def _pick_cube(dataset: Any, spec: ReportSpec) -> Cube | None:
+    # 组数最少的可作答立方体
+    cubes = [c for c in getattr(dataset, "cubes", ()) if c.can_answer(spec)]
+    return min(cubes, key=lambda c: c.state.ngroups, default=None)
+
+
+# ---- 7.10 DataIndex：WHERE 跳读（块 zone map / 低基数位置表 / 排序位置） ----
+def _column_cmp(p: Cmp) -> tuple[str, str, Any] | None:
+    """`列 op 字面量`（或反向写法）-> (列名, op, 值)。"""
+    left, right, op = p.left, p.right, p.op
+    if isinstance(left, Literal) and isinstance(right, ColumnRef):
+        left, right, op = right, left, _FLIPPED_OPS.get(op, op)
+    if isinstance(left, ColumnRef) and isinstance(right, Literal): return left.name, op, right.value
+    return None
+
+
+def _cmp_mask(values: pd.Series, op: str, value: Any) -> np.ndarray:
+    # 与行级求值同一套比较语义（字符串日期、NaN 为 False 等）
+    return _to_mask(Cmp(ColumnRef("v"), Literal(value), op).eval(pd.DataFrame({"v": values})), len(values))
+
+
+def _intersect(sel: np.ndarray, pos: np.ndarray, n: int) -> np.ndarray:
+    if len(sel) == n: return pos
+    keep = np.zeros(n, dtype=bool)
+    keep[pos] = True
+    return sel[keep[sel]]
+
+
+class ZoneMap:
+    """每 block_rows 行一块的 min/max/空值数（数值/时间列）。
+
+    对块分类：不可能命中的块整块跳过，必然全部命中的块直接接受，其余块才逐行求值。
+    """
+
+    def __init__(self, s: pd.Series, block_rows: int = 65_536):
+        self.name, self.block_rows = s.name, block_rows
+        blocks = np.arange(len(s)) // block_rows
+        self.mins = s.groupby(blocks).min().reset_index(drop=True)
+        self.maxs = s.groupby(blocks).max().reset_index(drop=True)
+        self.nulls = np.bincount(blocks, weights=s.isna().to_numpy(), minlength=len(self.mins))
+        self.sizes = np.bincount(blocks, minlength=len(self.mins))
+
+    def _classify(self, p: PredicateExpr) -> tuple[np.ndarray, np.ndarray] | None:
+        """-> (整块命中, 整块不命中)；块内全为空值时 min/max 为 NaN，比较为 False。"""
+        lo, hi, full = self.mins, self.maxs, self.nulls == 0
+        match p:
+            case IsNull(ColumnRef(name)) if name == self.name:
+                return self.nulls == self.sizes, self.nulls == 0
+            case Cmp():
+                parsed = _column_cmp(p)
+                if parsed is None or parsed[0] != self.name or _is_missing(parsed[2]): return None
+                _, op, v = parsed
+                if op in (">", ">=", "<", "<="):  # 单侧区间：两端同真则全真，两端同假则全假
+                    a, b = _cmp_mask(lo, op, v), _cmp_mask(hi, op, v)
+                    return a & b & full, ~a & ~b
+                eq_all = _cmp_mask(lo, "==", v) & _cmp_mask(hi, "==", v) & full
+                eq_none = ~_cmp_mask(hi, ">=", v) | ~_cmp_mask(lo, "<=", v)
+                if op in ("==", "="): return eq_all, eq_none
+                if op in ("!=", "<>"): return eq_none, eq_all  # NaN != v 为 True
+                return None
+            case Between(ColumnRef(name), left, right, inclusive) if name == self.name:
+                if _is_missing(left) or _is_missing(right): return None
+                lower = ">=" if inclusive in ("both", "left") else ">"
+                upper = "<=" if inclusive in ("both", "right") else "<"
+                return (_cmp_mask(lo, lower, left) & _cmp_mask(hi, upper, right) & full,
+                        ~_cmp_mask(hi, lower, left) | ~_cmp_mask(lo, upper, right))
+            case InSet(ColumnRef(name), values) if name == self.name:
+                if any(_is_missing(v) for v in values): return None
+                hit_all, hit_none = np.zeros(len(lo), dtype=bool), np.ones(len(lo), dtype=bool)
+                for v in values:
+                    hit_all |= _cmp_mask(lo, "==", v) & _cmp_mask(hi, "==", v) & full
+                    hit_none &= ~_cmp_mask(hi, ">=", v) | ~_cmp_mask(lo, "<=", v)
+                return hit_all, hit_none
+            case _:
+                return None
+
+    def probe(self, p: PredicateExpr, sel: np.ndarray) -> tuple[np.ndarray, np.ndarray] | None:
+        try:
+            classified = self._classify(p)
+        except (TypeError, ValueError):
+            return None  # 不可比较：交给逐行求值（报同样的错）
+        if classified is None: return None
+        all_b, none_b = classified
+        if not (all_b | none_b).any(): return None  # 没有可判定的块：直接逐行求值
+        b = sel // self.block_rows
+        return sel[all_b[b]], sel[~(all_b | none_b)[b]]
+
+
+class BitmapIndex:
+    """低基数列：取值（含空值）-> 升序行位置表。
+
+    任意只依赖该列的谓词都在取值表上求值一次（与 _eval_on_dictionary 同一语义），
+    再合并命中取值的位置表，不再逐行求值。
+    """
+
+    def __init__(self, s: pd.Series):
+        self.name, self.n = s.name, len(s)
+        codes, uniques = pd.factorize(s, use_na_sentinel=False)
+        self.codes = codes
+        self.values = pd.Series(uniques)
+        self.order = np.argsort(codes, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(uniques)))])
+
+    def probe(self, p: PredicateExpr, sel: np.ndarray) -> tuple[np.ndarray, np.ndarray] | None:
+        if p.dependencies() != {self.name}: return None
+        mask = _to_mask(EvalContext(pd.DataFrame({self.name: self.values})).eval(p), len(self.values))
+        if len(sel) < self.n: return sel[mask[self.codes[sel]]], sel[:0]  # 已收窄：按码查表
+        hit = [self.order[self.offsets[k]:self.offsets[k + 1]] for k in np.flatnonzero(mask)]
+        if len(hit) == 1: return hit[0], sel[:0]  # 稳定排序：单个取值的位置表本身有序
+        return (np.sort(np.concatenate(hit)) if hit else sel[:0]), sel[:0]
+
+
+class SortedIndex:
+    """排序位置索引（时间/数值列）：非空值升序 + 对应行位置，范围谓词两次二分即得行位置。
+
+    按时间排好序的帧位置本身就是升序，取区间后无需再排序。
+    """
+
+    def __init__(self, s: pd.Series):
+        self.name, self.n = s.name, len(s)
+        valid = ~s.isna().to_numpy()
+        pos = np.flatnonzero(valid)
+        vals = s.to_numpy()[valid]
+        order = np.argsort(vals, kind="stable")
+        self.values = pd.Index(vals[order])
+        self.positions = pos[order]
+        self.nulls = np.flatnonzero(~valid)
+        self.monotonic = bool((np.diff(self.positions) > 0).all())
+
+    def _rows(self, lo: int, hi: int) -> np.ndarray:
+        rows = self.positions[lo:hi]
+        return rows if self.monotonic else np.sort(rows)
+
+    def _range(self, op: str, v: Any) -> tuple[int, int]:
+        ss, n = self.values.searchsorted, len(self.values)
+        match op:
+            case ">": return int(ss(v, "right")), n
+            case ">=": return int(ss(v, "left")), n
+            case "<": return 0, int(ss(v, "left"))
+            case "<=": return 0, int(ss(v, "right"))
+            case _: return int(ss(v, "left")), int(ss(v, "right"))  # ==
+
+    def _positions(self, p: PredicateExpr) -> np.ndarray | None:
+        match p:
+            case IsNull(ColumnRef(name)) if name == self.name:
+                return self.nulls
+            case Cmp():
+                parsed = _column_cmp(p)
+                if parsed is None or parsed[0] != self.name or _is_missing(parsed[2]): return None
+                _, op, v = parsed
+                if op not in (">", ">=", "<", "<=", "==", "=", "!=", "<>"): return None
+                _cmp_mask(self.values[:1].to_series(), op, v)  # 不可比较时与逐行求值一样抛错 -> 放弃索引
+                if op in ("!=", "<>"):
+                    return np.setdiff1d(np.arange(self.n), self._rows(*self._range("==", v)), assume_unique=True)
+                return self._rows(*self._range(op, v))
+            case Between(ColumnRef(name), left, right, inclusive) if name == self.name:
+                if _is_missing(left) or _is_missing(right): return None
+                lo, _ = self._range(">=" if inclusive in ("both", "left") else ">", left)
+                _, hi = self._range("<=" if inclusive in ("both", "right") else "<", right)
+                return self._rows(lo, max(lo, hi))
+            case InSet(ColumnRef(name), values) if name == self.name:
+                if any(_is_missing(v) for v in values): return None
+                parts = [self._rows(*self._range("==", v)) for v in values]
+                return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+            case _:
+                return None
+
+    def probe(self, p: PredicateExpr, sel: np.ndarray) -> tuple[np.ndarray, np.ndarray] | None:
+        try:
+            pos = self._positions(p)
+        except (TypeError, ValueError):
+            return None
+        return None if pos is None else (_intersect(sel, pos, self.n), sel[:0])
+
+
+class DataIndex:
+    """一个帧上的列索引集合；filter_positions 对单列叶子谓词调用 probe()。
+
+    kind：zonemap（块 min/max）、bitmap（低基数列位置表）、sorted（排序位置）；
+    auto 时分类/低基数字符串列用 bitmap，时间列用 sorted，数值列用 zonemap。
+    """
+
+    def __init__(self, df: pd.DataFrame, specs: Mapping[str, tuple[str, int]], *, max_ratio: float = 0.05):
+        self.by_column: dict[str, ZoneMap | BitmapIndex | SortedIndex] = {}
+        for name, (kind, block_rows) in specs.items():
+            s = df[name]
+            if kind == "auto": kind = self._auto_kind(s, max_ratio)
+            match kind:
+                case "zonemap": self.by_column[name] = ZoneMap(s, block_rows)
+                case "bitmap": self.by_column[name] = BitmapIndex(s)
+                case "sorted": self.by_column[name] = SortedIndex(s)
+
+    @staticmethod
+    def _auto_kind(s: pd.Series, max_ratio: float) -> str:
+        if isinstance(s.dtype, pd.CategoricalDtype): return "bitmap"
+        if pd.api.types.is_datetime64_any_dtype(s.dtype): return "sorted"
+        if pd.api.types.is_numeric_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype): return "zonemap"
+        if s.nunique(dropna=False) <= max(max_ratio * len(s), 1): return "bitmap"
+        raise ValueError(f"No suitable index for column {s.name!r}; pass kind explicitly")
+
+    def probe(self, p: PredicateExpr, sel: np.ndarray) -> tuple[np.ndarray, np.ndarray] | None:
+        """-> (确定命中的位置, 仍需逐行求值的位置)；索引不适用时返回 None。"""
+        deps = p.dependencies()
+        if len(deps) != 1: return None
+        idx = self.by_column.get(next(iter(deps)))
+        return None if idx is None else idx.probe(p, sel)
+
+
+# ---- 7.11 AutoEngine：按代价估计选择引擎（行数 / 列类型 / 组数 / 度量种类），SQL 不支持时回退 ----
+def _cpu_count() -> int:
+    return os.cpu_count() or 1
+
+
+@dataclass(slots=True)
+class CostModel:
+    """各引擎的单位代价（秒；"每行"均指扫描行）。默认值按 tools/report_bench.py 在单核上的结果粗略标定，
+    DuckDB 的行级代价按 threads 摊薄；换机器时可用基准结果重新标定。
+    """
+    group: float = 2e-6  # 每组：解码 / 透视 / 排序，各引擎共有
+    pandas_fixed: float = 0.02
+    pandas_column: float = 5e-9  # 每行每列：列裁剪与搬运
+    pandas_string_key: float = 150e-9  # 每行每个字符串分组键（factorize）
+    pandas_code_key: float = 4e-9  # 每行每个分类 / 数值 / 时间分组键
+    pandas_time_grain: float = 150e-9  # 每行每个时间粒度维度（物化）
+    pandas_reduction: float = 8e-9  # 每行每个 sum/count/min/max/size 归约
+    pandas_distinct: float = 250e-9  # 每行每个精确去重
+    pandas_hll: float = 100e-9
+    pandas_row_expr: float = 6e-9  # 每行每个行级派生表达式
+    pandas_pattern: float = 100e-9  # 每行每个字符串列上的 LIKE / 正则（分类列在字典上求值，按 pandas_code_key 计）
+    pandas_compare: float = 3e-9
+    pandas_arrow_convert: float = 40e-9  # Arrow 底表首次转 pandas：每行每列
+    pandas_parquet: float = 25e-9  # Parquet 解码成 pandas 分块：每行每列
+    chunk_fixed: float = 5e-3  # 每块：调度 + 部分状态
+    parallel_fixed: float = 0.3  # 进程池启动
+    parallel_share: float = 3e-9  # 拷进共享内存：每行每列
+    duckdb_fixed: float = 0.045
+    duckdb_column: float = 3e-9
+    duckdb_object_scan: float = 60e-9  # 注册的 pandas object 字符串列：逐行转换，不并行
+    duckdb_key: float = 6e-9
+    duckdb_reduction: float = 3e-9
+    duckdb_distinct: float = 60e-9
+    duckdb_pattern: float = 150e-9
+    duckdb_parquet: float = 6e-9
+    threads: int = dc_field(default_factory=_cpu_count)
+
+
+@dataclass(slots=True)
+class WorkloadStats:
+    """代价估计的输入：只看元数据与少量采样，不扫描全表。"""
+    source: str  # pandas / arrow / parquet / chunks
+    rows: int | None
+    columns: dict[str, str]  # 用到的原始列 -> string / category / numeric / datetime
+    keys: list[str]  # 分组维度的原始列
+    time_grains: int
+    groups: int | None  # 估计组数（采样 + GEE 估计）；未知为 None
+    reductions: dict[str, int]  # 融合后的归约：op -> 个数
+    row_exprs: int  # 非裸列的归约输入（行级派生表达式）
+    windows: int
+    patterns: list[str]  # WHERE 中 LIKE / 正则作用的列
+    compares: int  # WHERE 中其余叶子谓词
+    pandas_ready: bool = True  # Arrow 底表是否已转成 pandas
+
+    def to_dict(self) -> dict[str, Any]: return {name: getattr(self, name) for name in self.__dataclass_fields__}
+
+
+@dataclass(slots=True)
+class EngineDecision:
+    """一次 AutoEngine 选择的审计记录。"""
+    engine: str
+    costs: dict[str, float]  # 候选 -> 估计秒数
+    rejected: dict[str, str]  # 候选 -> 排除原因（缺依赖、SQL 发射器不支持…）
+    stats: WorkloadStats
+    fingerprint: str | None = None
+    seconds: float | None = None  # 实际执行耗时
+    fallback: list[str] = dc_field(default_factory=list)  # 执行期失败而跳过的候选及原因
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"engine": self.engine, "costs": self.costs, "rejected": self.rejected, "stats": self.stats.to_dict(),
+                "fingerprint": self.fingerprint, "seconds": self.seconds, "fallback": self.fallback}
+
+
+def _pandas_kind(dtype: Any) -> str:
+    if isinstance(dtype, pd.CategoricalDtype): return "category"
+    if pd.api.types.is_datetime64_any_dtype(dtype): return "datetime"
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_numeric_dtype(dtype): return "numeric"
+    return "string"
+
+
+def _arrow_kind(typ: Any) -> str:
+    import pyarrow as pa  # type: ignore
+    if pa.types.is_dictionary(typ): return "category"
+    if pa.types.is_temporal(typ): return "datetime"
+    if pa.types.is_boolean(typ) or pa.types.is_integer(typ) or pa.types.is_floating(typ) or pa.types.is_decimal(typ):
+        return "numeric"
+    return "string"
+
+
+def _source_profile(dataset: Any, columns: list[str]) -> tuple[str, int | None, dict[str, str], bool]:
+    """(来源, 行数, 列类型, pandas 是否就绪)；只读 schema / 元数据。"""
+    if isinstance(dataset, ParquetDataset):
+        schema = dataset.schema
+        return "parquet", dataset.dataset.count_rows(), {c: _arrow_kind(schema.field(c).type) for c in columns}, False
+    if isinstance(dataset, ChunkedDataset):
+        return "chunks", None, {}, False
+    if dataset.arrow is not None:
+        schema = dataset.arrow.schema
+        return ("arrow", dataset.arrow.num_rows, {c: _arrow_kind(schema.field(c).type) for c in columns},
+                dataset._df is not None)
+    df = dataset.df
+    return "pandas", len(df), {c: _pandas_kind(df[c].dtype) for c in columns}, True
+
+
+def _predicate_profile(pred: PredicateExpr | None) -> tuple[list[str], int]:
+    """WHERE 的叶子：(LIKE / 正则作用的列, 其余叶子个数)。"""
+    patterns: list[str] = []
+    compares = 0
+    stack = [pred] if pred is not None else []
+    while stack:
+        node = stack.pop()
+        if isinstance(node, SQLPredicate): node = node.as_inner()
+        match node:
+            case BoolOp(left, right, _):
+                stack += [left, right]
+            case NotOp(inner):
+                stack.append(inner)
+            case LikePredicate(expr) | RegexPredicate(expr):
+                patterns += sorted(expr.dependencies())
+            case _:
+                compares += 1
+    return patterns, compares
+
+
+def _sample_frame(dataset: Any, columns: list[str], rows: int | None, size: int) -> pd.DataFrame | None:
+    """等距采样 size 行（Parquet 取 16 个等距行组的开头）；分块数据源不可重复读，返回 None。"""
+    if not rows: return None
+    pos = np.unique(np.linspace(0, rows - 1, min(size, rows)).astype(np.int64))
+    if isinstance(dataset, ParquetDataset):
+        groups = [rg for f in dataset.dataset.get_fragments() for rg in f.split_by_row_group()]
+        picked = groups[::max(len(groups) // 16, 1)][:16]
+        # 按数据集 schema 扫描：hive 分区列由分片的分区表达式补出
+        parts = [rg.scanner(schema=dataset.schema, columns=columns).head(size // len(picked) + 1)
+                 for rg in picked]
+        return pd.concat([t.to_pandas(date_as_object=False) for t in parts], ignore_index=True)
+    if isinstance(dataset, ChunkedDataset): return None
+    if dataset._df is None and dataset.arrow is not None:
+        import pyarrow as pa  # type: ignore
+        return dataset.arrow.select(columns).take(pa.array(pos)).to_pandas(date_as_object=False)
+    return dataset.df[columns].iloc[pos].reset_index(drop=True)
+
+
+def _estimate_groups(dataset: Any, dims: list[Dimension], rows: int | None, sample_rows: int) -> int | None:
+    """采样上的组数按 GEE 估计外推：sqrt(N/n)·f1 + (d - f1)，f1 为样本中只出现一次的组数。"""
+    sample = _sample_frame(dataset, list(dict.fromkeys(d.name for d in dims)), rows, sample_rows)
+    if sample is None or not len(sample): return None
+    key = make_group_key(_materialize_dims(sample, dims), [d.materialized_name() for d in dims])
+    counts = np.bincount(key.codes, minlength=key.ngroups)
+    f1 = int((counts == 1).sum())
+    est = np.sqrt(rows / len(sample)) * f1 + (key.ngroups - f1)
+    return int(min(max(est, key.ngroups), rows))
+
+
+def workload_stats(dataset: Any, spec: ReportSpec, plan: Plan, *, sample_rows: int = 20_000) -> WorkloadStats:
+    columns = plan.columns or required_columns(spec)
+    source, rows, kinds, ready = _source_profile(dataset, columns)
+    dims = [*spec.rows, *spec.columns, *spec.slicers]
+    agg_plan = plan.agg_plan or fuse_measures(_report_metrics(spec))
+    ops: dict[str, int] = {}
+    for r in agg_plan.reductions: ops[r.op] = ops.get(r.op, 0) + 1
+    patterns, compares = _predicate_profile(ensure_predicate(spec.where))
+    return WorkloadStats(
+        source=source, rows=rows, columns=kinds, keys=[d.name for d in dims],
+        time_grains=sum(1 for d in dims if d.time_grain),
+        groups=_estimate_groups(dataset, dims, rows, sample_rows) if dims else 1,
+        reductions=ops,
+        row_exprs=len({r.expr.signature() for r in agg_plan.reductions
+                       if r.expr is not None and not isinstance(r.expr, ColumnRef)}),
+        windows=sum(1 for m in spec.metrics if isinstance(m, WindowMeasure)),
+        patterns=patterns, compares=compares, pandas_ready=ready)
+
+
+def _pandas_cost(st: WorkloadStats, m: CostModel) -> float:
+    n, kinds, r = st.rows or 0, st.columns, st.reductions
+    plain = sum(v for op, v in r.items() if op not in ("nunique", "hll"))
+    c = m.pandas_fixed + n * len(kinds) * m.pandas_column
+    if st.source == "parquet": c += n * len(kinds) * m.pandas_parquet
+    elif not st.pandas_ready: c += n * len(kinds) * m.pandas_arrow_convert
+    c += n * sum(m.pandas_code_key if kinds.get(col) == "category" else m.pandas_pattern for col in st.patterns)
+    c += n * st.compares * m.pandas_compare
+    c += n * sum(m.pandas_string_key if kinds.get(col) == "string" else m.pandas_code_key for col in st.keys)
+    c += n * (st.time_grains * m.pandas_time_grain + st.row_exprs * m.pandas_row_expr + plain * m.pandas_reduction
+              + r.get("nunique", 0) * m.pandas_distinct + r.get("hll", 0) * m.pandas_hll)
+    return c + (st.groups if st.groups is not None else n) * m.group
+
+
+def _duckdb_cost(st: WorkloadStats, m: CostModel) -> float:
+    n, t, r = st.rows or 0, max(m.threads, 1), st.reductions
+    plain = sum(v for op, v in r.items() if op not in ("nunique", "hll"))
+    c = m.duckdb_fixed
+    for kind in st.columns.values():
+        # 注册的 pandas object 字符串列逐行转换；Arrow / Parquet / 分类列按列扫描
+        c += n * m.duckdb_object_scan if st.source == "pandas" and kind == "string" else n * m.duckdb_column / t
+    if st.source == "parquet": c += n * len(st.columns) * m.duckdb_parquet / t
+    if st.source == "pandas": c += n * st.time_grains * m.pandas_time_grain  # pandas 底表先在本地物化时间粒度
+    distinct = r.get("nunique", 0) + r.get("hll", 0)
+    c += n * (len(st.patterns) * m.duckdb_pattern + st.compares * m.duckdb_column + len(st.keys) * m.duckdb_key
+              + (plain + st.row_exprs) * m.duckdb_reduction + distinct * m.duckdb_distinct) / t
+    return c + (st.groups if st.groups is not None else n) * m.group
+
+
+def estimate_cost(engine: Engine, stats: WorkloadStats, model: CostModel, dataset: Any = None) -> float | None:
+    """估计 engine 执行该报表的秒数；没有代价模型的引擎（如 BigQuery）返回 None。"""
+    n = stats.rows or 0
+    groups = stats.groups if stats.groups is not None else n
+    match engine:
+        case DuckDBEngine():
+            return _duckdb_cost(stats, model)
+        case ChunkedPandasEngine():
+            chunk = getattr(dataset, "batch_size", None) or engine.chunk_rows
+            chunks = max(-(-n // chunk), 1)
+            return _pandas_cost(stats, model) + chunks * (model.chunk_fixed + min(groups, chunk) * model.group)
+        case ParallelPandasEngine():
+            parts = min(engine.workers, max(n // max(engine.min_rows // 4, 1), 1))
+            if n < engine.min_rows or parts < 2: return _pandas_cost(stats, model)
+            return (_pandas_cost(stats, model) / parts + model.parallel_fixed
+                    + n * len(stats.columns) * model.parallel_share + parts * groups * model.group)
+        case PandasEngine():
+            return _pandas_cost(stats, model)
+        case _:
+            return None
+
+
+def _negated_columns(pred: PredicateExpr | None) -> set[str]:
+    """WHERE 中处于 NOT / != / NOT LIKE / NOT 正则 之下的列：pandas 把缺失值当作不满足内层条件而保留，SQL 得 NULL 而丢弃。"""
+    cols: set[str] = set()
+    stack = [pred] if pred is not None else []
+    while stack:
+        node = stack.pop()
+        if isinstance(node, SQLPredicate): node = node.as_inner()
+        match node:
+            case BoolOp(left, right, _):
+                stack += [left, right]
+            case NotOp(IsNull()):
+                pass
+            case NotOp(inner):
+                cols |= inner.dependencies()
+            case Cmp(_, _, "!=" | "<>"):
+                cols |= node.dependencies()
+            case LikePredicate(expr, _, _, True) | RegexPredicate(expr, _, _, True):
+                cols |= expr.dependencies()
+    return cols
+
+
+def _has_missing(dataset: Any, column: str) -> bool:
+    """列中是否有缺失值（NULL/NaN）；只看内存数据，Parquet / 分块数据源无法廉价判断，视为有。"""
+    if isinstance(dataset, ChunkedDataset): return True
+    if dataset._df is None and dataset.arrow is not None:
+        import pyarrow as pa  # type: ignore
+        import pyarrow.compute as pc  # type: ignore
+        if column not in dataset.arrow.schema.names: return True
+        arr = dataset.arrow.column(column)
+        return arr.null_count > 0 or (pa.types.is_floating(arr.type) and pc.any(pc.is_nan(arr)).as_py() is True)
+    return column not in dataset.df.columns or bool(dataset.df[column].hasnans)
+
+
+def _engine_rejection(engine: Engine, dataset: Any, spec: ReportSpec) -> str | None:
+    """engine 不能执行该报表的原因（数据源不匹配、缺少依赖、SQL 发射器不支持的构造、
+    与 pandas 结果不一致的 SQL 语义）；可执行时返回 None。"""
+    if isinstance(engine, DuckDBEngine):
+        if isinstance(dataset, ChunkedDataset) and not isinstance(dataset, ParquetDataset):
+            return "needs an in-memory or Parquet dataset"
+        try:
+            import duckdb  # type: ignore  # noqa: F401
+        except Exception as e:
+            return f"duckdb unavailable: {e}"
+        try:
+            engine.build_sql(dataset, spec)
+        except (NotImplementedError, ValueError, TypeError) as e:
+            return f"SQL emitter: {type(e).__name__}: {e}"
+        # 候选之间结果须一致、与行数无关：SQL 三值逻辑下 NOT/!= 遇 NULL 丢行，pandas 保留；
+        # COUNT(DISTINCT) 不计 NULL，pandas 的去重计数把缺失值算作一个值
+        nullable = sorted(c for c in _negated_columns(ensure_predicate(spec.where)) if _has_missing(dataset, c))
+        if nullable: return f"negated predicate over columns with missing values: {nullable}"
+        distinct = {c for m in _report_metrics(spec) if isinstance(m, AggMeasure)
+                    and isinstance(m.expr, (NUnique, ApproxNUnique)) for c in m.expr.dependencies()}
+        nullable = sorted(c for c in distinct if _has_missing(dataset, c))
+        if nullable: return f"distinct count over columns with missing values: {nullable}"
+        return None
+    if isinstance(engine, (PandasEngine, ParallelPandasEngine)) and isinstance(dataset, ChunkedDataset):
+        return "needs an in-memory dataset"
+    return None
+
+
+class AutoEngine(Engine):
+    """按代价估计在候选引擎中选最便宜的一个执行（默认 Pandas / DuckDB / 分块 Pandas）。
+
+    缺少依赖、SQL 发射器不支持的构造（自定义表达式等）或结果会与 pandas 不一致（见 _engine_rejection）
+    的候选不参与；执行期抛出 NotImplementedError 时依次改用次便宜的候选。每次选择记为 EngineDecision，
+    保存在 decisions（最近 history 条）。内存 Dataset 上的排序按 (报表指纹, 数据版本) 记住，不重复采样估计。
+    """
+    cube_routing = True
+
+    def __init__(self, engines: Sequence[Engine] | None = None, *, model: CostModel | None = None,
+                 history: int = 256, sample_rows: int = 20_000):
+        self.engines = list(engines) if engines is not None else [PandasEngine(), DuckDBEngine(),
+                                                                  ChunkedPandasEngine()]
+        self.model = model or CostModel()
+        self.sample_rows = sample_rows
+        self.decisions: deque[EngineDecision] = deque(maxlen=history)
+        self.cacheable = all(e.cacheable for e in self.engines)
+        # dataset -> (版本, {报表指纹: (审计记录, 排序后的候选)})；数据集释放后条目随之消失
+        self._ranked: weakref.WeakKeyDictionary[Any, tuple[int, dict[str, tuple]]] = weakref.WeakKeyDictionary()
+
+    @override
+    def identity(self) -> tuple: return (type(self).__qualname__, *(e.identity() for e in self.engines))
+
+    @property
+    def last_decision(self) -> EngineDecision | None: return self.decisions[-1] if self.decisions else None
+
+    def _labels(self) -> list[str]:
+        names = [type(e).__name__ for e in self.engines]
+        return [f"{n}#{i}" if names.count(n) > 1 else n for i, n in enumerate(names)]
+
+    def rank(self, dataset: Any, spec: ReportSpec, plan: Plan) -> tuple[EngineDecision, list[tuple[str, Engine]]]:
+        """(审计记录, 按估计代价升序的可用候选)；不执行报表。内存 Dataset 上按 (指纹, 版本) 复用此前的结果。"""
+        try:
+            fingerprint = spec.fingerprint()
+        except TypeError:
+            fingerprint = None
+        version = getattr(dataset, "version", None)
+        if fingerprint is None or version is None:
+            return self._rank(dataset, spec, plan, fingerprint)
+        seen_version, memo = self._ranked.get(dataset, (None, {}))
+        if seen_version != version:
+            memo = {}
+            self._ranked[dataset] = (version, memo)
+        if fingerprint not in memo:
+            memo[fingerprint] = self._rank(dataset, spec, plan, fingerprint)
+        decision, ranked = memo[fingerprint]
+        return dc_replace(decision, fallback=[]), ranked  # execute 会改写审计记录：每次给一份新的
+
+    def _rank(self, dataset: Any, spec: ReportSpec, plan: Plan,
+              fingerprint: str | None) -> tuple[EngineDecision, list[tuple[str, Engine]]]:
+        stats = workload_stats(dataset, spec, plan, sample_rows=self.sample_rows)
+        costs: dict[str, float] = {}
+        rejected: dict[str, str] = {}
+        ranked: list[tuple[float, int, str, Engine]] = []
+        for i, (name, engine) in enumerate(zip(self._labels(), self.engines)):
+            if (reason := _engine_rejection(engine, dataset, spec)) is not None:
+                rejected[name] = reason
+            elif (cost := estimate_cost(engine, stats, self.model, dataset)) is None:
+                rejected[name] = "no cost model"
+            else:
+                costs[name] = cost
+                ranked.append((cost, i, name, engine))
+        if not ranked:
+            raise RuntimeError(f"AutoEngine: no candidate engine can run this report: {rejected}")
+        ranked.sort(key=lambda x: (x[0], x[1]))
+        decision = EngineDecision(ranked[0][2], costs, rejected, stats, fingerprint)
+        return decision, [(name, engine) for _, _, name, engine in ranked]
+
+    @override
+    def execute(self, dataset: Any, spec: ReportSpec, plan: Plan) -> PivotResult:
+        decision, ranked = self.rank(dataset, spec, plan)
+        self.decisions.append(decision)
+        t0 = time.perf_counter()
+        for name, engine in ranked[:-1]:
+            try:
+                result = engine.execute(dataset, spec, plan)
+            except NotImplementedError as e:  # 发射器之外的未实现路径：换次便宜的候选
+                decision.fallback.append(f"{name}: {e}")
+                continue
+            decision.engine, decision.seconds = name, time.perf_counter() - t0
+            return result
+        name, engine = ranked[-1]
+        result = engine.execute(dataset, spec, plan)
+        decision.engine, decision.seconds = name, time.perf_counter() - t0
+        return result
+
+    @override
+    def explain(self, dataset: Any, spec: ReportSpec, plan: Plan) -> PlanNode:
+        decision, ranked = self.rank(dataset, spec, plan)
+        root = ranked[0][1].explain(dataset, spec, plan)
+        root.detail["auto"] = {name: f"{cost * 1e3:.1f}ms" for name, cost in decision.costs.items()}
+        if decision.rejected: root.detail["rejected"] = decision.rejected
+        return root
 
 
 # ========= 8) 旧接口适配（可选保留） =========
@@ -1664,9 +4842,11 @@ def aggexpr_to_dict(a: AggExpr) -> dict[str, Any]:
         case Max(expr):
             return {"kind": "max", "expr": scalar_to_dict(expr)}
         case Count(expr):
-            return {"kind": "count", "expr": (scalar_to_dict(expr.expr) if expr.expr is not None else None)}
+            return {"kind": "count", "expr": (scalar_to_dict(expr) if expr is not None else None)}
         case NUnique(expr):
             return {"kind": "nunique", "expr": scalar_to_dict(expr)}
+        case ApproxNUnique(expr, error):
+            return {"kind": "approx_nunique", "expr": scalar_to_dict(expr), "error": error}
         case RatioOfSums(num, den, fill):
             return {"kind": "ratio_of_sums", "numerator": scalar_to_dict(num), "denominator": scalar_to_dict(den),
                     "fill": fill}
@@ -1684,16 +4864,48 @@ def aggexpr_from_dict(d: Mapping[str, Any]) -> AggExpr:
         expr_json = d.get("expr")
         return Count(None if expr_json is None else scalar_from_dict(expr_json))
     if kind == "nunique": return NUnique(scalar_from_dict(d["expr"]))
+    if kind == "approx_nunique": return ApproxNUnique(scalar_from_dict(d["expr"]), d.get("error", 0.0163))
     if kind == "ratio_of_sums":
         return RatioOfSums(scalar_from_dict(d["numerator"]), scalar_from_dict(d["denominator"]), d.get("fill", 0.0))
     raise ValueError(f"Unknown agg kind: {kind}")
 
 
+def windowexpr_to_dict(w: WindowExpr) -> dict[str, Any]:
+    match w:
+        case PeriodDelta(source, offset, pct, order_by):
+            return {"kind": "period_delta", "source": source, "offset": offset, "pct": pct, "order_by": order_by}
+        case Lead(source, offset, order_by):
+            return {"kind": "lead", "source": source, "offset": offset, "order_by": order_by}
+        case Lag(source, offset, order_by):
+            return {"kind": "lag", "source": source, "offset": offset, "order_by": order_by}
+        case RollingMean(source, periods, order_by):
+            return {"kind": "rolling_mean", "source": source, "periods": periods, "order_by": order_by}
+        case RollingSum(source, periods, order_by):
+            return {"kind": "rolling_sum", "source": source, "periods": periods, "order_by": order_by}
+        case CumSum(source, order_by):
+            return {"kind": "cumsum", "source": source, "order_by": order_by}
+        case _:
+            raise TypeError(f"Cannot serialize WindowExpr: {type(w)}")
+
+
+def windowexpr_from_dict(d: Mapping[str, Any]) -> WindowExpr:
+    kind, source, order_by = d["kind"], d["source"], d.get("order_by")
+    if kind == "rolling_sum": return RollingSum(source, d["periods"], order_by)
+    if kind == "rolling_mean": return RollingMean(source, d["periods"], order_by)
+    if kind == "cumsum": return CumSum(source, order_by)
+    if kind == "lag": return Lag(source, d.get("offset", 1), order_by)
+    if kind == "lead": return Lead(source, d.get("offset", 1), order_by)
+    if kind == "period_delta": return PeriodDelta(source, d.get("offset", 1), d.get("pct", False), order_by)
+    raise ValueError(f"Unknown window kind: {kind}")
+
+
 def measure_to_dict(m: Measure) -> dict[str, Any]:
     if isinstance(m, RowMeasure):
         return {"type": "row_measure", "name": m.name, "agg": m.agg, "expr": scalar_to_dict(m.expr)}
     if isinstance(m, AggMeasure):
         return {"type": "agg_measure", "name": m.name, "agg_expr": aggexpr_to_dict(m.expr)}
+    if isinstance(m, WindowMeasure):
+        return {"type": "window_measure", "name": m.name, "window": windowexpr_to_dict(m.expr)}
     raise TypeError(f"Cannot serialize Measure: {type(m)}")
 
 
@@ -1703,6 +4915,8 @@ def measure_from_dict(d: Mapping[str, Any]) -> Measure:
         return RowMeasure(d["name"], scalar_from_dict(d["expr"]), agg=d.get("agg", "mean"))
     if t == "agg_measure":
         return AggMeasure(d["name"], aggexpr_from_dict(d["agg_expr"]))
+    if t == "window_measure":
+        return WindowMeasure(d["name"], windowexpr_from_dict(d["window"]))
     raise ValueError(f"Unknown measure type: {t}")
 
 
@@ -1782,3 +4996,17 @@ if __name__ == "__main__":
     spec2 = ReportSpec.from_dict(spec_json)
     assert json.dumps(spec2.to_dict(), sort_keys=True) == json.dumps(spec_json, sort_keys=True)
     print("ReportSpec (de)serialization OK.")
+
+    # --- Parquet 数据集的 EXPLAIN / EXPLAIN ANALYZE（需要 pyarrow） ---
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        pyarrow = None
+    if pyarrow is not None:
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            data.to_parquet(f"{tmp}/ads.parquet", index=False)
+            pq_dataset = ParquetDataset(f"{tmp}/ads.parquet")
+            print("\n" + pq_dataset.explain(spec).render())
+            print(pq_dataset.explain(spec, analyze=True, memory=False).render())
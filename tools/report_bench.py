@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+report_bench.py
+---------------
+report.py 各引擎的基准测试：合成 Ads 形态数据（1e4 – 1e8 行）× 固定报表目录 × 引擎，
+每个用例记录耗时（预热后取 repeat 次）、峰值 RSS 与 rows/sec，输出 JSON 便于跨提交对比。
+
+    python tools/report_bench.py --rows 1e4,1e5,1e6 --engines pandas,duckdb --out bench.json
+    python tools/report_bench.py --rows 1e6 --compare bench.json          # 与基线对比，回退时退出码 1
+    python tools/report_bench.py --rows 1e8 --parquet /data/ads_bench     # 大数据量：落盘 Parquet，分块/DuckDB 扫描
+
+合成数据按行序对应日期（与按日导出的报表一致），维度基数：Campaign 随行数增长（20 – 500，Zipf 偏斜）、
+每个 Campaign 约 12 个 Ad Group、Device 4 个、Country 60 个（头部集中）、Date 730 天。
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from report import (AggMeasure, ApproxNUnique, AutoEngine, ChunkedPandasEngine, Dataset, Dimension, DuckDBEngine,
+                    Engine, NUnique, PandasEngine, ParallelPandasEngine, ParquetDataset, Planner, RatioOfSums,
+                    ReportSpec, SQLPredicate, SortBy, Sum, col, lit)
+
+# ========= 0) 合成 Ads 数据 =========
+CAMPAIGN_TYPES = ["Brand", "Generic", "Competitor", "Shopping", "PMax", "Display"]
+REGIONS = ["NA", "EMEA", "APAC", "LATAM"]
+THEMES = ["Shoes", "Boots", "Sneakers", "Sandals", "Jackets", "Coats", "Hats", "Bags", "Socks", "Belts",
+          "Watches", "Sunglasses"]
+MATCH_TYPES = ["Exact", "Phrase", "Broad"]
+DEVICES = ["Mobile devices with full browsers", "Computers", "Tablets with full browsers", "TV screens"]
+DEVICE_WEIGHTS = [0.58, 0.36, 0.05, 0.01]
+N_COUNTRIES = 60
+DAYS = 730
+START = np.datetime64("2024-01-01")
+
+
+class AdsUniverse:
+    """维度取值全集（由 rows 与 seed 决定）：分块生成时各块共用，保证全量与分块数据一致。"""
+
+    def __init__(self, rows: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        n_campaigns = int(np.clip(rows // 2_000, 20, 500))
+        self.campaigns = np.array([f"{CAMPAIGN_TYPES[i % len(CAMPAIGN_TYPES)]} | {REGIONS[(i // 6) % len(REGIONS)]}"
+                                   f" | {THEMES[rng.integers(len(THEMES))]} #{i}" for i in range(n_campaigns)],
+                                  dtype=object)
+        # Campaign 流量 Zipf 偏斜；每个 Campaign 1 – 40 个 Ad Group（均值约 12）
+        w = 1.0 / np.arange(1, n_campaigns + 1) ** 1.1
+        self.campaign_p = rng.permutation(w / w.sum())
+        self.ag_count = np.clip(rng.poisson(12, n_campaigns), 1, 40)
+        self.ag_offset = np.concatenate([[0], np.cumsum(self.ag_count)[:-1]])
+        self.ad_groups = np.array([f"{THEMES[rng.integers(len(THEMES))]} - {MATCH_TYPES[k % 3]} #{c}.{k}"
+                                   for c, n in enumerate(self.ag_count) for k in range(n)], dtype=object)
+        self.countries = np.array(["US", "GB", "DE", "FR", "CA", "AU", "JP", "IN", "BR", "MX"]
+                                  + [f"C{i:02d}" for i in range(N_COUNTRIES - 10)], dtype=object)
+        w = 1.0 / np.arange(1, N_COUNTRIES + 1) ** 1.3
+        self.country_p = w / w.sum()
+        self.ctr = rng.uniform(0.01, 0.08, n_campaigns)  # 每个 Campaign 自己的 CTR / CPC / CVR
+        self.cpc = rng.lognormal(0.0, 0.5, n_campaigns)
+        self.cvr = rng.uniform(0.01, 0.06, n_campaigns)
+
+
+def ads_chunk(u: AdsUniverse, rows: int, start: int, stop: int, *, seed: int = 0,
+              encode: bool = False) -> pd.DataFrame:
+    """第 [start, stop) 行：日期随行号单调递增；encode=True 时维度列为分类列，否则为字符串（同 CSV 读入）。"""
+    rng = np.random.default_rng([seed, start])
+    n = stop - start
+    day = np.arange(start, stop, dtype=np.int64) * DAYS // max(rows, 1)
+    camp = rng.choice(len(u.campaigns), n, p=u.campaign_p)
+    ag = u.ag_offset[camp] + (rng.random(n) * u.ag_count[camp]).astype(np.int64)
+    dev = rng.choice(len(DEVICES), n, p=DEVICE_WEIGHTS)
+    ctry = rng.choice(N_COUNTRIES, n, p=u.country_p)
+    weekly = 1.0 + 0.25 * np.sin(2 * np.pi * day / 7)
+    impr = np.maximum(rng.lognormal(4.0, 1.2, n) * weekly, 1).astype(np.int64)
+    clicks = rng.binomial(impr, u.ctr[camp])
+    cost = np.round(clicks * u.cpc[camp] * rng.uniform(0.8, 1.2, n), 2)
+    conv = rng.binomial(clicks, u.cvr[camp]).astype(np.float64)
+    revenue = np.round(conv * rng.lognormal(4.0, 0.6, n), 2)
+
+    def dim(values: np.ndarray, codes: np.ndarray) -> Any:
+        cat = pd.Categorical.from_codes(codes, categories=pd.Index(values, dtype=object))
+        return cat if encode else pd.Series(values[codes], dtype=object)
+
+    return pd.DataFrame({
+        "Date": START + day.astype("m8[D]"),
+        "Campaign": dim(u.campaigns, camp),
+        "Ad Group": dim(u.ad_groups, ag),
+        "Device": dim(np.array(DEVICES, dtype=object), dev),
+        "Country": dim(u.countries, ctry),
+        "Impressions": impr,
+        "Clicks": clicks,
+        "Cost": cost,
+        "Conversions": conv,
+        "Revenue": revenue,
+    })
+
+
+def ads_chunks(rows: int, *, seed: int = 0, chunk_rows: int = 1_000_000,
+               encode: bool = False) -> Iterator[pd.DataFrame]:
+    u = AdsUniverse(rows, seed)
+    for start in range(0, rows, chunk_rows):
+        yield ads_chunk(u, rows, start, min(start + chunk_rows, rows), seed=seed, encode=encode)
+
+
+def ads_frame(rows: int, *, seed: int = 0, encode: bool = False) -> pd.DataFrame:
+    parts = list(ads_chunks(rows, seed=seed, encode=encode))
+    if len(parts) == 1: return parts[0]
+    if encode:  # 各块字典相同（取自同一全集），拼接后仍是分类列
+        return pd.DataFrame({c: (pd.Categorical.from_codes(np.concatenate([p[c].cat.codes for p in parts]),
+                                                           categories=parts[0][c].cat.categories)
+                                 if isinstance(parts[0][c].dtype, pd.CategoricalDtype)
+                                 else np.concatenate([p[c].to_numpy() for p in parts]))
+                             for c in parts[0].columns})
+    return pd.concat(parts, ignore_index=True)
+
+
+def write_parquet(root: Path, rows: int, *, seed: int = 0, row_group_size: int = 131_072) -> Path:
+    """分块落盘（每块一个文件，按日期有序，行组统计可用于裁剪）；目录已存在时直接复用。"""
+    try:
+        import pyarrow as pa  # type: ignore
+        import pyarrow.parquet as pq  # type: ignore
+    except Exception as e:
+        raise RuntimeError("请先 `pip install pyarrow` 再使用 --parquet") from e
+    path = root / f"ads_rows={rows}_seed={seed}"
+    done = path / "_SUCCESS"
+    if done.exists(): return path
+    path.mkdir(parents=True, exist_ok=True)
+    for i, chunk in enumerate(ads_chunks(rows, seed=seed)):
+        pq.write_table(pa.Table.from_pandas(chunk, preserve_index=False), path / f"part-{i:05d}.parquet",
+                       row_group_size=row_group_size)
+    done.touch()
+    return path
+
+
+# ========= 1) 报表目录（固定；新增用例只追加，不改已有用例，保证跨提交可比） =========
+def catalogue() -> dict[str, ReportSpec]:
+    campaign, ad_group, device, country = (Dimension("Campaign"), Dimension("Ad Group"), Dimension("Device"),
+                                           Dimension("Country"))
+    clicks = AggMeasure("Clicks", Sum("Clicks"))
+    impr = AggMeasure("Impressions", Sum("Impressions"))
+    cost = AggMeasure("Cost", Sum("Cost"))
+    conv = AggMeasure("Conversions", Sum("Conversions"))
+    ctr = AggMeasure("CTR", RatioOfSums("Clicks", "Impressions", 0))
+    cpc = AggMeasure("CPC", RatioOfSums("Cost", "Clicks", 0))
+    cpa = AggMeasure("CPA", RatioOfSums("Cost", "Conversions", 0))
+    roas = AggMeasure("ROAS", RatioOfSums("Revenue", "Cost", 0))
+    return {
+        # 账户概览：全部 KPI + 总计行
+        "campaign_kpis": ReportSpec(rows=[campaign], columns=[],
+                                    metrics=[impr, clicks, cost, conv, ctr, cpc, cpa, roas],
+                                    sort_by=[SortBy("Cost")], totals=True),
+        # 宽透视：Country × Device 展开成数百列
+        "wide_pivot": ReportSpec(rows=[campaign], columns=[country, device], metrics=[clicks, cost, ctr]),
+        # 切片：每个 Device 一张 Ad Group 表，各取 Top 25
+        "adgroup_slicer_topn": ReportSpec(rows=[ad_group], columns=[], slicers=[device], metrics=[clicks, cost, conv],
+                                          sort_by=[SortBy("Conversions")], topn=25),
+        # LIKE 前缀 + IN
+        "like_brand": ReportSpec(rows=[campaign], columns=[device], metrics=[clicks, cost, roas],
+                                 where=SQLPredicate("Campaign LIKE 'Brand%' AND Country IN ('US', 'GB', 'DE')")),
+        # 正则（不区分大小写）
+        "regex_adgroup": ReportSpec(rows=[country], columns=[], metrics=[clicks, cost, cpa],
+                                    where=col("Ad Group").regex(lit(r"(?:shoes|boots) - exact"), flags="i")),
+        # 月粒度趋势
+        "monthly_trend": ReportSpec(rows=[campaign], columns=[Dimension("Date", time_grain="month")],
+                                    metrics=[cost, roas]),
+        # 周粒度列 + 分组集上卷（Country -> Device 各级小计）
+        "weekly_rollup": ReportSpec(rows=[country, device], columns=[Dimension("Date", time_grain="week")],
+                                    metrics=[clicks, cost], grouping="rollup"),
+        # 日粒度 + HAVING + Top N
+        "daily_topn": ReportSpec(rows=[Dimension("Date", time_grain="day")], columns=[], metrics=[clicks, cost, cpa],
+                                 having=SQLPredicate("Clicks > 0"), sort_by=[SortBy("Cost")], topn=30),
+        # 去重计数（精确 + HLL）
+        "country_reach": ReportSpec(rows=[country], columns=[],
+                                    metrics=[AggMeasure("Campaigns", NUnique("Campaign")),
+                                             AggMeasure("Ad Groups", ApproxNUnique("Ad Group")), cost],
+                                    totals=True),
+    }
+
+
+ENGINES: dict[str, Callable[[], Engine]] = {
+    "pandas": PandasEngine,
+    "chunked": ChunkedPandasEngine,
+    "parallel": ParallelPandasEngine,
+    "duckdb": DuckDBEngine,
+    "auto": AutoEngine,
+}
+PARQUET_ENGINES = {"chunked", "duckdb", "auto"}  # ParquetDataset 不整体载入内存
+
+
+def _engine_missing(name: str) -> str | None:
+    """引擎的可选依赖缺失时返回原因（用例记为 skipped）。"""
+    if name != "duckdb": return None
+    try:
+        import duckdb  # type: ignore  # noqa: F401
+    except Exception as e:
+        return f"duckdb unavailable: {e}"
+    return None
+
+
+# ========= 2) 计量 =========
+def _reset_peak_rss() -> bool:
+    """Linux：写 /proc/self/clear_refs 重置 VmHWM，使每个用例的峰值互不影响；其他平台只能取进程级峰值。"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"): return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # macOS 为字节，Linux 为 KiB
+
+
+def run_case(dataset: Any, spec: ReportSpec, engine: Engine, rows: int, *, repeat: int = 3,
+             warmup: int = 1) -> dict[str, Any]:
+    """预热后执行 repeat 次（直接走 Planner，不经结果缓存）；rows_per_sec 按最快一次计。"""
+    planner = Planner(engine)
+    gc.collect()
+    reset = _reset_peak_rss()
+    out_rows = 0
+    warm: list[float] = []
+    times: list[float] = []
+    for i in range(warmup + repeat):
+        t0 = time.perf_counter()
+        result = planner.run(dataset, spec)
+        (warm if i < warmup else times).append(time.perf_counter() - t0)
+        out_rows = sum(len(f) for f in result.frames.values())
+        del result
+    best = min(times)
+    return {"warmup_seconds": warm, "seconds": times, "best": best, "median": float(np.median(times)),
+            "rows_per_sec": rows / best if best > 0 else None, "peak_rss_bytes": _peak_rss(),
+            "peak_rss_per_case": reset, "out_rows": out_rows}
+
+
+def _git_revision() -> dict[str, Any]:
+    here = Path(__file__).resolve().parent
+    try:
+        rev = subprocess.run(["git", "rev-parse", "HEAD"], cwd=here, capture_output=True, text=True, check=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "."], cwd=here, capture_output=True, text=True)
+        return {"commit": rev.stdout.strip(), "dirty": bool(dirty.stdout.strip())}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def _versions() -> dict[str, str | None]:
+    out: dict[str, str | None] = {"python": platform.python_version(), "pandas": pd.__version__,
+                                  "numpy": np.__version__}
+    for mod in ("pyarrow", "duckdb", "numexpr"):
+        try:
+            out[mod] = __import__(mod).__version__
+        except Exception:
+            out[mod] = None
+    return out
+
+
+def run_suite(sizes: list[int], engines: list[str], specs: dict[str, ReportSpec], *, repeat: int, warmup: int,
+              seed: int, encode: bool, parquet: Path | None, log: Callable[[str], None]) -> dict[str, Any]:
+    results: list[dict[str, Any]] = []
+    for rows in sizes:
+        t0 = time.perf_counter()
+        if parquet is not None:
+            dataset: Any = ParquetDataset(str(write_parquet(parquet, rows, seed=seed)))
+        else:
+            dataset = Dataset(ads_frame(rows, seed=seed, encode=encode), cache_bytes=None)
+        build = time.perf_counter() - t0
+        log(f"rows={rows:,}  data ready in {build:.2f}s")
+        for engine_name in engines:
+            base = {"rows": rows, "engine": engine_name, "source": "parquet" if parquet is not None else "memory"}
+            reason = _engine_missing(engine_name)
+            if reason is None and parquet is not None and engine_name not in PARQUET_ENGINES:
+                reason = "engine needs an in-memory DataFrame"
+            if reason is not None: log(f"  {engine_name:<8} skipped: {reason}")
+            engine = None if reason is not None else ENGINES[engine_name]()  # 同一引擎跨用例复用（进程池等）
+            for spec_name, spec in specs.items():
+                case = {**base, "spec": spec_name, "data_seconds": build}
+                if reason is not None:
+                    results.append({**case, "skipped": reason})
+                    continue
+                try:
+                    case.update(run_case(dataset, spec, engine, rows, repeat=repeat, warmup=warmup))
+                except Exception as e:  # 记录失败用例，不中断整轮
+                    case["error"] = f"{type(e).__name__}: {e}"
+                if isinstance(engine, AutoEngine) and engine.last_decision is not None:
+                    case["chosen"] = engine.last_decision.engine  # 审计：AutoEngine 实际选用的引擎
+                results.append(case)
+                log(f"  {engine_name:<8} {spec_name:<22} "
+                    + (f"best={case['best'] * 1e3:9.1f}ms  {case['rows_per_sec']:>14,.0f} rows/s  "
+                       f"rss={case['peak_rss_bytes'] / 2 ** 20:8.1f}MiB" if "best" in case else case.get("error", "")))
+            if isinstance(engine, ParallelPandasEngine): engine.close()
+        del dataset
+    return {
+        "meta": {"timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"), **_git_revision(),
+                 "versions": _versions(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                 "repeat": repeat, "warmup": warmup, "seed": seed, "encode": encode,
+                 "source": "parquet" if parquet is not None else "memory"},
+        "results": results,
+    }
+
+
+# ========= 3) 对比 =========
+def compare(current: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[dict[str, Any]]:
+    """按 (rows, engine, spec, source) 对齐，best 耗时比值超过 threshold 的为回退。"""
+    def key(r: dict[str, Any]) -> tuple: return (r["rows"], r["engine"], r["spec"], r.get("source", "memory"))
+
+    base = {key(r): r for r in baseline["results"] if "best" in r}
+    rows: list[dict[str, Any]] = []
+    for r in current["results"]:
+        b = base.get(key(r))
+        if b is None or "best" not in r: continue
+        ratio = r["best"] / b["best"] if b["best"] > 0 else float("inf")
+        rows.append({"rows": r["rows"], "engine": r["engine"], "spec": r["spec"], "baseline": b["best"],
+                     "current": r["best"], "ratio": ratio, "regressed": ratio > threshold})
+    return rows
+
+
+def _parse_sizes(text: str) -> list[int]:
+    sizes = [int(float(s)) for s in text.split(",") if s.strip()]
+    if not sizes or min(sizes) <= 0: raise argparse.ArgumentTypeError("--rows expects positive counts like 1e4,1e6")
+    return sizes
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark report.py engines on synthetic Ads data.")
+    ap.add_argument("--rows", type=_parse_sizes, default=[10_000, 100_000, 1_000_000],
+                    help="comma separated row counts, e.g. 1e4,1e5,1e6 (up to 1e8)")
+    ap.add_argument("--engines", default="pandas,duckdb", help=f"subset of {','.join(ENGINES)}")
+    ap.add_argument("--specs", default=None, help="subset of the catalogue (default: all)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--warmup", type=int, default=1)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--encode", action="store_true", help="dictionary-encode dimension columns (categoricals)")
+    ap.add_argument("--parquet", type=Path, default=None,
+                    help="write data as Parquet under this directory and scan it (chunked/duckdb engines)")
+    ap.add_argument("--out", type=Path, default=None, help="JSON output file (default: stdout)")
+    ap.add_argument("--compare", type=Path, default=None, help="baseline JSON to compare against")
+    ap.add_argument("--threshold", type=float, default=1.10, help="best-time ratio counted as a regression")
+    args = ap.parse_args(argv)
+
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    if unknown := [e for e in engines if e not in ENGINES]: ap.error(f"unknown engines: {unknown}")
+    specs = catalogue()
+    if args.specs:
+        names = [s.strip() for s in args.specs.split(",") if s.strip()]
+        if unknown := [s for s in names if s not in specs]: ap.error(f"unknown specs: {unknown}")
+        specs = {s: specs[s] for s in names}
+
+    def log(msg: str) -> None: print(msg, file=sys.stderr, flush=True)
+
+    report = run_suite(args.rows, engines, specs, repeat=args.repeat, warmup=args.warmup, seed=args.seed,
+                       encode=args.encode, parquet=args.parquet, log=log)
+    if args.compare is not None:
+        report["comparison"] = compare(report, json.loads(args.compare.read_text()), args.threshold)
+        for c in report["comparison"]:
+            log(f"{'REGRESSED' if c['regressed'] else 'ok':<9} rows={c['rows']:<10,} {c['engine']:<8} "
+                f"{c['spec']:<22} {c['baseline'] * 1e3:9.1f}ms -> {c['current'] * 1e3:9.1f}ms  x{c['ratio']:.2f}")
+
+    text = json.dumps(report, indent=2)
+    if args.out is not None:
+        args.out.write_text(text + "\n")
+    else:
+        print(text)
+    return 1 if any(c["regressed"] for c in report.get("comparison", [])) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
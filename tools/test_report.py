@@ -0,0 +1,325 @@
+"""
+test_report.py
+--------------
+report.py 的回归测试（pytest）：表达式语义、跨引擎一致性、增量/分块状态与数据源。
+
+    python -m pytest -q tools/test_report.py
+
+DuckDB / pyarrow 为可选依赖，未安装时相关用例跳过。
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import report
+from report import (AggMeasure, ApproxNUnique, AutoEngine, Avg, CaseWhen, ChunkedDataset, ChunkedPandasEngine, Count,
+                    Dataset, Dialect, Dimension, DuckDBEngine, FieldRole, Max, NUnique, PandasEngine,
+                    ParallelPandasEngine, ParquetDataset, Planner, RatioOfSums, ReportSpec, SQLEmitter, Sum, _hash64,
+                    col, lit, sql_duckdb)
+
+
+@pytest.fixture
+def ads() -> pd.DataFrame:
+    """与 report.py 末尾 Demo 相同的小样例。"""
+    return pd.DataFrame({
+        "Campaign": ["A", "A", "A", "B", "B", "B"] * 2,
+        "Device": ["Mobile", "Desktop", "Tablet"] * 4,
+        "Date": pd.to_datetime(["2025-05-01"] * 6 + ["2025-06-01"] * 6),
+        "Country": ["US", "US", "US", "CA", "CA", "CA", "US", "US", "US", "CA", "CA", "CA"],
+        "clicks": [100, 80, 20, 60, 40, 10, 150, 90, 30, 70, 50, 20],
+        "impr": [500, 400, 100, 300, 200, 50, 700, 500, 150, 350, 250, 60],
+        "cost": [80, 64, 16, 48, 32, 8, 120, 72, 24, 56, 40, 16],
+        "revenue": [200, 160, 40, 120, 80, 20, 300, 200, 60, 140, 100, 40],
+    })
+
+
+# ---- CaseWhen ----
+def test_case_when_string_result_compares_outside_labels(ads: pd.DataFrame) -> None:
+    bucket = CaseWhen([(col("clicks") > 100, lit("z"))], lit("a"))
+    assert bucket.eval(ads).dtype == object
+    assert (bucket < lit("m")).eval(ads).tolist() == (ads["clicks"] <= 100).tolist()
+
+
+def test_case_when_string_result_fills_new_label(ads: pd.DataFrame) -> None:
+    out = CaseWhen([(col("clicks") > 100, lit("z"))]).eval(ads).fillna("other")
+    assert out.tolist() == np.where(ads["clicks"] > 100, "z", "other").tolist()
+
+
+def test_case_when_numeric_branches_stay_numeric(ads: pd.DataFrame) -> None:
+    out = CaseWhen([(col("clicks") > 100, lit(2)), (col("clicks") > 50, lit(1))], lit(0)).eval(ads)
+    assert pd.api.types.is_integer_dtype(out.dtype)
+    assert out.tolist() == np.select([ads["clicks"] > 100, ads["clicks"] > 50], [2, 1], 0).tolist()
+
+
+# ---- Dataset 结果缓存 ----
+def _clicks_by_campaign() -> ReportSpec:
+    return ReportSpec(rows=[Dimension("Campaign", role=FieldRole.ROW)], columns=[],
+                      metrics=[AggMeasure("Clicks", Sum("clicks"))])
+
+
+def test_cache_hit_returns_independent_copy(ads: pd.DataFrame) -> None:
+    ds, spec = Dataset(ads.copy()), _clicks_by_campaign()
+    first = ds.report(spec).single()
+    expected = first.copy()
+    first.iloc[:, :] = -1
+    again = ds.report(spec).single()
+    assert ds.cache.hits == 1
+    pd.testing.assert_frame_equal(again, expected)
+
+
+def test_inplace_edit_invalidates_cache_and_index(ads: pd.DataFrame) -> None:
+    ds, spec = Dataset(ads.copy()), _clicks_by_campaign()
+    ds.create_index("clicks", "zonemap", block_rows=4)
+    where = ReportSpec(rows=spec.rows, columns=[], metrics=spec.metrics, where=col("clicks") > 1000)
+    assert ds.report(where).single().empty
+    before = ds.report(spec).single()
+    version = ds.version
+    ds.df.loc[0, "clicks"] = 5000
+    if int(pd.__version__.split(".")[0]) < 3 and not pd.options.mode.copy_on_write:
+        ds.invalidate()  # 未开启 Copy-on-Write 时原地改值无法察觉
+    after = ds.report(spec).single()
+    assert ds.version > version
+    assert after.iloc[0, 0] == before.iloc[0, 0] - ads.loc[0, "clicks"] + 5000
+    assert not ds.report(where).single().empty
+
+
+def test_column_assignment_and_row_drop_invalidate(ads: pd.DataFrame) -> None:
+    ds, spec = Dataset(ads.copy()), _clicks_by_campaign()
+    ds.report(spec)
+    ds.df["clicks"] = ds.df["clicks"] * 2
+    assert ds.report(spec).single().iloc[:, 0].sum() == 2 * ads["clicks"].sum()
+    ds.df.drop(index=[0, 1], inplace=True)
+    assert ds.report(spec).single().iloc[:, 0].sum() == 2 * ads["clicks"].iloc[2:].sum()
+
+
+# ---- 物化报表：append 与整帧重算一致 ----
+def _mixed_spec() -> ReportSpec:
+    return ReportSpec(
+        rows=[Dimension("Campaign", role=FieldRole.ROW)], columns=[Dimension("Device", role=FieldRole.COLUMN)],
+        metrics=[AggMeasure("Clicks", Sum("clicks")), AggMeasure("AvgCost", Avg("cost")),
+                 AggMeasure("MaxImpr", Max("impr")), AggMeasure("Countries", NUnique("Country")),
+                 AggMeasure("CTR", RatioOfSums("clicks", "impr", 0))],
+        where=col("impr") > 50, totals=True)
+
+
+def test_materialized_append_matches_recompute(ads: pd.DataFrame) -> None:
+    ds = Dataset(ads.iloc[:7].reset_index(drop=True))
+    mr = ds.materialize(_mixed_spec())
+    ds.append(ads.iloc[7:10])
+    ds.append(pd.DataFrame({**ads.iloc[10:].to_dict("list"), "Campaign": ["C", "C"], "Country": ["MX", "MX"]}))
+    fresh = Dataset(ds.df.copy()).report(_mixed_spec())
+    pd.testing.assert_frame_equal(mr.result().single(), fresh.single())
+
+
+def test_materialized_refreshes_after_df_replaced(ads: pd.DataFrame) -> None:
+    ds = Dataset(ads.copy())
+    mr = ds.materialize(_mixed_spec())
+    ds.df = ads.iloc[::2].reset_index(drop=True)
+    ds.append(ads.iloc[1::2])
+    fresh = Dataset(ds.df.copy()).report(_mixed_spec())
+    pd.testing.assert_frame_equal(mr.result().single(), fresh.single())
+
+
+# ---- 去重计数：HLL 误差界与大整数 ID ----
+def _distinct_spec(error: float = 0.0163) -> ReportSpec:
+    return ReportSpec(rows=[Dimension("g", role=FieldRole.ROW)], columns=[],
+                      metrics=[AggMeasure("Users", ApproxNUnique("uid", error)), AggMeasure("Exact", NUnique("uid"))])
+
+
+@pytest.mark.parametrize("error", [0.0163, 0.05])
+def test_hll_within_error_bound(error: float) -> None:
+    rng = np.random.default_rng(7)
+    df = pd.DataFrame({"g": rng.integers(0, 4, 200_000), "uid": rng.integers(0, 60_000, 200_000)})
+    out = Dataset(df).report(_distinct_spec(error)).single()
+    rel = (out["Users"] / out["Exact"] - 1).abs()
+    assert (rel < 4 * error).all(), rel  # 4 倍标准误差
+
+
+@pytest.mark.parametrize("as_float", [False, True])
+def test_hll_distinguishes_ids_beyond_float53(as_float: bool) -> None:
+    uid = pd.Series(2 ** 60 + np.arange(100_000, dtype=np.int64))
+    df = pd.DataFrame({"g": 0, "uid": uid})
+    if as_float:
+        df["uid"] = df["uid"].astype(object).where(df.index % 1000 != 0, None)  # NaN 把分块变成 object/float 的情形
+    est = Dataset(df).report(_distinct_spec()).single()["Users"].iloc[0]
+    assert abs(est / 100_000 - 1) < 0.07
+
+
+def test_big_ids_hash_identically_across_chunk_dtypes() -> None:
+    ids = 2 ** 60 + np.arange(5, dtype=np.int64)
+    as_int = _hash64(pd.Series(ids))
+    assert (_hash64(pd.Series(ids.tolist() + [None], dtype=object))[:5] == as_int).all()
+    assert (_hash64(pd.Series(ids, dtype="Int64")) == as_int).all()
+    assert (_hash64(pd.Series([1.0, 2.0, np.nan])) == _hash64(pd.Series([1, 2, None], dtype="Int64"))).all()
+
+
+def test_chunked_nunique_falls_back_to_hll_with_big_ids(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(report, "NUNIQUE_EXACT_LIMIT", 1_000)
+    uid = 2 ** 60 + np.arange(60_000, dtype=np.int64)
+    df = pd.DataFrame({"g": np.arange(60_000) % 2, "uid": uid})
+    spec = ReportSpec(rows=[Dimension("g", role=FieldRole.ROW)], columns=[],
+                      metrics=[AggMeasure("Exact", NUnique("uid"))])
+    chunks = [df.iloc[i:i + 7_000] for i in range(0, len(df), 7_000)]
+    out = ChunkedDataset(lambda _cols: iter(chunks)).report(spec).single()["Exact"]
+    assert ((out / 30_000 - 1).abs() < 0.07).all(), out
+
+
+def test_sql_approx_nunique_honours_error() -> None:
+    m = AggMeasure("Users", ApproxNUnique("uid"))
+    assert SQLEmitter(Dialect.DUCKDB).agg_of_measure(m)[0].startswith("COUNT(DISTINCT")
+    assert SQLEmitter(Dialect.BIGQUERY).agg_of_measure(m)[0].startswith("APPROX_COUNT_DISTINCT")
+    tight = AggMeasure("Users", ApproxNUnique("uid", 0.002))
+    assert SQLEmitter(Dialect.BIGQUERY).agg_of_measure(tight)[0].startswith("COUNT(DISTINCT")
+
+
+# ---- 分块数据源 ----
+def test_empty_chunked_source_matches_empty_frame(ads: pd.DataFrame) -> None:
+    spec = ReportSpec(rows=[Dimension("Campaign", role=FieldRole.ROW)], columns=[Dimension("Device", role=FieldRole.COLUMN)],
+                      metrics=[AggMeasure("Clicks", Sum("clicks")), AggMeasure("CTR", RatioOfSums("clicks", "impr", 0))],
+                      totals=True)
+    expected = Dataset(ads.iloc[:0]).report(spec)
+    result = ChunkedDataset(iter([])).report(spec)
+    assert result.slicer_names == expected.slicer_names
+    assert result.frames.keys() == expected.frames.keys()
+    for key, frame in expected.frames.items():
+        pd.testing.assert_frame_equal(result.frames[key], frame, check_dtype=False, check_index_type=False,
+                                      check_column_type=False)
+
+
+# ---- ParallelPandasEngine ----
+def test_parallel_engine_matches_pandas_and_reuses_pool() -> None:
+    rng = np.random.default_rng(3)
+    n = 40_000
+    df = pd.DataFrame({"Campaign": rng.choice(["A", "B", "C"], n), "Device": rng.choice(["Mobile", "Desktop"], n),
+                       "clicks": rng.integers(0, 100, n), "impr": rng.integers(1, 500, n),
+                       "uid": pd.array(rng.integers(0, 5_000, n), dtype="Int64")})
+    spec = ReportSpec(rows=[Dimension("Campaign", role=FieldRole.ROW)], columns=[Dimension("Device", role=FieldRole.COLUMN)],
+                      metrics=[AggMeasure("Clicks", Sum("clicks")), AggMeasure("Users", NUnique("uid")),
+                               AggMeasure("CTR", RatioOfSums("clicks", "impr", 0))], totals=True)
+    expected = Dataset(df).report(spec, PandasEngine()).single()
+    with ParallelPandasEngine(workers=2, min_rows=10_000, mp_context=multiprocessing.get_context("spawn")) as engine:
+        ds = Dataset(df, cache_bytes=None)
+        pd.testing.assert_frame_equal(ds.report(spec, engine).single(), expected)
+        pool = engine._pool
+        assert pool is not None
+        pd.testing.assert_frame_equal(ds.report(spec, engine).single(), expected)
+        assert engine._pool is pool
+    assert engine._pool is None
+
+
+# ---- ParquetDataset：EXPLAIN 与分区/行组裁剪 ----
+def test_parquet_explain_reports_path(ads: pd.DataFrame, tmp_path) -> None:
+    pytest.importorskip("pyarrow")
+    ads.to_parquet(tmp_path / "ads.parquet", index=False)
+    ds = ParquetDataset(str(tmp_path / "ads.parquet"))
+    spec = ReportSpec(rows=[Dimension("Campaign", role=FieldRole.ROW)], columns=[],
+                      metrics=[AggMeasure("Clicks", Sum("clicks"))], where=col("Country") == lit("US"))
+    scan = ds.explain(spec).find("scan")
+    assert scan.detail["path"] == ds.path and scan.detail["source"] == "parquet"
+    assert "Country" in scan.detail["pruning"]
+    assert ds.explain(spec, analyze=True, memory=False).find("scan") is not None
+
+
+def test_parquet_pruning_skips_partitions_and_row_groups(ads: pd.DataFrame, tmp_path) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    pa = pytest.importorskip("pyarrow")
+    for country, part in ads.sort_values("clicks").groupby("Country"):
+        (tmp_path / f"Country={country}").mkdir()
+        pq.write_table(pa.Table.from_pandas(part.drop(columns="Country"), preserve_index=False),
+                       tmp_path / f"Country={country}" / "part-0.parquet", row_group_size=2)
+    ds = ParquetDataset(str(tmp_path))
+    where = (col("Country") == lit("US")) & (col("clicks") >= 100)
+    fragments = list(ds.dataset.get_fragments(filter=ds.pruning_filter(where)))
+    assert len(fragments) == 1  # 只剩 Country=US 分区
+    row_groups = fragments[0].split_by_row_group(ds.pruning_filter(col("clicks") >= 100))
+    assert len(row_groups) < fragments[0].num_row_groups  # clicks 排序写入：min/max 跳过前面的行组
+
+    spec = ReportSpec(rows=[Dimension("Campaign", role=FieldRole.ROW)], columns=[],
+                      metrics=[AggMeasure("Clicks", Sum("clicks")), AggMeasure("Impr", Sum("impr"))], where=where)
+    expected = Dataset(ads).report(spec).single()
+    pd.testing.assert_frame_equal(ds.report(spec).single(), expected, check_dtype=False, check_index_type=False)
+
+
+# ---- 跨引擎一致性 / AutoEngine ----
+@pytest.fixture
+def nullable_ads() -> pd.DataFrame:
+    rng = np.random.default_rng(11)
+    n = 3_000
+    return pd.DataFrame({"Campaign": rng.choice(["A", "B", "C"], n), "Device": rng.choice(["Mobile", "Tablet", None], n),
+                         "clicks": rng.integers(0, 100, n), "impr": rng.integers(1, 500, n),
+                         "cost": np.where(rng.random(n) < 0.1, np.nan, rng.random(n) * 10)})
+
+
+def _engine_spec(where, distinct: str = "clicks") -> ReportSpec:
+    return ReportSpec(rows=[Dimension("Campaign", role=FieldRole.ROW)], columns=[],
+                      metrics=[AggMeasure("Clicks", Sum("clicks")), AggMeasure("Cost", Sum("cost")),
+                               AggMeasure("Rows", Count()), AggMeasure("CPC", RatioOfSums("cost", "clicks", 0)),
+                               AggMeasure("AvgCost", Avg("cost")), AggMeasure("Distinct", NUnique(distinct))],
+                      where=where, totals=True)
+
+
+# DuckDB 与 pandas 对缺失值语义不同的报表：AutoEngine 须排除 DuckDB
+NULL_SENSITIVE = {"ne": _engine_spec(col("Device") != lit("Tablet")), "not_gt": _engine_spec(~(col("cost") > 5)),
+                  "sql_not_like": _engine_spec(sql_duckdb("WHERE Device NOT LIKE 'Tab%'")),
+                  "nunique": _engine_spec(None, distinct="Device")}
+
+
+@pytest.mark.parametrize("where", [None, col("cost") > 5, col("Device").isin(["Mobile"])], ids=["none", "gt", "isin"])
+def test_engines_agree(nullable_ads: pd.DataFrame, where) -> None:
+    engines = [ChunkedPandasEngine(chunk_rows=700)]
+    if importlib.util.find_spec("duckdb") is not None:
+        engines.append(DuckDBEngine())
+    expected = Dataset(nullable_ads).report(_engine_spec(where), PandasEngine()).single()
+    for engine in engines:
+        got = Dataset(nullable_ads).report(_engine_spec(where), engine).single()
+        pd.testing.assert_frame_equal(got.sort_index(), expected.sort_index(), check_exact=False, rtol=1e-9,
+                                      obj=type(engine).__name__)
+
+
+@pytest.mark.parametrize("name", list(NULL_SENSITIVE))
+@pytest.mark.parametrize("rows", [300, 3_000])
+def test_auto_engine_matches_pandas_over_missing_values(nullable_ads: pd.DataFrame, name: str, rows: int) -> None:
+    pytest.importorskip("duckdb")
+    df = nullable_ads.iloc[:rows]
+    spec = NULL_SENSITIVE[name]
+    auto = AutoEngine([DuckDBEngine(), PandasEngine()])
+    got = Dataset(df).report(spec, auto).single()
+    assert "DuckDBEngine" in auto.last_decision.rejected
+    pd.testing.assert_frame_equal(got, Dataset(df).report(spec, PandasEngine()).single())
+
+
+def test_auto_engine_keeps_duckdb_when_negated_column_has_no_nulls(nullable_ads: pd.DataFrame) -> None:
+    pytest.importorskip("duckdb")
+    auto = AutoEngine([DuckDBEngine(), PandasEngine()])
+    Dataset(nullable_ads).report(_engine_spec(col("Campaign") != lit("A")), auto)
+    assert "DuckDBEngine" not in auto.last_decision.rejected
+
+
+def test_duckdb_integer_sum_stays_integer(nullable_ads: pd.DataFrame) -> None:
+    pytest.importorskip("duckdb")
+    pa = pytest.importorskip("pyarrow")
+    spec = _engine_spec(None)
+    for ds in (Dataset(nullable_ads), Dataset(pa.Table.from_pandas(nullable_ads, preserve_index=False))):
+        assert ds.report(spec, DuckDBEngine()).single()["Clicks"].dtype == np.int64
+
+
+def test_auto_engine_memoizes_ranking_and_caches_results(nullable_ads: pd.DataFrame,
+                                                         monkeypatch: pytest.MonkeyPatch) -> None:
+    calls = []
+    original = report.workload_stats
+    monkeypatch.setattr(report, "workload_stats", lambda *a, **k: calls.append(1) or original(*a, **k))
+    ds, auto, spec = Dataset(nullable_ads), AutoEngine(), _engine_spec(col("cost") > 5)
+    assert auto.cacheable
+    first = ds.report(spec, auto)
+    auto.rank(ds, spec, Planner(auto).compile(ds, spec))
+    pd.testing.assert_frame_equal(ds.report(spec, auto).single(), first.single())
+    assert ds.cache.hits == 1 and len(calls) == 1
+    ds.append(nullable_ads.iloc[:10])
+    ds.report(spec, auto)
+    assert len(calls) == 2